@@ -1,13 +1,230 @@
-from flask import Flask, request, abort, jsonify
+from flask import (
+    Flask, Response, request, abort, current_app, jsonify, make_response,
+    stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from database.models import ActorInMovie, db_drop_and_create_all, setup_db, Actor, Movie
-from auth.auth import AuthError, requires_auth
+import hashlib
+import json
+import os
+from datetime import datetime
+from sqlalchemy import func, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.orm.exc import StaleDataError
+from database.models import ActorInMovie, db, db_drop_and_create_all, setup_db, unit_of_work, Actor, Movie, TableVersion
+from database.export import export_batches, export_columns
+from database.filters import (
+    ACTOR_FILTERS, ACTOR_SORT_KEYS, MOVIE_FILTERS, MOVIE_SORT_KEYS,
+    parse_filters, parse_sort)
+from database.pagination import (
+    PageStream, cursor_values, paginate, parse_page_args)
+from database.pool import pool_stats
+from database.profiler import SQL_TOP_LIMIT, SQL_TOP_SORT_KEYS
+from database.routing import READ_PRIMARY_COOKIE, primary_reads
+from database.stats import ActorStats, ReleaseYearStats
+from database.search import (
+    SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT, search, search_terms)
+from auth.auth import AuthError, get_permission_set, requires_auth
+from cache.response_cache import ACTOR, MOVIE, create_response_cache
+from graph.cast_graph import GRAPH_MAX_DEGREES, CastGraph, written_version
+from metrics.request_metrics import init_request_metrics
+from serialization.export import (
+    EXPORT_FORMATS, csv_chunks, gzip_chunks, ndjson_chunks)
+from serialization.json_provider import (
+    JSON_STREAM_MIN_ROWS, init_json_provider, streamed_json_response)
+
+# Largest number of movies accepted by a single POST /movies/bulk
+BULK_MAX_MOVIES = int(os.environ.get('BULK_MAX_MOVIES', 10000))
+# Rows inserted and committed together by POST /actors/bulk
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 1000))
+BULK_MAX_BATCH_SIZE = int(os.environ.get('BULK_MAX_BATCH_SIZE', 10000))
+# Per-line errors listed in a POST /actors/bulk response, the rest are counted
+BULK_MAX_REPORTED_ERRORS = int(
+    os.environ.get('BULK_MAX_REPORTED_ERRORS', 1000))
+
+DATE_FORMATS = ("%Y-%m-%d", "%B %d, %Y", "%b %d, %Y")
+
+
+def parse_date(value):
+    """
+    Parses an ISO or "April 30, 1988" style date, raises TypeError when
+    value is not a string and ValueError when it is not a date
+    """
+    if not isinstance(value, str):
+        raise TypeError
+
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format).date()
+        except ValueError:
+            continue
+
+    raise ValueError
+
+
+def row_etag(kind, row_id, version):
+    return "{}-{}-v{}".format(kind, row_id, version)
+
+
+def list_etag(table_name, version, query_string=None):
+    """A list page depends on the table version and on its query string"""
+    if query_string is None:
+        query_string = request.query_string
+    query_hash = hashlib.sha1(query_string).hexdigest()[:16]
+    return "{}-v{}-{}".format(table_name, version, query_hash)
+
+
+def not_modified(etag):
+    """A 304 response if the client already holds this version, else None"""
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+    return None
+
+
+def check_if_match(etag):
+    """Aborts with 412 if If-Match names another version of the resource"""
+    if request.if_match and not request.if_match.contains(etag):
+        abort(412)
+
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    return response
+
+
+def export_response(name):
+    """
+    Streams an export as NDJSON (default) or CSV, picked by ?format=,
+    gzipped on the fly when the client accepts it
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+
+    keys = export_columns(name)
+    batches = export_batches(name)
+    if export_format == 'csv':
+        chunks = csv_chunks(keys, batches)
+    else:
+        chunks = ndjson_chunks(current_app.json, keys, batches)
+
+    headers = {
+        'Content-Disposition': 'attachment; filename="{}.{}"'.format(
+            name, export_format),
+        'Vary': 'Accept-Encoding'
+    }
+    if request.accept_encodings['gzip']:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(stream_with_context(chunks),
+                    mimetype=EXPORT_FORMATS[export_format], headers=headers)
+
+
+def parse_new_actor(body):
+    """
+    Reads an actor from a request body with the rules of POST /actors
+    Raises TypeError, KeyError or ValueError
+    """
+    if not isinstance(body, dict):
+        raise TypeError
+
+    new_name = body.get('name', None)
+    new_date_of_birth = body.get('date_of_birth', None)
+    new_full_name = body.get('full_name', None)
+
+    if new_name is None or new_date_of_birth is None:
+        raise TypeError
+
+    # Names end up in set lookups and unique indexes, only strings will do
+    if not isinstance(new_name, str) \
+            or not isinstance(new_full_name, (str, type(None))):
+        raise TypeError
+
+    if new_name == '' or new_date_of_birth == '':
+        raise ValueError
+
+    return Actor(new_name, new_full_name or '',
+                 parse_date(new_date_of_birth))
+
+
+def parse_new_movie(body):
+    """
+    Reads a movie from a request body with the rules of POST /movies
+    Returns (movie, cast), raises TypeError, KeyError or ValueError
+    """
+    if not isinstance(body, dict):
+        raise TypeError
+
+    new_title = body.get('title', None)
+    new_release_year = body.get('release_year', None)
+    new_duration = body.get('duration', None)
+    new_imdb_rating = body.get('imdb_rating', None)
+    new_cast = body.get('cast', None)
+
+    if new_title is None \
+            or new_title == '' \
+            or new_release_year <= 0 \
+            or new_duration <= 0 \
+            or new_imdb_rating < 0 \
+            or new_imdb_rating > 10 \
+            or not isinstance(new_cast, list) \
+            or len(new_cast) == 0 \
+            or not all(isinstance(name, str) for name in new_cast):
+        raise TypeError
+
+    new_movie = Movie(
+        new_title,
+        new_release_year,
+        new_duration,
+        new_imdb_rating
+    )
+
+    return new_movie, new_cast
 
 
 def create_app(test_config=None):
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
+    init_json_provider(app)
+    # Registered first so its after_request hook runs last
+    request_metrics = init_request_metrics(app)
+    sql_profiler = app.extensions['sql_profiler']
+
+    # Detail reads are cached, every write below invalidates what it changed
+    response_cache = create_response_cache(app.config)
+    app.extensions['response_cache'] = response_cache
+
+    def cached_detail(kind, row_id):
+        """
+        The cached detail of a row, never for a client that just wrote:
+        the cache may predate its write and its reads go to the primary
+        """
+        if READ_PRIMARY_COOKIE in request.cookies:
+            return None
+        return response_cache.get(kind, row_id)
+
+    def cache_detail(kind, model, row_id, cached):
+        """
+        Caches a detail read from the primary, see primary_reads: a lagging
+        replica would serve every client its old rows until the entry
+        expires; skipped when a write committed since the row was read, as
+        that write may have invalidated the entry already
+        """
+        if db.session.info.get("use_replica"):
+            return
+        if model.version_of(row_id) == cached["version"]:
+            response_cache.set(kind, row_id, cached)
+
+    # Co-star and separation queries walk this instead of the database,
+    # every write changing a cast updates it
+    cast_graph = CastGraph()
+    app.extensions['cast_graph'] = cast_graph
 
     # Uncomment the following line on the initial run to setup
     # the required tables in the database
@@ -31,39 +248,84 @@ def create_app(test_config=None):
     @app.route('/actors')
     @requires_auth("get:actors")
     def get_actors(payload):
-        actors_query = Actor.query.order_by(Actor.id).all()
-
-        return jsonify({
+        try:
+            limit, cursor = parse_page_args(request.args)
+            predicates = parse_filters(request.args, ACTOR_FILTERS)
+            key_columns, descending = parse_sort(
+                request.args, ACTOR_SORT_KEYS, Actor.id)
+            if cursor is not None:
+                cursor = cursor_values(cursor, key_columns)
+        except ValueError:
+            abort(400)
+
+        # Revalidation reads one counter, not the rows
+        etag = list_etag("actors", TableVersion.current("actors"))
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
+        actors_query = Actor.short_info_query().filter(*predicates)
+
+        if limit >= JSON_STREAM_MIN_ROWS:
+            # Large pages are fetched and encoded chunk by chunk
+            page = PageStream(actors_query, key_columns, limit, cursor,
+                              descending)
+            return with_etag(streamed_json_response(
+                {"success": True}, "actors", page,
+                lambda: {"next_cursor": page.next_cursor}), etag), 200
+
+        actors, next_cursor = paginate(
+            actors_query, key_columns, limit, cursor, descending)
+
+        return with_etag(jsonify({
             "success": True,
-            "actors": [actor.short_info for actor in actors_query]
-        }), 200
+            "actors": actors,
+            "next_cursor": next_cursor
+        }), etag), 200
 
     @app.route('/actors/<int:actor_id>')
     @requires_auth("get:actor-by-id")
     def get_actor_by_id(payload, actor_id):
-        actor = Actor.query.filter_by(id=actor_id).first()
-
-        if actor is None:
-            return abort(404)
-        return jsonify({
+        cached = cached_detail(ACTOR, actor_id)
+
+        if cached is None:
+            if request.if_none_match:
+                # Revalidation reads the version, not the related rows
+                version = Actor.version_of(actor_id)
+                if version is None:
+                    return abort(404)
+
+                response = not_modified(row_etag(ACTOR, actor_id, version))
+                if response is not None:
+                    return response
+
+            # Misses read the primary, so replicated setups fill the
+            # cache too
+            with primary_reads(db.session):
+                actor = Actor.query.options(Actor.with_movies()) \
+                    .filter_by(id=actor_id).first()
+
+                if actor is None:
+                    return abort(404)
+                cached = {"version": actor.version, "info": actor.full_info}
+                cache_detail(ACTOR, Actor, actor_id, cached)
+
+        etag = row_etag(ACTOR, actor_id, cached["version"])
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
+        return with_etag(jsonify({
             "success": True,
-            "actor": actor.full_info
-        }), 200
+            "actor": cached["info"]
+        }), etag), 200
 
     @app.route('/actors', methods=['POST'])
     @requires_auth("post:actors")
     def create_actor(payload):
         try:
             body = request.get_json()
-            new_name = body.get('name', None)
-            new_date_of_birth = body.get('date_of_birth', None)
-            new_full_name = body.get('full_name', None)
-
-            if new_name == '' or new_date_of_birth == '':
-                raise ValueError
-
-            new_actor = Actor(new_name, new_full_name,
-                              new_date_of_birth)
+            new_actor = parse_new_actor(body)
             new_actor.insert()
 
             return jsonify({
@@ -74,9 +336,103 @@ def create_app(test_config=None):
         except (TypeError, KeyError, ValueError):
             abort(422)
 
+        except IntegrityError:
+            # Actor names are unique
+            db.session.rollback()
+            abort(422)
+
         except Exception:
             abort(500)
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth("post:actors")
+    def create_actors_bulk(payload):
+        """
+        Streams an NDJSON body (one actor per line) into the database
+        Lines are validated like POST /actors and inserted in batches of
+        batch_size with one commit per batch, invalid lines are reported
+        without aborting the upload
+        """
+        try:
+            batch_size = int(request.args.get('batch_size', BULK_BATCH_SIZE))
+        except ValueError:
+            abort(400)
+
+        if batch_size <= 0:
+            abort(400)
+        batch_size = min(batch_size, BULK_MAX_BATCH_SIZE)
+
+        created = 0
+        failed = 0
+        errors = []
+
+        def report(line_number, message):
+            if len(errors) < BULK_MAX_REPORTED_ERRORS:
+                errors.append({"line": line_number, "error": message})
+
+        def flush(batch):
+            nonlocal created, failed
+
+            # Actor names are unique, duplicates are reported per line
+            # instead of failing the whole batch
+            names = {row["name"] for _, row in batch}
+            taken = {name for name, in db.session.query(Actor.name)
+                     .filter(Actor.name.in_(names))}
+            rows = []
+            for line_number, row in batch:
+                if row["name"] in taken:
+                    failed += 1
+                    report(line_number, "duplicate name")
+                    continue
+                taken.add(row["name"])
+                rows.append((line_number, row))
+
+            if not rows:
+                return
+            batch = rows
+
+            try:
+                db.session.execute(insert(Actor), [row for _, row in batch])
+                db.session.commit()
+                created += len(batch)
+            except Exception:
+                db.session.rollback()
+                failed += len(batch)
+                for line_number, _ in batch:
+                    report(line_number, "database error")
+
+        batch = []
+        for line_number, line in enumerate(request.stream, start=1):
+            if not line.strip():
+                continue
+
+            try:
+                actor = parse_new_actor(json.loads(line))
+            except (TypeError, KeyError, ValueError):
+                failed += 1
+                report(line_number, "unprocessable")
+                continue
+
+            batch.append((line_number, {
+                "name": actor.name,
+                "full_name": actor.full_name,
+                "date_of_birth": actor.date_of_birth
+            }))
+
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+
+        if batch:
+            flush(batch)
+
+        return jsonify({
+            "success": True,
+            "created": created,
+            "failed": failed,
+            "errors": errors
+        }), 200
+
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth("patch:actors")
     def update_actor(payload, actor_id):
@@ -84,6 +440,7 @@ def create_app(test_config=None):
 
         if actor is None:
             return abort(404)
+        check_if_match(row_etag(ACTOR, actor_id, actor.version))
 
         try:
             body = request.get_json()
@@ -91,31 +448,51 @@ def create_app(test_config=None):
             new_date_of_birth = body.get('date_of_birth', None)
             new_full_name = body.get('full_name', None)
 
-            if 'date_of_birth' in body:
-                if new_date_of_birth == "":
-                    raise ValueError
-                actor.date_of_birth = new_date_of_birth
+            # Movies list their cast by name
+            affected_movie_ids = set()
 
-            if 'name' in body:
-                if new_name == "":
-                    raise ValueError
-                actor.name = new_name
+            with unit_of_work():
+                if 'date_of_birth' in body:
+                    if new_date_of_birth == "":
+                        raise ValueError
+                    actor.date_of_birth = new_date_of_birth
 
-            if 'full_name' in body:
-                if new_full_name == "":
-                    raise ValueError
-                actor.full_name = new_full_name
+                if 'name' in body:
+                    if new_name == "":
+                        raise ValueError
+                    if new_name != actor.name:
+                        affected_movie_ids = ActorInMovie.movie_ids_of(
+                            [actor_id])
+                        Movie.touch(affected_movie_ids)
+                    actor.name = new_name
 
-            actor.update()
+                if 'full_name' in body:
+                    if new_full_name == "":
+                        raise ValueError
+                    actor.full_name = new_full_name
 
-            return jsonify({
+                actor.update()
+
+            response_cache.invalidate(ACTOR, [actor_id])
+            response_cache.invalidate(MOVIE, affected_movie_ids)
+
+            return with_etag(jsonify({
                 "success": True,
                 "actor_info": actor.long_info
-            }), 200
+            }), row_etag(ACTOR, actor_id, actor.version)), 200
 
         except (TypeError, ValueError, KeyError):
             abort(422)
 
+        except IntegrityError:
+            # Actor names are unique
+            db.session.rollback()
+            abort(422)
+
+        except StaleDataError:
+            # Changed by another request since it was read
+            abort(412)
+
         except Exception as e:
             abort(500)
 
@@ -126,73 +503,135 @@ def create_app(test_config=None):
 
         if actor is None:
             return abort(404)
+        check_if_match(row_etag(ACTOR, actor_id, actor.version))
 
         try:
-            actor.delete()
+            # Their movies lose a cast member
+            with unit_of_work():
+                movie_ids = ActorInMovie.movie_ids_of([actor_id])
+                Movie.touch(movie_ids)
+                actor.delete()
+                if movie_ids:
+                    cast_version = written_version()
+
+            response_cache.invalidate(ACTOR, [actor_id])
+            response_cache.invalidate(MOVIE, movie_ids)
+            if movie_ids:
+                cast_graph.apply_write(cast_version, actor_ids=[actor_id])
 
             return jsonify({
                 "success": True,
                 "deleted_actor_id": actor.id
             }), 200
 
+        except StaleDataError:
+            abort(412)
+
         except Exception as e:
             abort(500)
 
     @app.route('/movies')
     @requires_auth("get:movies")
     def get_movies(payload):
-        movies_query = Movie.query.order_by(Movie.id).all()
-
-        return jsonify({
+        try:
+            limit, cursor = parse_page_args(request.args)
+            predicates = parse_filters(request.args, MOVIE_FILTERS)
+            key_columns, descending = parse_sort(
+                request.args, MOVIE_SORT_KEYS, Movie.id)
+            if cursor is not None:
+                cursor = cursor_values(cursor, key_columns)
+        except ValueError:
+            abort(400)
+
+        # Revalidation reads one counter, not the rows
+        etag = list_etag("movies", TableVersion.current("movies"))
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
+        movies_query = Movie.short_info_query().filter(*predicates)
+
+        if limit >= JSON_STREAM_MIN_ROWS:
+            # Large pages are fetched and encoded chunk by chunk
+            page = PageStream(movies_query, key_columns, limit, cursor,
+                              descending)
+            return with_etag(streamed_json_response(
+                {"success": True}, "movies", page,
+                lambda: {"next_cursor": page.next_cursor}), etag), 200
+
+        movies, next_cursor = paginate(
+            movies_query, key_columns, limit, cursor, descending)
+
+        return with_etag(jsonify({
             "success": True,
-            "movies": [movie.short_info for movie in movies_query]
-        }), 200
+            "movies": movies,
+            "next_cursor": next_cursor
+        }), etag), 200
 
     @app.route('/movies/<int:movie_id>')
     @requires_auth("get:movie-by-id")
     def get_movie_by_id(payload, movie_id):
-        movie = Movie.query.filter_by(id=movie_id).first()
-
-        if movie is None:
-            return abort(404)
-        return jsonify({
+        cached = cached_detail(MOVIE, movie_id)
+
+        if cached is None:
+            if request.if_none_match:
+                # Revalidation reads the version, not the related rows
+                version = Movie.version_of(movie_id)
+                if version is None:
+                    return abort(404)
+
+                response = not_modified(row_etag(MOVIE, movie_id, version))
+                if response is not None:
+                    return response
+
+            # Misses read the primary, so replicated setups fill the
+            # cache too
+            with primary_reads(db.session):
+                movie = Movie.query.options(Movie.with_cast()) \
+                    .filter_by(id=movie_id).first()
+
+                if movie is None:
+                    return abort(404)
+                cached = {"version": movie.version, "info": movie.full_info}
+                cache_detail(MOVIE, Movie, movie_id, cached)
+
+        etag = row_etag(MOVIE, movie_id, cached["version"])
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
+        return with_etag(jsonify({
             "success": True,
-            "movie": movie.full_info
-        }), 200
+            "movie": cached["info"]
+        }), etag), 200
 
     @app.route('/movies', methods=['POST'])
     @requires_auth("post:movies")
     def create_movie(payload):
         try:
             body = request.get_json()
-            new_title = body.get('title', None)
-            new_release_year = body.get('release_year', None)
-            new_duration = body.get('duration', None)
-            new_imdb_rating = body.get('imdb_rating', None)
-            new_cast = body.get('cast', None)
+            new_movie, new_cast = parse_new_movie(body)
 
-            if new_title == '' \
-                    or new_release_year <= 0 \
-                    or new_duration <= 0 \
-                    or new_imdb_rating < 0 \
-                    or new_imdb_rating > 10 \
-                    or len(new_cast) == 0:
-                raise TypeError
-
-            new_movie = Movie(
-                new_title,
-                new_release_year,
-                new_duration,
-                new_imdb_rating
-            )
             actors = Actor.query.filter(
                 Actor.name.in_(new_cast)).all()
 
             if len(new_cast) == len(actors):
-                new_movie.insert()
-                for actor in actors:
-                    actor_in_movie = ActorInMovie(new_movie.id, actor.id)
-                    actor_in_movie.insert()
+                # One transaction, the links pick up the movie id on flush
+                with unit_of_work():
+                    new_movie.insert()
+                    for actor in actors:
+                        actor_in_movie = ActorInMovie(None, actor.id)
+                        new_movie.actors.append(actor_in_movie)
+                        actor_in_movie.insert()
+                    Actor.touch([actor.id for actor in actors])
+                    cast_version = written_version()
+
+                response_cache.invalidate(MOVIE, [new_movie.id])
+                response_cache.invalidate(
+                    ACTOR, [actor.id for actor in actors])
+                cast_graph.apply_write(
+                    cast_version,
+                    added=[(actor.id, new_movie.id) for actor in actors])
             else:
                 raise ValueError
 
@@ -207,6 +646,71 @@ def create_app(test_config=None):
         except Exception as e:
             abort(500)
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth("post:movies")
+    def create_movies_bulk(payload):
+        """
+        Creates many movies with their casts in a single transaction:
+        one query resolves every actor name, the movies are inserted in
+        batches and the cast links with a single executemany
+        """
+        try:
+            body = request.get_json()
+            movies_body = body['movies']
+
+            if len(movies_body) == 0 or len(movies_body) > BULK_MAX_MOVIES:
+                raise ValueError
+
+            new_movies = [parse_new_movie(movie) for movie in movies_body]
+            if any(len(set(cast)) != len(cast) for _, cast in new_movies):
+                raise ValueError
+
+            names = {name for _, cast in new_movies for name in cast}
+            actor_ids = {}
+            for actor_id, name in db.session.query(Actor.id, Actor.name) \
+                    .filter(Actor.name.in_(names)):
+                # Ambiguous names are rejected, as in POST /movies
+                if name in actor_ids:
+                    raise ValueError
+                actor_ids[name] = actor_id
+
+            if len(actor_ids) != len(names):
+                raise ValueError
+
+        except (TypeError, KeyError, ValueError):
+            abort(422)
+
+        try:
+            movies = [movie for movie, _ in new_movies]
+            db.session.add_all(movies)
+            db.session.flush()
+
+            links = [
+                {"movie_id": movie.id, "actor_id": actor_ids[name]}
+                for movie, cast in new_movies
+                for name in cast
+            ]
+            db.session.execute(insert(ActorInMovie), links)
+            Actor.touch(actor_ids.values())
+            # Read before commit expires the movies
+            created_movie_ids = [movie.id for movie in movies]
+            cast_version = written_version()
+            db.session.commit()
+
+            response_cache.invalidate(MOVIE, created_movie_ids)
+            response_cache.invalidate(ACTOR, actor_ids.values())
+            cast_graph.apply_write(cast_version, added=[
+                (link["actor_id"], link["movie_id"]) for link in links])
+
+            return jsonify({
+                "success": True,
+                "created_movie_ids": created_movie_ids
+            }), 201
+
+        except Exception:
+            db.session.rollback()
+            abort(500)
+
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth("patch:movies")
     def update_movie(payload, movie_id):
@@ -214,6 +718,7 @@ def create_app(test_config=None):
 
         if movie is None:
             return abort(404)
+        check_if_match(row_etag(MOVIE, movie_id, movie.version))
 
         try:
             body = request.get_json()
@@ -223,53 +728,98 @@ def create_app(test_config=None):
             new_imdb_rating = body.get('imdb_rating', None)
             new_cast = body.get('cast', None)
 
-            if "title" in body:
-                if new_title == "":
-                    raise ValueError
-
-                movie.title = new_title
-
-            if "release_year" in body:
-                if new_release_year <= 0:
-                    raise ValueError
-
-                movie.release_year = new_release_year
-
-            if "duration" in body:
-                if new_duration <= 0:
-                    raise ValueError
-
-                movie.duration = new_duration
-
-            if "imdb_rating" in body:
-                if new_imdb_rating < 0 \
-                        or new_imdb_rating > 10:
-                    raise ValueError
-
-                movie.imdb_rating = new_imdb_rating
-
-            if "cast" in body:
-                if len(new_cast) == 0:
-                    raise ValueError
-
-                actors = Actor.query.filter(
-                    Actor.name.in_(new_cast)).all()
-
-                if len(new_cast) == len(actors):
-                    movie.cast = actors
-                else:
-                    raise ValueError
-
-            movie.update()
-
-            return jsonify({
+            # Actors list their movies by title
+            affected_actor_ids = set()
+            added_actor_ids = set()
+            removed_actor_ids = set()
+
+            # Field and cast changes are committed together or not at all
+            with unit_of_work():
+                if "title" in body:
+                    if new_title == "":
+                        raise ValueError
+
+                    if new_title != movie.title:
+                        affected_actor_ids |= ActorInMovie.actor_ids_of(
+                            [movie_id])
+                    movie.title = new_title
+
+                if "release_year" in body:
+                    if new_release_year <= 0:
+                        raise ValueError
+
+                    movie.release_year = new_release_year
+
+                if "duration" in body:
+                    if new_duration <= 0:
+                        raise ValueError
+
+                    movie.duration = new_duration
+
+                if "imdb_rating" in body:
+                    if new_imdb_rating < 0 \
+                            or new_imdb_rating > 10:
+                        raise ValueError
+
+                    movie.imdb_rating = new_imdb_rating
+
+                if "cast" in body:
+                    if len(new_cast) == 0:
+                        raise ValueError
+
+                    actors = Actor.query.filter(
+                        Actor.name.in_(new_cast)).all()
+
+                    if len(new_cast) == len(actors):
+                        new_actor_ids = {actor.id for actor in actors}
+                        current = {actor_in_movie.actor_id: actor_in_movie
+                                   for actor_in_movie in movie.actors}
+
+                        removed_actor_ids = current.keys() - new_actor_ids
+                        for actor_id in removed_actor_ids:
+                            actor_in_movie = current[actor_id]
+                            movie.actors.remove(actor_in_movie)
+                            actor_in_movie.delete()
+
+                        added_actor_ids = new_actor_ids - current.keys()
+                        for actor_id in added_actor_ids:
+                            ActorInMovie(movie.id, actor_id).insert()
+
+                        changed_actor_ids = \
+                            new_actor_ids.symmetric_difference(current)
+                        if changed_actor_ids:
+                            # The cast is part of the movie's version too
+                            flag_modified(movie, "title")
+                        affected_actor_ids |= changed_actor_ids
+                    else:
+                        raise ValueError
+
+                Actor.touch(affected_actor_ids)
+                movie.update()
+                if added_actor_ids or removed_actor_ids:
+                    cast_version = written_version()
+
+            response_cache.invalidate(MOVIE, [movie_id])
+            response_cache.invalidate(ACTOR, affected_actor_ids)
+            if added_actor_ids or removed_actor_ids:
+                cast_graph.apply_write(
+                    cast_version,
+                    added=[(actor_id, movie_id)
+                           for actor_id in added_actor_ids],
+                    removed=[(actor_id, movie_id)
+                             for actor_id in removed_actor_ids])
+
+            return with_etag(jsonify({
                 "success": True,
                 "movie_info": movie.long_info
-            }), 200
+            }), row_etag(MOVIE, movie_id, movie.version)), 200
 
         except (TypeError, ValueError, KeyError):
             abort(422)
 
+        except StaleDataError:
+            abort(412)
+
         except Exception:
             abort(500)
 
@@ -280,18 +830,279 @@ def create_app(test_config=None):
 
         if movie is None:
             return abort(404)
+        check_if_match(row_etag(MOVIE, movie_id, movie.version))
 
         try:
-            movie.delete()
+            # Its cast lose a movie
+            with unit_of_work():
+                actor_ids = ActorInMovie.actor_ids_of([movie_id])
+                Actor.touch(actor_ids)
+                movie.delete()
+                if actor_ids:
+                    cast_version = written_version()
+
+            response_cache.invalidate(MOVIE, [movie_id])
+            response_cache.invalidate(ACTOR, actor_ids)
+            if actor_ids:
+                cast_graph.apply_write(cast_version, movie_ids=[movie_id])
 
             return jsonify({
                 "success": True,
                 "deleted_movie_id": movie.id
             }), 200
 
+        except StaleDataError:
+            abort(412)
+
         except Exception:
             abort(500)
 
+    @app.route('/actors/<int:actor_id>/co-stars')
+    @requires_auth("get:actor-by-id")
+    def get_co_stars(payload, actor_id):
+        """Actors sharing a movie with actor_id, the most shared first"""
+        try:
+            limit, _ = parse_page_args(request.args)
+        except ValueError:
+            abort(400)
+
+        if Actor.version_of(actor_id) is None:
+            abort(404)
+
+        cast_graph.refresh()
+        shared = cast_graph.co_stars(actor_id)
+        co_star_ids = sorted(shared, key=lambda co_star_id: (
+            -shared[co_star_id], co_star_id))[:limit]
+
+        co_stars = Actor.short_info_by_id(co_star_ids)
+        return jsonify({
+            "success": True,
+            "actor_id": actor_id,
+            "total_co_stars": len(shared),
+            "co_stars": [dict(co_stars[co_star_id],
+                              shared_movies=shared[co_star_id])
+                         for co_star_id in co_star_ids]
+        }), 200
+
+    @app.route('/actors/<int:actor_id>/separation/<int:other_actor_id>')
+    @requires_auth("get:actor-by-id")
+    def get_separation(payload, actor_id, other_actor_id):
+        """
+        Degrees of separation between two actors, with one shortest chain
+        of actors and the movies linking them
+        """
+        try:
+            max_degrees = int(request.args.get('max_degrees',
+                                               GRAPH_MAX_DEGREES))
+        except ValueError:
+            abort(400)
+
+        if not 0 < max_degrees <= GRAPH_MAX_DEGREES:
+            abort(400)
+
+        actors = Actor.short_info_by_id({actor_id, other_actor_id})
+        if len(actors) != len({actor_id, other_actor_id}):
+            abort(404)
+
+        cast_graph.refresh()
+        chain = cast_graph.separation(actor_id, other_actor_id, max_degrees)
+        if chain is None:
+            return jsonify({
+                "success": True,
+                "degrees": None,
+                "path": []
+            }), 200
+
+        actors.update(Actor.short_info_by_id(chain[2:-2:2]))
+        movies = Movie.short_info_by_id(chain[1::2])
+        return jsonify({
+            "success": True,
+            "degrees": len(chain) // 2,
+            "path": [{"actor": actors[node_id]} if index % 2 == 0
+                     else {"movie": movies[node_id]}
+                     for index, node_id in enumerate(chain)]
+        }), 200
+
+    @app.route('/movies/<int:movie_id>/shared-actors/<int:other_movie_id>')
+    @requires_auth("get:movie-by-id")
+    def get_shared_actors(payload, movie_id, other_movie_id):
+        """Actors cast in both movies"""
+        movie_ids = {movie_id, other_movie_id}
+        if db.session.query(Movie.id).filter(
+                Movie.id.in_(movie_ids)).count() != len(movie_ids):
+            abort(404)
+
+        cast_graph.refresh()
+        shared = Actor.short_info_by_id(
+            cast_graph.shared_actors(movie_id, other_movie_id))
+
+        return jsonify({
+            "success": True,
+            "actors": [shared[actor_id] for actor_id in sorted(shared)]
+        }), 200
+
+    @app.route('/stats')
+    @requires_auth(any_of=("get:actors", "get:movies"))
+    def get_stats(payload):
+        """Catalogue totals, read from the summary tables"""
+        movies, total_duration, rating_sum = db.session.query(
+            func.coalesce(func.sum(ReleaseYearStats.movie_count), 0),
+            func.coalesce(func.sum(ReleaseYearStats.total_duration), 0),
+            func.sum(ReleaseYearStats.rating_sum)).one()
+
+        return jsonify({
+            "success": True,
+            "stats": {
+                "actors": db.session.query(func.count(Actor.id)).scalar(),
+                "cast_actors": db.session.query(
+                    func.count(ActorStats.actor_id)).scalar(),
+                "movies": movies,
+                "total_duration": total_duration,
+                "average_imdb_rating":
+                    rating_sum / movies if movies else None
+            }
+        }), 200
+
+    @app.route('/stats/release-years')
+    @requires_auth("get:movies")
+    def get_release_year_stats(payload):
+        """Movie count, average rating and total duration per year"""
+        years = db.session.query(ReleaseYearStats).order_by(
+            ReleaseYearStats.release_year)
+
+        return jsonify({
+            "success": True,
+            "release_years": [{
+                "release_year": year.release_year,
+                "movie_count": year.movie_count,
+                "total_duration": year.total_duration,
+                "average_imdb_rating": year.rating_sum / year.movie_count
+            } for year in years]
+        }), 200
+
+    @app.route('/stats/actors')
+    @requires_auth("get:actors")
+    def get_actor_stats(payload):
+        """
+        Movie count, total screen duration and average rating of the
+        actors cast in at least one movie, the busiest first by default
+        """
+        sort_keys = {
+            "id": ActorStats.actor_id,
+            "movie_count": ActorStats.movie_count,
+            "total_duration": ActorStats.total_duration,
+        }
+        args = request.args.to_dict()
+        args.setdefault("sort", "-movie_count")
+
+        try:
+            limit, cursor = parse_page_args(args)
+            key_columns, descending = parse_sort(
+                args, sort_keys, ActorStats.actor_id)
+            if cursor is not None:
+                cursor = cursor_values(cursor, key_columns)
+        except ValueError:
+            abort(400)
+
+        stats_query = db.session.query(
+            ActorStats.actor_id.label("id"), Actor.name,
+            ActorStats.movie_count, ActorStats.total_duration,
+            (ActorStats.rating_sum / ActorStats.movie_count).label(
+                "average_imdb_rating")
+        ).join(Actor, Actor.id == ActorStats.actor_id)
+
+        actors, next_cursor = paginate(
+            stats_query, key_columns, limit, cursor, descending)
+
+        return jsonify({
+            "success": True,
+            "actors": actors,
+            "next_cursor": next_cursor
+        }), 200
+
+    @app.route('/search')
+    @requires_auth(any_of=("get:actors", "get:movies"))
+    def search_catalogue(payload):
+        """
+        Ranked search of actors by name or full name and of movies by
+        title, each word of q matching the start of a word
+        Only the kinds the caller may list are searched
+        """
+        terms = search_terms(request.args.get('q'))
+        try:
+            limit = int(request.args.get('limit', SEARCH_DEFAULT_LIMIT))
+        except ValueError:
+            abort(400)
+
+        if not terms or limit <= 0:
+            abort(400)
+        limit = min(limit, SEARCH_MAX_LIMIT)
+
+        permissions = get_permission_set(payload)
+        results = {"success": True, "query": request.args['q']}
+        if "get:actors" in permissions:
+            results["actors"] = search("actors", terms, limit)
+        if "get:movies" in permissions:
+            results["movies"] = search("movies", terms, limit)
+
+        return jsonify(results), 200
+
+    @app.route('/export/actors')
+    @requires_auth("get:actors")
+    def export_actors(payload):
+        return export_response("actors")
+
+    @app.route('/export/movies')
+    @requires_auth("get:movies")
+    def export_movies(payload):
+        return export_response("movies")
+
+    @app.route('/export/casting')
+    @requires_auth("get:movies")
+    def export_casting(payload):
+        return export_response("casting")
+
+    @app.route('/internal/pool')
+    @requires_auth("read:metrics")
+    def get_pool_stats(payload):
+        return jsonify({
+            "success": True,
+            "pool": pool_stats(db.engine)
+        }), 200
+
+    @app.route('/metrics')
+    @requires_auth("read:metrics")
+    def get_metrics(payload):
+        """Request latency histograms in the Prometheus text format"""
+        return Response(request_metrics.prometheus(),
+                        mimetype="text/plain; version=0.0.4")
+
+    @app.route('/internal/queries')
+    @requires_auth("read:metrics")
+    def get_query_stats(payload):
+        """The costliest SQL statement fingerprints, by default on total time"""
+        try:
+            limit = int(request.args.get("limit", SQL_TOP_LIMIT))
+            sort = request.args.get("sort", "total_ms")
+            if limit < 1 or sort not in SQL_TOP_SORT_KEYS:
+                raise ValueError(sort)
+        except ValueError:
+            abort(400)
+
+        return jsonify({
+            "success": True,
+            "profiler": sql_profiler.stats,
+            "queries": sql_profiler.top(limit, sort)
+        }), 200
+
+    @app.route('/internal/cache')
+    @requires_auth("read:metrics")
+    def get_cache_stats(payload):
+        return jsonify({
+            "success": True,
+            "cache": response_cache.stats
+        }), 200
+
     @app.errorhandler(AuthError)
     def handle_auth_error(ex):
         """
@@ -349,6 +1160,16 @@ def create_app(test_config=None):
             'message': 'Method not allowed'
         }), 405
 
+    @app.errorhandler(412)
+    def precondition_failed_error_handler(error):
+        '''
+        Error handler for status code 412.
+        '''
+        return jsonify({
+            'success': False,
+            'message': 'Precondition failed'
+        }), 412
+
     @app.errorhandler(500)
     def internal_server_error_handler(error):
         '''
@@ -358,6 +1179,16 @@ def create_app(test_config=None):
             'success': False,
             'message': 'Internal server error'
         }), 500
+
+    @app.errorhandler(503)
+    def service_unavailable_error_handler(error):
+        '''
+        Error handler for status code 503.
+        '''
+        return jsonify({
+            'success': False,
+            'message': 'Service unavailable'
+        }), 503
     
     return app
 
@@ -0,0 +1,346 @@
+"""
+Async entry point, served by an ASGI server:
+
+    hypercorn async_app:app
+
+The read endpoints below run on the event loop with an asyncio database
+engine, so a worker holds thousands of in-flight requests waiting on the
+database or on a key fetch. Every other request is handed to the Flask
+app of create_app in a worker thread: both serve the same routes with
+the same error contract, and share one response cache.
+"""
+import os
+
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from quart import Quart, abort, jsonify, make_response, request
+from sqlalchemy import select
+from werkzeug.exceptions import HTTPException
+
+from app import create_app, list_etag, row_etag
+from auth.async_auth import requires_auth_async
+from auth.auth import AuthError
+from cache.response_cache import ACTOR, MOVIE
+from database.aio import async_session_factory, create_async_db_engine
+from database.filters import (
+    ACTOR_FILTERS, ACTOR_SORT_KEYS, MOVIE_FILTERS, MOVIE_SORT_KEYS,
+    parse_filters, parse_sort)
+from database.models import Actor, Movie, TableVersion, replica_database_path
+from database.pagination import (
+    cursor_values, keyset_query, page_of, parse_page_args)
+from database.profiler import (
+    SQL_PROFILER, finish_request_profile, start_request_profile)
+from database.routing import READ_METHODS, READ_PRIMARY_COOKIE
+from metrics.request_metrics import (
+    REQUEST_METRICS, SERVER_TIMING, clear_request_timer, finish_request_timer,
+    start_request_timer, timed_json_response)
+from serialization.json_provider import init_json_provider
+
+# Largest request body handed to the Flask app, e.g. by the bulk endpoints
+ASYNC_WSGI_MAX_BODY_SIZE = int(
+    os.environ.get('ASYNC_WSGI_MAX_BODY_SIZE', 64 * 1024 * 1024))
+
+# Methods served by the async views, the rest always goes to Flask
+ASYNC_METHODS = ("GET", "HEAD")
+
+
+class AsyncDispatcher:
+    """
+    ASGI application routing GET and HEAD requests matching a route of the
+    Quart app to it and every other request to the Flask app
+    """
+
+    def __init__(self, async_app, sync_app,
+                 max_body_size=ASYNC_WSGI_MAX_BODY_SIZE):
+        self.async_app = async_app
+        self.sync_app = sync_app
+        self.wsgi = AsyncioWSGIMiddleware(sync_app, max_body_size)
+        self.routes = async_app.url_map.bind("localhost")
+
+    def handles(self, method, path):
+        """Whether the request runs on the event loop"""
+        if method not in ASYNC_METHODS:
+            return False
+
+        try:
+            self.routes.match(path, method)
+        except HTTPException:
+            return False
+        return True
+
+    async def __call__(self, scope, receive, send):
+        # Lifespan events start and stop the async app's engines
+        if scope["type"] != "http" \
+                or self.handles(scope["method"], scope["path"]):
+            return await self.async_app(scope, receive, send)
+        return await self.wsgi(scope, receive, send)
+
+    def __repr__(self):
+        return "<AsyncDispatcher(async_routes={})>".format(
+            len(list(self.async_app.url_map.iter_rules())))
+
+
+async def not_modified(etag):
+    """A 304 response if the client already holds this version, else None"""
+    if request.if_none_match.contains(etag):
+        response = await make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+    return None
+
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    return response
+
+
+def create_async_app(test_config=None, sync_app=None):
+    """
+    Builds the ASGI application, on top of sync_app or of a new
+    create_app(test_config)
+    """
+    if sync_app is None:
+        sync_app = create_app(test_config)
+
+    app = Quart(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    init_json_provider(app)
+
+    # Writes go through sync_app, which invalidates this same cache
+    response_cache = sync_app.extensions['response_cache']
+
+    config = sync_app.config
+    if config.get("REQUEST_METRICS", REQUEST_METRICS):
+        # Recorded next to the Flask routes, served by its /metrics
+        request_metrics = sync_app.extensions['request_metrics']
+        server_timing = config.get("SERVER_TIMING", SERVER_TIMING)
+        timed_json_response(app.json)
+
+        @app.before_request
+        async def start_timer():
+            start_request_timer()
+
+        @app.after_request
+        async def record_request(response):
+            return finish_request_timer(request_metrics, request, response,
+                                        server_timing)
+
+        @app.teardown_request
+        async def clear_timer(exc):
+            clear_request_timer()
+
+    engine = create_async_db_engine(
+        config, config["SQLALCHEMY_DATABASE_URI"])
+    sessions = async_session_factory(engine)
+    engines = [engine]
+
+    replica_path = config.get("DATABASE_REPLICA_URL", replica_database_path)
+    replica_sessions = None
+    if replica_path:
+        replica_engine = create_async_db_engine(config, replica_path)
+        replica_sessions = async_session_factory(replica_engine)
+        engines.append(replica_engine)
+
+    app.extensions['async_engines'] = engines
+
+    if config.get("SQL_PROFILER", SQL_PROFILER):
+        # Same fingerprints and budget as the Flask routes
+        sql_profiler = sync_app.extensions['sql_profiler']
+        for async_engine in engines:
+            sql_profiler.attach(async_engine.sync_engine)
+
+        @app.before_request
+        async def start_profile():
+            start_request_profile(sql_profiler)
+
+        @app.teardown_request
+        async def finish_profile(exc):
+            finish_request_profile(sql_profiler, request)
+
+    def read_session():
+        """
+        A session on the replica unless the client just wrote, the same
+        rule as database.routing
+        """
+        if replica_sessions is not None \
+                and request.method in READ_METHODS \
+                and READ_PRIMARY_COOKIE not in request.cookies:
+            return replica_sessions()
+        return sessions()
+
+    @app.after_serving
+    async def dispose_engines():
+        for async_engine in engines:
+            await async_engine.dispose()
+
+    @app.after_request
+    async def after_request(response):
+        # Same headers as flask-cors and the Flask app's after_request
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers.add('Access-Control-Allow-Headers',
+                             'Content-Type, Authorization')
+        response.headers.add('Access-Control-Allow-Methods',
+                             'GET, POST, PATCH, DELETE, OPTIONS')
+        return response
+
+    async def short_info_page(table_name, model, filters, sort_keys):
+        """GET /actors and GET /movies, see the Flask views"""
+        try:
+            limit, cursor = parse_page_args(request.args)
+            predicates = parse_filters(request.args, filters)
+            key_columns, descending = parse_sort(
+                request.args, sort_keys, model.id)
+            if cursor is not None:
+                cursor = cursor_values(cursor, key_columns)
+        except ValueError:
+            abort(400)
+
+        async with read_session() as session:
+            etag = list_etag(
+                table_name,
+                await TableVersion.current_async(session, table_name),
+                request.query_string)
+            response = await not_modified(etag)
+            if response is not None:
+                return response
+
+            query, fields = keyset_query(
+                model.short_info_select().filter(*predicates),
+                key_columns, cursor, descending)
+            rows = (await session.execute(query.limit(limit + 1))).all()
+
+        page, next_cursor = page_of(rows, fields, limit)
+
+        return with_etag(jsonify({
+            "success": True,
+            table_name: page,
+            "next_cursor": next_cursor
+        }), etag), 200
+
+    async def full_info(kind, model, loader, row_id, key):
+        """GET /actors/<id> and GET /movies/<id>, see the Flask views"""
+        # Same cache rules as the Flask views: a client that just wrote
+        # skips it, misses are read from the primary and fill it
+        just_wrote = READ_PRIMARY_COOKIE in request.cookies
+        cached = None if just_wrote else response_cache.get(kind, row_id)
+
+        if cached is None:
+            if request.if_none_match:
+                async with read_session() as session:
+                    # Revalidation reads the version, not the related rows
+                    version = await session.scalar(
+                        select(model.version).filter_by(id=row_id))
+                if version is None:
+                    abort(404)
+
+                response = await not_modified(row_etag(kind, row_id, version))
+                if response is not None:
+                    return response
+
+            async with sessions() as session:
+                row = (await session.execute(
+                    select(model).options(loader()).filter_by(id=row_id)
+                )).scalars().first()
+
+                if row is None:
+                    abort(404)
+                cached = {"version": row.version, "info": row.full_info}
+
+                # Skipped when a write committed since the row was read
+                if await session.scalar(
+                        select(model.version).filter_by(id=row_id)) \
+                        == cached["version"]:
+                    response_cache.set(kind, row_id, cached)
+
+        etag = row_etag(kind, row_id, cached["version"])
+        response = await not_modified(etag)
+        if response is not None:
+            return response
+
+        return with_etag(jsonify({
+            "success": True,
+            key: cached["info"]
+        }), etag), 200
+
+    @app.route('/')
+    async def index():
+        return "Welcome!!", 200
+
+    @app.route('/actors')
+    @requires_auth_async("get:actors")
+    async def get_actors(payload):
+        return await short_info_page(
+            "actors", Actor, ACTOR_FILTERS, ACTOR_SORT_KEYS)
+
+    @app.route('/actors/<int:actor_id>')
+    @requires_auth_async("get:actor-by-id")
+    async def get_actor_by_id(payload, actor_id):
+        return await full_info(
+            ACTOR, Actor, Actor.with_movies, actor_id, "actor")
+
+    @app.route('/movies')
+    @requires_auth_async("get:movies")
+    async def get_movies(payload):
+        return await short_info_page(
+            "movies", Movie, MOVIE_FILTERS, MOVIE_SORT_KEYS)
+
+    @app.route('/movies/<int:movie_id>')
+    @requires_auth_async("get:movie-by-id")
+    async def get_movie_by_id(payload, movie_id):
+        return await full_info(
+            MOVIE, Movie, Movie.with_cast, movie_id, "movie")
+
+    @app.errorhandler(AuthError)
+    async def handle_auth_error(ex):
+        response = jsonify(ex.error)
+        response.status_code = ex.status_code
+        return response
+
+    @app.errorhandler(400)
+    async def error_handler(error):
+        return jsonify({
+            'success': False,
+            'error': error.code,
+            'message': error.description
+        }), error.code
+
+    @app.errorhandler(401)
+    async def auth_error_handler(error):
+        return jsonify({
+            'success': False,
+            'message': 'Auth error'
+        }), 401
+
+    @app.errorhandler(403)
+    async def forbidden_error_handler(error):
+        return jsonify({
+            'success': False,
+            'message': 'Forbidden'
+        }), 403
+
+    @app.errorhandler(404)
+    async def resource_not_found_error_handler(error):
+        return jsonify({
+            'success': False,
+            'message': 'resource not found'
+        }), 404
+
+    @app.errorhandler(500)
+    async def internal_server_error_handler(error):
+        return jsonify({
+            'success': False,
+            'message': 'Internal server error'
+        }), 500
+
+    @app.errorhandler(503)
+    async def service_unavailable_error_handler(error):
+        return jsonify({
+            'success': False,
+            'message': 'Service unavailable'
+        }), 503
+
+    return AsyncDispatcher(app, sync_app)
+
+
+app = create_async_app()
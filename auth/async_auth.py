@@ -0,0 +1,39 @@
+from functools import wraps
+
+from quart import abort, request
+
+from metrics.request_metrics import record_phase
+
+from . import auth
+from .auth import (
+    AuthError, check_permissions, compile_permissions, parse_auth_header)
+
+
+def requires_auth_async(permission='', any_of=None):
+    """
+    requires_auth for the Quart views of async_app, same permissions and
+    same error contract; a key fetch never blocks the event loop
+    """
+    required = compile_permissions(permission)
+    required_any = compile_permissions(any_of) if any_of else None
+
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            try:
+                with record_phase("auth"):
+                    token = parse_auth_header(
+                        request.headers.get("Authorization", None))
+                    payload = auth.token_cache.get(token)
+                    if payload is None:
+                        payload = await auth.verify_decode_jwt_async(token)
+                        auth.token_cache.put(token, payload)
+                    check_permissions(required, payload, required_any)
+            except AuthError as authError:
+                abort(authError.status_code, authError.error["description"])
+
+            return await f(payload, *args, **kwargs)
+
+        return wrapper
+
+    return requires_auth_decorator
@@ -1,12 +1,13 @@
 import datetime
-import json
 import os
 from dotenv import load_dotenv
 from flask import request, abort
 from functools import wraps
 
 from jose import jwt
-from urllib.request import urlopen
+from .jwks import FileKeySource, JWKSKeyStore, UrlKeySource
+from .token_cache import TokenCache
+from metrics.request_metrics import record_phase
 basedir = os.path.abspath(os.path.dirname(__file__))
 load_dotenv(os.path.join(basedir, '.env'))
 SECRET_KEY = os.environ.get('SECRET_KEY')
@@ -15,6 +16,18 @@ AUTH0_DOMAIN = 'dev-vdwkjasj8ru8qxuz.us.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'agency'
 
+# Where the signing keys come from, JWKS_FILE takes precedence over JWKS_URL
+JWKS_URL = os.environ.get(
+    'JWKS_URL', "https://{}/.well-known/jwks.json".format(AUTH0_DOMAIN))
+JWKS_FILE = os.environ.get('JWKS_FILE')
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+
+# Verified-token cache, TOKEN_CACHE_SIZE=0 disables it
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_MAX_TTL = int(os.environ.get('TOKEN_CACHE_MAX_TTL', 3600))
+
 # AuthError Exception
 
 
@@ -29,10 +42,67 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+class Payload(dict):
+    """
+    Decoded JWT claims
+    The permissions claim is turned into a frozenset once, so every later
+    check (including on cached tokens) is a set lookup
+    """
+    __slots__ = ('permission_set',)
+
+    def __init__(self, claims):
+        super().__init__(claims)
+        permissions = claims.get('permissions')
+        self.permission_set = None if permissions is None \
+            else frozenset(permissions)
+
+
+def compile_permissions(permissions):
+    """Turns a single permission or an iterable of them into a frozenset"""
+    if not permissions:
+        # requires_auth's default, only any_of is checked
+        return frozenset()
+    if isinstance(permissions, str):
+        return frozenset((permissions,))
+    return frozenset(permissions)
+
+
+# JWKS key store
+
+
+def default_key_source():
+    if JWKS_FILE:
+        return FileKeySource(JWKS_FILE)
+    return UrlKeySource(JWKS_URL)
+
+
+jwks_store = JWKSKeyStore(default_key_source(), ttl=JWKS_TTL,
+                          min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL)
+
+
+def set_key_source(source, **kwargs):
+    """
+    Replaces the key source used by verify_decode_jwt, e.g. with a local
+    file or a stub JWKS server in tests and benchmarks
+    """
+    global jwks_store
+    kwargs.setdefault('ttl', JWKS_TTL)
+    kwargs.setdefault('min_refresh_interval', JWKS_MIN_REFRESH_INTERVAL)
+    jwks_store = JWKSKeyStore(source, **kwargs)
+    return jwks_store
+
+
+token_cache = TokenCache(max_size=TOKEN_CACHE_SIZE,
+                         max_ttl=TOKEN_CACHE_MAX_TTL)
+
+
 # Auth Header
 def get_token_auth_header():
-    auth_header = request.headers.get("Authorization", None)
+    return parse_auth_header(request.headers.get("Authorization", None))
 
+
+def parse_auth_header(auth_header):
+    """Returns the bearer token of an Authorization header value"""
     if auth_header is None:
         raise AuthError({
             "code": "authorization_header_missing",
@@ -54,14 +124,34 @@ def get_token_auth_header():
     return auth_header_values[1]
 
 
-def check_permissions(permission, payload):
+def get_permission_set(payload):
+    permissions = getattr(payload, 'permission_set', None)
+    if permissions is not None:
+        return permissions
+
     if 'permissions' not in payload:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    return frozenset(payload['permissions'])
+
+
+def check_permissions(permission, payload, any_of=None):
+    """
+    Checks that the payload grants every permission in permission (a single
+    permission or an iterable of them) and at least one of any_of, if given
+    """
+    permissions = get_permission_set(payload)
+
+    if not isinstance(permission, frozenset):
+        permission = compile_permissions(permission)
+    if any_of is not None and not isinstance(any_of, frozenset):
+        any_of = compile_permissions(any_of)
+
+    if not permission <= permissions \
+            or (any_of and permissions.isdisjoint(any_of)):
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Requested Permission not found.'
@@ -70,12 +160,14 @@ def check_permissions(permission, payload):
     return True
 
 
-def verify_decode_jwt(token):
-    url_string = "https://{}/.well-known/jwks.json".format(AUTH0_DOMAIN)
-    json_url = urlopen(url_string)
-    jwks = json.loads(json_url.read())
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
+def get_token_kid(token):
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except jwt.JWTError:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 401)
 
     if 'kid' not in unverified_header:
         raise AuthError({
@@ -83,16 +175,41 @@ def verify_decode_jwt(token):
             'description': 'Authorization Header is malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    return unverified_header['kid']
+
+
+def key_set_unavailable():
+    """
+    The key set could not be fetched and none was cached yet: the token
+    may well be valid, the service is what is failing
+    """
+    return AuthError({
+        'code': 'jwks_unavailable',
+        'description': 'Unable to fetch the signing keys.'
+    }, 503)
+
+
+def verify_decode_jwt(token):
+    kid = get_token_kid(token)
+    try:
+        rsa_key = jwks_store.get_key(kid)
+    except Exception:
+        raise key_set_unavailable()
+    return decode_jwt(token, rsa_key)
+
 
+async def verify_decode_jwt_async(token):
+    """verify_decode_jwt without blocking the event loop on a key fetch"""
+    kid = get_token_kid(token)
+    try:
+        rsa_key = await jwks_store.get_key_async(kid)
+    except Exception:
+        raise key_set_unavailable()
+    return decode_jwt(token, rsa_key)
+
+
+def decode_jwt(token, rsa_key):
+    """Verifies the token signature and claims against rsa_key"""
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -103,7 +220,7 @@ def verify_decode_jwt(token):
                 issuer='https://{}/'.format(AUTH0_DOMAIN)
             )
 
-            return payload
+            return Payload(payload)
 
         except jwt.ExpiredSignatureError:
             raise AuthError({
@@ -130,14 +247,25 @@ def verify_decode_jwt(token):
     }, 401)
 
 
-def requires_auth(permission=''):
+def requires_auth(permission='', any_of=None):
+    """
+    permission is a single permission or an iterable of permissions that
+    are all required, any_of an iterable of which at least one is required
+    """
+    required = compile_permissions(permission)
+    required_any = compile_permissions(any_of) if any_of else None
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             try:
-                token = get_token_auth_header()
-                payload = verify_decode_jwt(token)
-                check_permissions(permission, payload)
+                with record_phase("auth"):
+                    token = get_token_auth_header()
+                    payload = token_cache.get(token)
+                    if payload is None:
+                        payload = verify_decode_jwt(token)
+                        token_cache.put(token, payload)
+                    check_permissions(required, payload, required_any)
             except AuthError as authError:
                 raise abort(authError.status_code,
                             authError.error["description"])
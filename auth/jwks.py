@@ -0,0 +1,212 @@
+import asyncio
+import json
+import threading
+import time
+from urllib.request import urlopen
+
+from jose import jwk
+
+# Seconds the key set is trusted when the source sends no Cache-Control
+DEFAULT_TTL = 600
+# Minimum seconds between two fetches, whatever triggered them
+MIN_REFRESH_INTERVAL = 30
+
+
+def parse_max_age(cache_control):
+    """
+    Returns the max-age of a Cache-Control header value in seconds,
+    0 when caching is forbidden and None when nothing usable is present
+    """
+    if not cache_control:
+        return None
+
+    for directive in cache_control.split(","):
+        name, _, value = directive.strip().partition("=")
+        name = name.lower()
+
+        if name in ("no-cache", "no-store"):
+            return 0
+
+        if name == "max-age":
+            try:
+                return max(int(value.strip('"')), 0)
+            except ValueError:
+                return None
+
+    return None
+
+
+class KeySetUnavailable(Exception):
+    """No key set was ever fetched and the last attempt is too recent to retry"""
+
+
+# Key sources
+# A key source only has to provide fetch() -> (jwks, max_age or None)
+
+
+class UrlKeySource:
+    """Fetches the key set over HTTP(S), e.g. from Auth0"""
+
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+            max_age = parse_max_age(response.headers.get("Cache-Control"))
+
+        return jwks, max_age
+
+    def __repr__(self):
+        return "<UrlKeySource(url='{}')>".format(self.url)
+
+
+class FileKeySource:
+    """Reads the key set from a local JSON file"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self):
+        with open(self.path) as jwks_file:
+            return json.load(jwks_file), None
+
+    def __repr__(self):
+        return "<FileKeySource(path='{}')>".format(self.path)
+
+
+class StaticKeySource:
+    """Serves an in-memory key set, mostly useful in tests and benchmarks"""
+
+    def __init__(self, jwks):
+        self.jwks = jwks
+        self.fetch_count = 0
+
+    def fetch(self):
+        self.fetch_count += 1
+        return self.jwks, None
+
+    def __repr__(self):
+        return "<StaticKeySource(keys={})>".format(
+            len(self.jwks.get("keys", [])))
+
+
+class JWKSKeyStore:
+    """
+    In-process cache of the signing keys, indexed by kid
+
+    The key set is fetched on first use and then refreshed once its TTL
+    (taken from Cache-Control when the source provides one) has passed.
+    An unknown kid triggers an early refetch, which together with the TTL
+    refresh is rate limited by min_refresh_interval.
+    If a refresh fails the previously fetched keys keep being served; while
+    none was ever fetched, lookups within min_refresh_interval of a failed
+    fetch raise KeySetUnavailable instead of fetching again.
+    """
+
+    def __init__(self, source, ttl=DEFAULT_TTL,
+                 min_refresh_interval=MIN_REFRESH_INTERVAL,
+                 algorithm="RS256", clock=time.monotonic):
+        self.source = source
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.algorithm = algorithm
+        self.clock = clock
+
+        self._keys = {}
+        self._expires_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+
+    def get_key(self, kid):
+        """Returns the parsed key for kid or None if the key set lacks it"""
+        now = self.clock()
+
+        if self._expires_at is None or now >= self._expires_at:
+            self._refresh(now)
+
+        key = self._keys.get(kid)
+        if key is None:
+            self._refresh(now)
+            key = self._keys.get(kid)
+
+        return key
+
+    async def get_key_async(self, kid):
+        """
+        get_key for asyncio servers: a fresh cached key is returned right
+        away, a fetch (or the wait for another one) runs in a worker thread
+        so the event loop keeps serving other requests meanwhile
+        """
+        expires_at = self._expires_at
+        if expires_at is not None and self.clock() < expires_at:
+            key = self._keys.get(kid)
+            if key is not None:
+                return key
+
+        return await asyncio.to_thread(self.get_key, kid)
+
+    def clear(self):
+        """Drops every cached key, the next lookup fetches again"""
+        with self._lock:
+            self._keys = {}
+            self._expires_at = None
+            self._last_attempt = None
+
+    @property
+    def kids(self):
+        return list(self._keys)
+
+    def _refresh(self, now):
+        with self._lock:
+            # Covers both the rate limit and another thread having
+            # refreshed while we were waiting for the lock
+            if self._last_attempt is not None \
+                    and now - self._last_attempt < self.min_refresh_interval:
+                if self._expires_at is None:
+                    # The first fetch failed: fail fast rather than pile
+                    # every request up on the outage
+                    raise KeySetUnavailable(
+                        "no key set fetched from {!r}".format(self.source))
+                return
+
+            self._last_attempt = now
+
+            try:
+                jwks, max_age = self.source.fetch()
+                keys = self._parse_keys(jwks)
+            except Exception:
+                # Serve the stale keys rather than failing every request
+                if self._expires_at is None:
+                    raise
+                return
+
+            self._keys = keys
+            self._expires_at = now + (self.ttl if max_age is None else max_age)
+
+    def _parse_keys(self, jwks):
+        keys = {}
+
+        for key in jwks["keys"]:
+            if key.get("kty") != "RSA" or "kid" not in key:
+                continue
+            if key.get("use", "sig") != "sig":
+                continue
+
+            try:
+                keys[key["kid"]] = jwk.construct({
+                    "kty": key["kty"],
+                    "kid": key["kid"],
+                    "use": key.get("use", "sig"),
+                    "n": key["n"],
+                    "e": key["e"]
+                }, key.get("alg", self.algorithm))
+            except Exception:
+                continue
+
+        return keys
+
+    def __repr__(self):
+        return "<JWKSKeyStore(source={}, keys={})>".format(
+            self.source, len(self._keys))
@@ -0,0 +1,109 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# Number of decoded payloads kept in memory
+DEFAULT_MAX_SIZE = 1024
+# Upper bound on how long a payload is trusted, whatever its exp says
+DEFAULT_MAX_TTL = 3600
+
+
+def token_digest(token):
+    """Hash of the raw token, so the cache never holds bearer tokens"""
+    if isinstance(token, str):
+        token = token.encode()
+    return hashlib.sha256(token).digest()
+
+
+class TokenCache:
+    """
+    Bounded LRU cache of verified JWT payloads keyed by token hash
+
+    Every entry expires at the token's own exp claim (capped by max_ttl),
+    so a cached token is never accepted after it would have been rejected
+    by verify_decode_jwt.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, max_ttl=DEFAULT_MAX_TTL,
+                 clock=time.time):
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Returns the cached payload for token or None"""
+        if self.max_size <= 0:
+            return None
+
+        digest = token_digest(token)
+
+        with self._lock:
+            entry = self._entries.get(digest)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            payload, expires_at = entry
+            if self.clock() >= expires_at:
+                del self._entries[digest]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return payload
+
+    def put(self, token, payload):
+        if self.max_size <= 0:
+            return
+
+        now = self.clock()
+        expires_at = now + self.max_ttl
+        if 'exp' in payload:
+            expires_at = min(expires_at, payload['exp'])
+
+        if expires_at <= now:
+            return
+
+        digest = token_digest(token)
+
+        with self._lock:
+            self._entries[digest] = (payload, expires_at)
+            self._entries.move_to_end(digest)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    @property
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "<TokenCache(size={}, hits={}, misses={})>".format(
+            len(self._entries), self.hits, self.misses)
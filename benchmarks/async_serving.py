@@ -0,0 +1,265 @@
+"""
+Serves the same seeded database with the Flask app (a pool of worker
+threads, like gunicorn's gthread workers) and with async_app (hypercorn),
+then drives both with the same number of concurrent read requests.
+
+    python benchmarks/async_serving.py --rows 10000 --concurrency 1 50 500
+
+--db-latency-ms adds a delay to every SQL statement, inside the database
+driver, to stand in for the round trip to a database server.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rsa  # noqa: E402
+from flask import Flask  # noqa: E402
+from jose import jwk, jwt  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.util import await_only  # noqa: E402
+from werkzeug.serving import (  # noqa: E402
+    BaseWSGIServer, WSGIRequestHandler)
+
+from auth import auth  # noqa: E402
+from auth.jwks import StaticKeySource  # noqa: E402
+from database.models import db, setup_db  # noqa: E402
+from list_queries import seed  # noqa: E402
+
+KID = "benchmark-key"
+PERMISSIONS = ["get:movies", "get:movie-by-id"]
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """WSGI server handling at most `threads` requests at once"""
+
+    request_queue_size = 2048
+
+    def __init__(self, host, port, app, threads):
+        super().__init__(host, port, app, handler=QuietRequestHandler)
+        self.executor = ThreadPoolExecutor(threads)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread,
+                             request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def signing_keys(permissions=PERMISSIONS):
+    public_key, private_key = rsa.newkeys(1024)
+    jwks = {"keys": [dict(
+        jwk.construct(public_key.save_pkcs1().decode(), "RS256").to_dict(),
+        kid=KID, use="sig")]}
+    now = int(time.time())
+    token = jwt.encode({
+        "iss": "https://{}/".format(auth.AUTH0_DOMAIN),
+        "aud": auth.API_AUDIENCE,
+        "sub": "benchmark|user",
+        "iat": now,
+        "exp": now + 3600,
+        "permissions": permissions
+    }, private_key.save_pkcs1().decode(), algorithm="RS256",
+        headers={"kid": KID})
+    return jwks, token
+
+
+def add_statement_latency(engine, seconds, is_async):
+    """Sleeps in the driver's thread before each statement"""
+    if not seconds:
+        return
+
+    def delay(statement):
+        time.sleep(seconds)
+
+    @event.listens_for(engine, "connect")
+    def set_delay(dbapi_connection, connection_record):
+        if is_async:
+            await_only(dbapi_connection.driver_connection
+                       .set_trace_callback(delay))
+        else:
+            dbapi_connection.set_trace_callback(delay)
+
+
+def serve(kind, database_uri, jwks, port, args):
+    """Runs in its own process until terminated"""
+    auth.set_key_source(StaticKeySource(jwks))
+    config = {
+        "SQLALCHEMY_DATABASE_URI": database_uri,
+        # Every read goes to the database
+        "RESPONSE_CACHE_SIZE": 0,
+        "DB_POOL_SIZE": args.pool_size,
+        "DB_MAX_OVERFLOW": 0,
+        "DB_POOL_TIMEOUT": 60,
+    }
+    latency = args.db_latency_ms / 1000
+
+    if kind == "sync":
+        from app import create_app
+        app = create_app(config)
+        with app.app_context():
+            add_statement_latency(db.engine, latency, False)
+        PooledWSGIServer("127.0.0.1", port, app, args.threads) \
+            .serve_forever()
+        return
+
+    from hypercorn.asyncio import serve as hypercorn_serve
+    from hypercorn.config import Config
+
+    from async_app import create_async_app
+    app = create_async_app(config)
+    for engine in app.async_app.extensions["async_engines"]:
+        add_statement_latency(engine.sync_engine, latency, True)
+
+    hypercorn_config = Config()
+    hypercorn_config.bind = ["127.0.0.1:{}".format(port)]
+    hypercorn_config.backlog = 2048
+    hypercorn_config.accesslog = None
+    asyncio.run(hypercorn_serve(app, hypercorn_config))
+
+
+async def get(port, path, token):
+    """One GET on a new connection, returns the status code"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write((
+        "GET {} HTTP/1.1\r\nHost: localhost\r\n"
+        "Authorization: Bearer {}\r\nConnection: close\r\n\r\n"
+    ).format(path, token).encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b" ", 2)[1])
+
+
+async def wait_until_ready(port, token):
+    for _ in range(200):
+        try:
+            if await get(port, "/", token) == 200:
+                return
+        except OSError:
+            pass
+        await asyncio.sleep(0.05)
+    raise RuntimeError("server on port {} did not start".format(port))
+
+
+def percentile(samples, fraction):
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+async def load(port, token, paths, concurrency):
+    """Sends every path with at most `concurrency` requests in flight"""
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(path):
+        nonlocal errors
+        async with slots:
+            start = time.perf_counter()
+            try:
+                status = await get(port, path, token)
+            except OSError:
+                status = None
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(path) for path in paths])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(paths),
+        "errors": errors,
+        "requests_per_second": round(len(paths) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def run(kind, database_uri, jwks, token, port, args):
+    server = multiprocessing.Process(
+        target=serve, args=(kind, database_uri, jwks, port, args),
+        daemon=True)
+    server.start()
+
+    try:
+        asyncio.run(wait_until_ready(port, token))
+        results = {}
+        for concurrency in args.concurrency:
+            paths = [
+                "/movies/{}".format(random.randint(1, args.rows))
+                if index % 2 else "/movies?limit=20&release_year_min={}"
+                .format(1950 + index % 75)
+                for index in range(args.requests)
+            ]
+            results[concurrency] = asyncio.run(
+                load(port, token, paths, concurrency))
+        return results
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--cast-size", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=2000,
+                        help="requests sent per concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+",
+                        default=[1, 50, 500])
+    parser.add_argument("--threads", type=int, default=8,
+                        help="worker threads of the Flask server")
+    parser.add_argument("--pool-size", type=int, default=20,
+                        help="database connections of each app")
+    parser.add_argument("--db-latency-ms", type=float, default=0)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    jwks, token = signing_keys()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_uri = "sqlite:///{}".format(os.path.join(tmp, "bench.db"))
+        app = Flask(__name__)
+        setup_db(app, database_uri)
+        with app.app_context():
+            seed(args.rows, args.cast_size)
+            db.session.remove()
+            db.engine.dispose()
+
+        results = {
+            kind: run(kind, database_uri, jwks, token, args.port + offset,
+                      args)
+            for offset, kind in enumerate(("sync", "async"))
+        }
+
+    print(json.dumps({"rows": args.rows, "threads": args.threads,
+                      "pool_size": args.pool_size,
+                      "db_latency_ms": args.db_latency_ms,
+                      "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
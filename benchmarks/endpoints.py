@@ -0,0 +1,383 @@
+"""
+Drives every route of app.py at a fixed concurrency against a database
+seeded at a given scale, and prints the throughput and latency
+percentiles of each route as JSON.
+
+    python benchmarks/endpoints.py --scale 100k --concurrency 16 > after.json
+    python benchmarks/endpoints.py --scale 100k --baseline before.json
+
+Seeded databases are kept in --cache-dir and copied before every run, so
+each run starts from the same rows. Tokens are signed with a local key
+served as the JWKS, no Auth0 tenant is needed. With --baseline, routes
+whose p95 latency or throughput got worse by more than --tolerance are
+listed under "regressions" and the exit status is 1.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# app.py builds a module-level app from DATABASE_URL when imported
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from flask import Flask  # noqa: E402
+
+from async_serving import (  # noqa: E402
+    percentile, serve, signing_keys, wait_until_ready)
+from database.models import db, setup_db  # noqa: E402
+from database.stats import refresh_all_stats  # noqa: E402
+from list_queries import seed  # noqa: E402
+
+# Actors and movies seeded, each
+SCALES = {"1k": 1000, "100k": 100000, "1m": 1000000}
+
+PERMISSIONS = [
+    "get:actors", "get:actor-by-id", "get:movies", "get:movie-by-id",
+    "post:actors", "patch:actors", "delete:actors",
+    "post:movies", "patch:movies", "delete:movies", "read:metrics"
+]
+
+# One benchmarked route: request(index, rng, rows) returns the path and
+# the JSON or NDJSON body of its index-th request, share scales the
+# number of requests sent
+Route = namedtuple("Route", "method rule request share")
+
+
+def path(template):
+    return lambda index, rng, rows: (template, None)
+
+
+def row_path(template):
+    """A random seeded row"""
+    return lambda index, rng, rows: (
+        template.format(rng.randint(1, rows)), None)
+
+
+def row_pair_path(template):
+    return lambda index, rng, rows: (
+        template.format(rng.randint(1, rows), rng.randint(1, rows)), None)
+
+
+def last_row_path(template):
+    """A distinct row per request, from the last one down"""
+    return lambda index, rng, rows: (template.format(rows - index), None)
+
+
+def new_actor(index, rng, rows):
+    return "/actors", {"name": "Bench Actor {}".format(index),
+                       "full_name": "Bench Full Name {}".format(index),
+                       "date_of_birth": "1990-01-01"}
+
+
+def new_actors(index, rng, rows):
+    return "/actors/bulk", "".join(
+        json.dumps({"name": "Bulk Actor {}-{}".format(index, line),
+                    "date_of_birth": "1990-01-01"}) + "\n"
+        for line in range(100))
+
+
+def movie_body(index, rng, rows):
+    return {"title": "Bench Movie {}".format(index),
+            "release_year": rng.randint(1950, 2024),
+            "duration": rng.randint(80, 180),
+            "imdb_rating": rng.randint(0, 100) / 10,
+            "cast": ["Actor {}".format(actor_id)
+                     for actor_id in rng.sample(range(1, rows + 1), 3)]}
+
+
+def new_movies(index, rng, rows):
+    return "/movies/bulk", {"movies": [
+        movie_body(index * 10 + line, rng, rows) for line in range(10)]}
+
+
+# Changes go to distinct rows, concurrent ones to the same row would
+# conflict on its version
+
+
+def actor_changes(index, rng, rows):
+    return "/actors/{}".format(index + 1), {
+        "full_name": "Renamed {}".format(index)}
+
+
+def movie_changes(index, rng, rows):
+    return "/movies/{}".format(index + 1), {
+        "imdb_rating": rng.randint(0, 100) / 10}
+
+
+def search_path(index, rng, rows):
+    return "/search?q=actor+{}".format(rng.randint(1, rows)), None
+
+
+# Reads first, then writes, deletes last so no read misses its row
+ROUTES = [
+    Route("GET", "/", path("/"), 1),
+    Route("GET", "/actors", lambda index, rng, rows: (
+        "/actors?limit=20&name_prefix=Actor+{}".format(rng.randint(1, 9)), None), 1),
+    Route("GET", "/actors/<int:actor_id>", row_path("/actors/{}"), 1),
+    Route("GET", "/movies", lambda index, rng, rows: (
+        "/movies?limit=20&release_year_min={}".format(
+            rng.randint(1950, 2024)), None), 1),
+    Route("GET", "/movies/<int:movie_id>", row_path("/movies/{}"), 1),
+    Route("GET", "/actors/<int:actor_id>/co-stars",
+          row_path("/actors/{}/co-stars"), 1),
+    Route("GET", "/actors/<int:actor_id>/separation/<int:other_actor_id>",
+          row_pair_path("/actors/{}/separation/{}"), 1),
+    Route("GET", "/movies/<int:movie_id>/shared-actors/<int:other_movie_id>",
+          row_pair_path("/movies/{}/shared-actors/{}"), 1),
+    Route("GET", "/search", search_path, 1),
+    Route("GET", "/stats", path("/stats"), 1),
+    Route("GET", "/stats/release-years", path("/stats/release-years"), 1),
+    Route("GET", "/stats/actors", path("/stats/actors?limit=20"), 1),
+    # Each export streams the whole table
+    Route("GET", "/export/actors", path("/export/actors"), 0.02),
+    Route("GET", "/export/movies", path("/export/movies"), 0.02),
+    Route("GET", "/export/casting", path("/export/casting"), 0.02),
+    Route("GET", "/internal/pool", path("/internal/pool"), 1),
+    Route("GET", "/internal/cache", path("/internal/cache"), 1),
+    Route("GET", "/internal/queries", path("/internal/queries"), 1),
+    Route("GET", "/metrics", path("/metrics"), 1),
+    Route("POST", "/actors", new_actor, 1),
+    Route("POST", "/actors/bulk", new_actors, 0.1),
+    Route("POST", "/movies", lambda index, rng, rows: (
+        "/movies", movie_body(index, rng, rows)), 1),
+    Route("POST", "/movies/bulk", new_movies, 0.1),
+    Route("PATCH", "/actors/<int:actor_id>", actor_changes, 1),
+    Route("PATCH", "/movies/<int:movie_id>", movie_changes, 1),
+    Route("DELETE", "/actors/<int:actor_id>", last_row_path("/actors/{}"), 1),
+    Route("DELETE", "/movies/<int:movie_id>", last_row_path("/movies/{}"), 1),
+]
+
+
+def missing_routes():
+    """Routes of app.py with no benchmark, e.g. one added since"""
+    from app import create_app
+
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    covered = {(route.method, route.rule) for route in ROUTES}
+    return sorted(
+        (method, rule.rule)
+        for rule in app.url_map.iter_rules() if rule.endpoint != "static"
+        for method in rule.methods - {"HEAD", "OPTIONS"}
+        if (method, rule.rule) not in covered)
+
+
+def seeded_database(rows, cast_size, cache_dir, reseed):
+    """Path of a database seeded with rows actors and movies, built once"""
+    os.makedirs(cache_dir, exist_ok=True)
+    database_file = os.path.join(
+        cache_dir, "seed-{}-{}.db".format(rows, cast_size))
+    if os.path.exists(database_file) and not reseed:
+        return database_file
+
+    building = database_file + ".building"
+    if os.path.exists(building):
+        os.remove(building)
+
+    app = Flask(__name__)
+    app.config["SQL_PROFILER"] = False
+    setup_db(app, "sqlite:///{}".format(building))
+    with app.app_context():
+        seed(rows, cast_size)
+        with db.engine.begin() as connection:
+            refresh_all_stats(connection)
+        db.session.remove()
+        db.engine.dispose()
+
+    os.replace(building, database_file)
+    return database_file
+
+
+async def send(port, token, method, path, body):
+    """One request on a new connection, returns the status code"""
+    if body is None:
+        payload = b""
+    elif isinstance(body, str):
+        payload = body.encode()
+    else:
+        payload = json.dumps(body).encode()
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write((
+        "{} {} HTTP/1.1\r\nHost: localhost\r\n"
+        "Authorization: Bearer {}\r\nContent-Type: application/json\r\n"
+        "Content-Length: {}\r\nConnection: close\r\n\r\n"
+    ).format(method, path, token, len(payload)).encode() + payload)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b" ", 2)[1])
+
+
+async def load(port, token, method, requests, concurrency):
+    """Sends every (path, body) with at most `concurrency` in flight"""
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(path, body):
+        nonlocal errors
+        async with slots:
+            start = time.perf_counter()
+            try:
+                status = await send(port, token, method, path, body)
+            except OSError:
+                status = None
+            latencies.append(time.perf_counter() - start)
+            if status is None or status >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(path, body) for path, body in requests])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(requests),
+        "errors": errors,
+        "requests_per_second": round(len(requests) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+async def run_routes(port, token, rows, args):
+    await wait_until_ready(port, token)
+    rng = random.Random(args.seed)
+    results = {}
+
+    for route in ROUTES:
+        count = max(int(args.requests * route.share), 1)
+        warmup = args.warmup if route.share == 1 else 0
+        requests = [route.request(index, rng, rows)
+                    for index in range(warmup + count)]
+
+        for path, body in requests[:warmup]:
+            await send(port, token, route.method, path, body)
+        results["{} {}".format(route.method, route.rule)] = await load(
+            port, token, route.method, requests[warmup:], args.concurrency)
+
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """Routes slower than in the baseline by more than tolerance"""
+    found = []
+    for name, before in baseline["results"].items():
+        after = results.get(name)
+        if after is None:
+            continue
+        if after["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            found.append({"route": name, "metric": "p95_ms",
+                          "baseline": before["p95_ms"],
+                          "current": after["p95_ms"]})
+        if after["requests_per_second"] \
+                < before["requests_per_second"] * (1 - tolerance):
+            found.append({"route": name, "metric": "requests_per_second",
+                          "baseline": before["requests_per_second"],
+                          "current": after["requests_per_second"]})
+    return found
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+            text=True, check=True, cwd=os.path.dirname(__file__)
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument("--rows", type=int, default=None,
+                        help="actors and movies seeded, overrides --scale")
+    parser.add_argument("--cast-size", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests sent per route")
+    parser.add_argument("--warmup", type=int, default=5,
+                        help="unmeasured requests sent first per route")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--server", choices=("sync", "async"),
+                        default="sync")
+    parser.add_argument("--threads", type=int, default=16,
+                        help="worker threads of the Flask server")
+    parser.add_argument("--pool-size", type=int, default=20,
+                        help="database connections of the app")
+    parser.add_argument("--db-latency-ms", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cache-dir", default=os.path.join(
+        tempfile.gettempdir(), "casting-benchmarks"))
+    parser.add_argument("--reseed", action="store_true",
+                        help="rebuild the cached seeded database")
+    parser.add_argument("--baseline", default=None,
+                        help="JSON output of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--port", type=int, default=8775)
+    args = parser.parse_args()
+
+    missing = missing_routes()
+    if missing:
+        parser.error("routes without a benchmark: {}".format(", ".join(
+            "{} {}".format(method, rule) for method, rule in missing)))
+
+    rows = args.rows or SCALES[args.scale]
+    # Every delete removes a distinct seeded row
+    if args.requests + args.warmup >= rows:
+        parser.error("--requests must stay below the seeded rows")
+
+    jwks, token = signing_keys(PERMISSIONS)
+    seeded = seeded_database(rows, args.cast_size, args.cache_dir,
+                             args.reseed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_file = os.path.join(tmp, "bench.db")
+        shutil.copyfile(seeded, database_file)
+
+        server = multiprocessing.Process(
+            target=serve, args=(args.server,
+                                "sqlite:///{}".format(database_file), jwks,
+                                args.port, args),
+            daemon=True)
+        server.start()
+        try:
+            results = asyncio.run(run_routes(args.port, token, rows, args))
+        finally:
+            server.terminate()
+            server.join()
+
+    output = {
+        "commit": current_commit(),
+        "server": args.server,
+        "rows": rows,
+        "cast_size": args.cast_size,
+        "concurrency": args.concurrency,
+        "seed": args.seed,
+        "results": results
+    }
+
+    found = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            found = regressions(results, json.load(baseline_file),
+                                args.tolerance)
+        output["regressions"] = found
+
+    print(json.dumps(output, indent=2))
+    if found:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Compares serialising a GET /movies page with Flask's stdlib provider, the
+orjson provider and their streamed variants, on the same seeded rows.
+
+    python benchmarks/json_serialisation.py --rows 50000 --repeat 5
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+
+from database.models import db, setup_db, Movie  # noqa: E402
+from list_queries import seed  # noqa: E402
+from serialization.json_provider import (  # noqa: E402
+    OrjsonProvider, encode, orjson, stream_json_object)
+
+
+def buffered(provider, rows):
+    """What jsonify does: the whole body in one string"""
+    return [len(encode(provider, {
+        "success": True, "movies": rows, "next_cursor": None}))]
+
+
+def streamed(provider, rows):
+    return [len(chunk) for chunk in stream_json_object(
+        provider, {"success": True}, "movies", iter(rows),
+        lambda: {"next_cursor": None})]
+
+
+def measure(fn, provider, rows, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sizes = fn(provider, rows)
+        samples.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn(provider, rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"bytes": sum(sizes), "largest_chunk": max(sizes),
+            "best_ms": round(min(samples) * 1000, 2),
+            "mean_ms": round(sum(samples) / len(samples) * 1000, 2),
+            "peak_kib": round(peak / 1024, 1)}
+
+
+def run(app, repeat):
+    rows = [movie._asdict() for movie in
+            Movie.short_info_query().order_by(Movie.id)]
+
+    providers = {"stdlib": DefaultJSONProvider(app)}
+    if orjson is not None:
+        providers["orjson"] = OrjsonProvider(app)
+
+    results = {}
+    for name, provider in providers.items():
+        results[name + "_buffered"] = measure(buffered, provider, rows, repeat)
+        results[name + "_streamed"] = measure(streamed, provider, rows, repeat)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = Flask(__name__)
+        setup_db(app, "sqlite:///{}".format(os.path.join(tmp, "bench.db")))
+
+        with app.app_context():
+            seed(args.rows, 1)
+            results = run(app, args.repeat)
+            db.session.remove()
+
+    print(json.dumps({"rows": args.rows, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Compares full ORM loads against the column-only projection used by
+GET /actors and GET /movies on a seeded SQLite database.
+
+    python benchmarks/list_queries.py --rows 100000 --repeat 5
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import date
+from itertools import islice
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+
+from database.models import db, setup_db, Actor, ActorInMovie, Movie  # noqa: E402
+
+
+# Rows sent per executemany while seeding, bounds memory at large scales
+SEED_BATCH_SIZE = 50000
+
+
+def batches(rows):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, SEED_BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+def seed(rows, cast_size):
+    db.create_all()
+    for batch in batches(
+            {"id": i, "name": "Actor {}".format(i),
+             "full_name": "Full Name {}".format(i),
+             "date_of_birth": date(1980, 1, 1)}
+            for i in range(1, rows + 1)):
+        db.session.execute(Actor.__table__.insert(), batch)
+    for batch in batches(
+            {"id": i, "title": "Movie {}".format(i),
+             "release_year": 1950 + i % 75, "duration": 80 + i % 90,
+             "imdb_rating": (i % 100) / 10}
+            for i in range(1, rows + 1)):
+        db.session.execute(Movie.__table__.insert(), batch)
+    for batch in batches(
+            {"movie_id": movie_id, "actor_id": (movie_id + offset) % rows + 1}
+            for movie_id in range(1, rows + 1)
+            for offset in range(cast_size)):
+        db.session.execute(ActorInMovie.__table__.insert(), batch)
+    db.session.commit()
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        count = len(fn())
+        samples.append(time.perf_counter() - start)
+    return {"rows": count, "best_ms": round(min(samples) * 1000, 2),
+            "mean_ms": round(sum(samples) / len(samples) * 1000, 2)}
+
+
+def run(limit, repeat):
+    cases = {
+        "actors_orm": lambda: [
+            actor.short_info for actor in
+            Actor.query.order_by(Actor.id).limit(limit).all()],
+        "actors_projection": lambda: [
+            actor._asdict() for actor in
+            Actor.short_info_query().order_by(Actor.id).limit(limit).all()],
+        "movies_orm": lambda: [
+            movie.short_info for movie in
+            Movie.query.order_by(Movie.id).limit(limit).all()],
+        "movies_projection": lambda: [
+            movie._asdict() for movie in
+            Movie.short_info_query().order_by(Movie.id).limit(limit).all()],
+    }
+    return {name: timed(fn, repeat) for name, fn in cases.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--cast-size", type=int, default=5)
+    parser.add_argument("--limit", type=int, default=None,
+                        help="rows fetched per query, all rows by default")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = Flask(__name__)
+        setup_db(app, "sqlite:///{}".format(os.path.join(tmp, "bench.db")))
+
+        with app.app_context():
+            seed(args.rows, args.cast_size)
+            results = run(args.limit or args.rows, args.repeat)
+            db.session.remove()
+
+    print(json.dumps({"rows": args.rows, "cast_size": args.cast_size,
+                      "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Resource kinds cached by the detail endpoints
+ACTOR = "actor"
+MOVIE = "movie"
+
+# RESPONSE_CACHE_SIZE=0 disables the cache
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 10000))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 60))
+# Shared backend, e.g. redis://localhost:6379/0, needs the redis package
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL')
+
+
+def cache_key(kind, resource_id):
+    return "{}:{}".format(kind, resource_id)
+
+
+# Backends
+# A backend provides get(key), set(key, value), delete(keys) and stats
+
+
+class LocalCacheBackend:
+    """In-process LRU with a TTL, one per worker"""
+
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL,
+                 clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.evictions = 0
+        self.expirations = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if self.clock() >= expires_at:
+                del self._entries[key]
+                self.expirations += 1
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (value, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self):
+        return {
+            "backend": "local",
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+
+class SharedCacheBackend:
+    """
+    Cache shared by every worker, on top of a redis-like client providing
+    get(key), set(key, value, ex=seconds) and delete(*keys)
+    Invalidations made by one worker are seen by all of them
+    """
+
+    def __init__(self, client, ttl=RESPONSE_CACHE_TTL, prefix="casting:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, keys):
+        keys = [self.prefix + key for key in keys]
+        if keys:
+            self.client.delete(*keys)
+
+    def clear(self):
+        pass
+
+    @property
+    def stats(self):
+        return {"backend": "shared"}
+
+
+class LocalSharedClient:
+    """In-memory stand-in for a redis client, for tests and local runs"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires_at = self._values.get(key, (None, None))
+            if expires_at is not None and self.clock() >= expires_at:
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._values[key] = (
+                value, None if ex is None else self.clock() + ex)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+
+
+class ResponseCache:
+    """
+    Caches the payload of detail reads by resource kind and id
+    Write handlers invalidate every entry their change affects
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, kind, resource_id):
+        value = self.backend.get(cache_key(kind, resource_id))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, kind, resource_id, value):
+        self.backend.set(cache_key(kind, resource_id), value)
+
+    def invalidate(self, kind, resource_ids):
+        keys = [cache_key(kind, resource_id) for resource_id in resource_ids]
+        self.invalidations += len(keys)
+        self.backend.delete(keys)
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "invalidations": self.invalidations
+        }
+        stats.update(self.backend.stats)
+        return stats
+
+
+def create_response_cache(config):
+    """Builds the cache configured by RESPONSE_CACHE_URL/SIZE/TTL"""
+    size = int(config.get("RESPONSE_CACHE_SIZE", RESPONSE_CACHE_SIZE))
+    ttl = int(config.get("RESPONSE_CACHE_TTL", RESPONSE_CACHE_TTL))
+    url = config.get("RESPONSE_CACHE_URL", RESPONSE_CACHE_URL)
+
+    if url:
+        import redis
+        return ResponseCache(SharedCacheBackend(
+            redis.Redis.from_url(url), ttl=ttl))
+
+    return ResponseCache(LocalCacheBackend(max_size=size, ttl=ttl))
@@ -0,0 +1,55 @@
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from .pool import engine_options
+
+# asyncio driver used for each sync database backend
+ASYNC_DRIVERS = {
+    "postgresql": "asyncpg",
+    "sqlite": "aiosqlite",
+}
+
+
+def async_database_url(database_uri):
+    """
+    The same database behind an asyncio driver, e.g. postgresql://... as
+    postgresql+asyncpg://...; raises ValueError for unsupported backends
+    """
+    url = make_url(database_uri)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError("no asyncio driver for {}".format(backend))
+
+    return url.set(drivername="{}+{}".format(backend, ASYNC_DRIVERS[backend]))
+
+
+def async_engine_options(config, database_uri):
+    """
+    engine_options for an asyncio engine: the pool class is left to the
+    default async adapted queue pool and the PostgreSQL statement timeout
+    moves to asyncpg's server_settings
+    """
+    options = engine_options(config, database_uri)
+    options.pop("poolclass", None)
+
+    connect_args = options.pop("connect_args", None)
+    if connect_args:
+        timeout = connect_args["options"].rpartition("=")[2]
+        options["connect_args"] = {
+            "server_settings": {"statement_timeout": timeout}
+        }
+
+    return options
+
+
+def create_async_db_engine(config, database_uri):
+    return create_async_engine(async_database_url(database_uri),
+                               **async_engine_options(config, database_uri))
+
+
+def async_session_factory(engine):
+    """
+    Sessions for the async read endpoints, on the models of database.models
+    Rows stay readable after commit, nothing is lazy loaded on an await
+    """
+    return async_sessionmaker(engine, expire_on_commit=False)
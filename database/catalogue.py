@@ -0,0 +1,290 @@
+import csv
+import io
+import os
+import random
+from datetime import date, timedelta
+from itertools import accumulate, islice
+
+from sqlalchemy import func, insert, select, text, update
+
+from .models import Actor, ActorInMovie, Movie, TableVersion, VERSIONED_TABLES
+from .stats import refresh_all_stats
+
+# Rows sent per COPY or executemany
+CATALOGUE_BATCH_SIZE = int(os.environ.get('CATALOGUE_BATCH_SIZE', 50000))
+
+# Cast sizes follow a triangular distribution between these bounds
+CAST_MIN = 1
+CAST_MAX = 30
+CAST_MODE = 6
+# Zipf exponent of actor popularity: the actor of rank r is cast in
+# proportion to 1 / r ** POPULARITY_EXPONENT
+POPULARITY_EXPONENT = 0.6
+
+FIRST_NAMES = (
+    "Ava", "Ben", "Chloe", "Daniel", "Elena", "Felix", "Grace", "Hugo",
+    "Isla", "Jack", "Kira", "Leo", "Maya", "Noah", "Olivia", "Paul",
+    "Quinn", "Rosa", "Sam", "Tara", "Umar", "Vera", "Will", "Xena", "Yusuf",
+    "Zoe", "Aaron", "Bianca", "Carlos", "Dana", "Emil", "Farah", "Gus",
+    "Hana", "Ivan", "Julia", "Kofi", "Lena", "Marco", "Nina", "Omar",
+    "Priya", "Rafael", "Sofia", "Tomas", "Uma", "Victor", "Wendy", "Yara",
+)
+MIDDLE_NAMES = (
+    "Anne", "James", "Marie", "Lee", "Rose", "John", "Kay", "Ray", "Jean",
+    "Lynn", "Mae", "Dean", "Grace", "Paul", "Louise", "Alan",
+)
+LAST_NAMES = (
+    "Adams", "Baker", "Costa", "Dubois", "Evans", "Fischer", "Garcia",
+    "Hughes", "Ito", "Jensen", "Kowalski", "Lopez", "Moreau", "Novak",
+    "Okafor", "Petrov", "Quinn", "Rossi", "Silva", "Tanaka", "Ueda",
+    "Vargas", "Walsh", "Xu", "Young", "Zhang", "Andersen", "Brennan",
+    "Castillo", "Dimitrov", "Eriksson", "Ferreira", "Gallagher", "Haddad",
+    "Ivanova", "Janssen", "Kim", "Larsen", "Mendes", "Nakamura", "Oliveira",
+    "Park", "Reyes", "Schmidt", "Torres", "Varga", "Weber", "Yilmaz",
+)
+TITLE_ADJECTIVES = (
+    "Silent", "Broken", "Golden", "Last", "Hidden", "Crimson", "Distant",
+    "Midnight", "Frozen", "Burning", "Lost", "Secret", "Wild", "Final",
+    "Endless", "Quiet", "Electric", "Hollow", "Bright", "Savage",
+)
+TITLE_NOUNS = (
+    "River", "Empire", "Garden", "Signal", "Harbor", "Kingdom", "Promise",
+    "Horizon", "Witness", "Storm", "Mirror", "Frontier", "Orchard",
+    "Station", "Verdict", "Voyage", "Shadow", "Machine", "Island", "Winter",
+)
+TITLE_PLACES = (
+    "Paris", "the North", "Tomorrow", "the Valley", "Saturn", "the Deep",
+    "Brooklyn", "the Desert", "Avalon", "the City",
+)
+
+FIRST_YEAR = 1930
+LAST_YEAR = 2024
+EARLIEST_BIRTH = date(1925, 1, 1)
+LATEST_BIRTH = date(2010, 12, 31)
+
+ACTOR_COLUMNS = ("id", "name", "full_name", "date_of_birth")
+MOVIE_COLUMNS = ("id", "title", "release_year", "duration", "imdb_rating")
+CAST_COLUMNS = ("actor_id", "movie_id")
+
+# Positional placeholders, rows go to the driver's executemany as tuples
+PLACEHOLDERS = {"qmark": "?", "format": "%s", "pyformat": "%s"}
+
+
+class CatalogueGenerator:
+    """
+    Synthetic actors, movies and casts; every table draws from its own
+    random stream of the seed, so a seed always gives the same rows
+    whatever is generated or skipped
+
+        generator = CatalogueGenerator(actors=1000000, movies=200000)
+        for actor_id, movie_id in generator.cast_rows():
+            ...
+    """
+
+    def __init__(self, actors, movies, cast_min=CAST_MIN, cast_max=CAST_MAX,
+                 cast_mode=CAST_MODE, popularity=POPULARITY_EXPONENT,
+                 seed=0):
+        if actors < 1 or movies < 0:
+            raise ValueError("actors must be positive and movies not negative")
+        if not 1 <= cast_min <= cast_mode <= cast_max:
+            raise ValueError("expected 1 <= cast_min <= cast_mode <= cast_max")
+
+        self.actors = actors
+        self.movies = movies
+        self.cast_min = cast_min
+        self.cast_max = cast_max
+        self.cast_mode = cast_mode
+        self.popularity = popularity
+        self.seed = seed
+
+    def random(self, stream):
+        return random.Random("{}-{}".format(self.seed, stream))
+
+    def actor_rows(self):
+        """(id, name, full_name, date_of_birth), names are unique"""
+        rng = self.random("actors")
+        birth_days = (LATEST_BIRTH - EARLIEST_BIRTH).days
+        taken = {}
+
+        for actor_id in range(1, self.actors + 1):
+            first = rng.choice(FIRST_NAMES)
+            last = rng.choice(LAST_NAMES)
+            name = "{} {}".format(first, last)
+
+            # Actor names are unique, namesakes get a number
+            homonyms = taken.get(name, 0)
+            taken[name] = homonyms + 1
+            if homonyms:
+                name = "{} {}".format(name, homonyms + 1)
+
+            yield (actor_id, name,
+                   "{} {} {}".format(first, rng.choice(MIDDLE_NAMES), last),
+                   EARLIEST_BIRTH + timedelta(rng.randrange(birth_days)))
+
+    def movie_rows(self):
+        """(id, title, release_year, duration, imdb_rating)"""
+        rng = self.random("movies")
+
+        for movie_id in range(1, self.movies + 1):
+            if rng.random() < 0.7:
+                title = "The {} {}".format(
+                    rng.choice(TITLE_ADJECTIVES), rng.choice(TITLE_NOUNS))
+            else:
+                title = "{} of {}".format(
+                    rng.choice(TITLE_NOUNS), rng.choice(TITLE_PLACES))
+            if rng.random() < 0.1:
+                title = "{} {}".format(title, rng.randint(2, 4))
+
+            # More recent years release more movies
+            release_year = int(rng.triangular(FIRST_YEAR, LAST_YEAR + 1,
+                                              LAST_YEAR))
+            duration = min(max(int(rng.gauss(110, 20)), 60), 240)
+            imdb_rating = round(min(max(rng.gauss(6.4, 1.1), 1.0), 10.0), 1)
+
+            yield movie_id, title, release_year, duration, imdb_rating
+
+    def popularity_ranking(self):
+        """
+        Actor ids from the most cast down, with the cumulative weights
+        of their power-law popularity
+        """
+        rng = self.random("popularity")
+        ranking = list(range(1, self.actors + 1))
+        rng.shuffle(ranking)
+        cum_weights = list(accumulate(
+            1 / rank ** self.popularity
+            for rank in range(1, self.actors + 1)))
+        return ranking, cum_weights
+
+    def cast_rows(self):
+        """(actor_id, movie_id), movie by movie, no actor twice per movie"""
+        rng = self.random("casts")
+        ranking, cum_weights = self.popularity_ranking()
+
+        for movie_id in range(1, self.movies + 1):
+            size = min(int(rng.triangular(self.cast_min, self.cast_max + 1,
+                                          self.cast_mode)),
+                       self.cast_max, self.actors)
+
+            if size * 2 > self.actors:
+                # Drawing by popularity would mostly redraw the same actors
+                cast = rng.sample(ranking, size)
+            else:
+                cast = dict.fromkeys(rng.choices(
+                    ranking, cum_weights=cum_weights, k=size))
+                while len(cast) < size:
+                    cast.update(dict.fromkeys(rng.choices(
+                        ranking, cum_weights=cum_weights, k=size - len(cast))))
+
+            for actor_id in cast:
+                yield actor_id, movie_id
+
+    def tables(self):
+        """(table, columns, rows) of each table, in insertion order"""
+        return [
+            (Actor.__table__, ACTOR_COLUMNS, self.actor_rows()),
+            (Movie.__table__, MOVIE_COLUMNS, self.movie_rows()),
+            (ActorInMovie.__table__, CAST_COLUMNS, self.cast_rows()),
+        ]
+
+    def __repr__(self):
+        return "<CatalogueGenerator(actors={}, movies={}, seed={})>".format(
+            self.actors, self.movies, self.seed)
+
+
+def batches(rows, batch_size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def csv_buffer(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    buffer.seek(0)
+    return buffer
+
+
+def write_catalogue(generator, directory):
+    """
+    Writes the catalogue as one CSV file per table, with a header line,
+    loadable with COPY ... WITH (FORMAT csv, HEADER); returns the rows
+    written per table
+    """
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+
+    for table, columns, rows in generator.tables():
+        path = os.path.join(directory, "{}.csv".format(table.name))
+        count = 0
+        with open(path, "w", newline="") as csv_file:
+            writer = csv.writer(csv_file, lineterminator="\n")
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        counts[table.name] = count
+
+    return counts
+
+
+def load_catalogue(connection, generator, batch_size=CATALOGUE_BATCH_SIZE):
+    """
+    Inserts the catalogue into empty tables, with COPY on PostgreSQL
+    (psycopg2) and batched executemany elsewhere, then refreshes what
+    the row-by-row writes would have: the /stats summaries, the table
+    versions and the id sequences; returns the rows inserted per table
+    """
+    for table in (Actor.__table__, Movie.__table__):
+        if connection.scalar(select(func.count()).select_from(table)):
+            raise ValueError("the {} table is not empty".format(table.name))
+
+    cursor = None
+    if connection.dialect.name == "postgresql":
+        cursor = connection.connection.cursor()
+        if not hasattr(cursor, "copy_expert"):
+            # Only psycopg2 cursors take a file to COPY from
+            cursor.close()
+            cursor = None
+    placeholder = PLACEHOLDERS.get(connection.dialect.paramstyle)
+    counts = {}
+
+    for table, columns, rows in generator.tables():
+        column_list = ", ".join(columns)
+        count = 0
+        for batch in batches(rows, batch_size):
+            if cursor is not None:
+                cursor.copy_expert(
+                    "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+                        table.name, column_list), csv_buffer(batch))
+            elif placeholder is not None:
+                connection.exec_driver_sql(
+                    "INSERT INTO {} ({}) VALUES ({})".format(
+                        table.name, column_list,
+                        ", ".join([placeholder] * len(columns))), batch)
+            else:
+                connection.execute(insert(table), [
+                    dict(zip(columns, row)) for row in batch])
+            count += len(batch)
+        counts[table.name] = count
+
+    if cursor is not None:
+        cursor.close()
+
+    if connection.dialect.name == "postgresql":
+        # Ids were given explicitly, the next insert must not reuse them
+        for table in (Actor.__table__, Movie.__table__):
+            connection.execute(text(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                "GREATEST((SELECT max(id) FROM {0}), 1))".format(table.name)))
+
+    refresh_all_stats(connection)
+    connection.execute(
+        update(TableVersion.__table__)
+        .where(TableVersion.table_name.in_(VERSIONED_TABLES))
+        .values(version=TableVersion.version + 1))
+
+    return counts
@@ -0,0 +1,44 @@
+import os
+
+from sqlalchemy import select
+
+from .models import db, Actor, ActorInMovie, Movie
+
+# Rows fetched per round trip of the server-side cursor
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 5000))
+
+# Exported columns and the index order the rows are read in
+EXPORTS = {
+    "actors": (
+        (Actor.id, Actor.name, Actor.full_name, Actor.date_of_birth),
+        (Actor.id,)),
+    "movies": (
+        (Movie.id, Movie.title, Movie.release_year, Movie.duration,
+         Movie.imdb_rating),
+        (Movie.id,)),
+    # Primary key order, (actor_id, movie_id)
+    "casting": (
+        (ActorInMovie.movie_id, ActorInMovie.actor_id),
+        (ActorInMovie.actor_id, ActorInMovie.movie_id)),
+}
+
+
+def export_columns(name):
+    columns, _ = EXPORTS[name]
+    return [column.key for column in columns]
+
+
+def export_batches(name, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields the rows of an export in lists of batch_size, read through a
+    server-side cursor so memory stays constant whatever the table size
+    """
+    columns, order_by = EXPORTS[name]
+    result = db.session.execute(
+        select(*columns).order_by(*order_by)
+        .execution_options(yield_per=batch_size))
+
+    try:
+        yield from result.partitions()
+    finally:
+        result.close()
@@ -0,0 +1,106 @@
+import sys
+from datetime import date
+
+from .models import Actor, Movie
+
+
+class RangeFilter:
+    """<name>_min and <name>_max query parameters, both bounds inclusive"""
+
+    def __init__(self, column, convert):
+        self.column = column
+        self.convert = convert
+
+    def predicates(self, args, name):
+        for suffix, bound in (("_min", self.column.__ge__),
+                              ("_max", self.column.__le__)):
+            raw = args.get(name + suffix)
+            if raw is None:
+                continue
+
+            try:
+                value = self.convert(raw)
+            except (TypeError, ValueError):
+                raise ValueError("invalid {}".format(name + suffix))
+            yield bound(value)
+
+    def __repr__(self):
+        return "<RangeFilter(column={})>".format(self.column)
+
+
+class PrefixFilter:
+    """
+    <name>_prefix query parameter, case-sensitive
+    Matched as a range on the column so its btree index is used, and with
+    LIKE since under a linguistic collation the range alone can let
+    through values that do not start with the prefix
+    """
+
+    def __init__(self, column):
+        self.column = column
+
+    def predicates(self, args, name):
+        prefix = args.get(name + "_prefix")
+        if not prefix:
+            return
+
+        yield self.column >= prefix
+        if ord(prefix[-1]) < sys.maxunicode:
+            yield self.column < prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        yield self.column.startswith(prefix, autoescape=True)
+
+    def __repr__(self):
+        return "<PrefixFilter(column={})>".format(self.column)
+
+
+# Query parameters accepted by GET /movies and GET /actors
+MOVIE_FILTERS = {
+    "release_year": RangeFilter(Movie.release_year, int),
+    "imdb_rating": RangeFilter(Movie.imdb_rating, float),
+    "duration": RangeFilter(Movie.duration, int),
+}
+
+ACTOR_FILTERS = {
+    "name": PrefixFilter(Actor.name),
+    "date_of_birth": RangeFilter(Actor.date_of_birth, date.fromisoformat),
+}
+
+# Whitelisted sort keys, all of them indexed
+MOVIE_SORT_KEYS = {
+    "id": Movie.id,
+    "title": Movie.title,
+    "release_year": Movie.release_year,
+    "imdb_rating": Movie.imdb_rating,
+    "duration": Movie.duration,
+}
+
+ACTOR_SORT_KEYS = {
+    "id": Actor.id,
+    "name": Actor.name,
+    "date_of_birth": Actor.date_of_birth,
+}
+
+
+def parse_filters(args, filters):
+    """SQL predicates of the filter query parameters, raises ValueError"""
+    return [predicate
+            for name, list_filter in filters.items()
+            for predicate in list_filter.predicates(args, name)]
+
+
+def parse_sort(args, sort_keys, id_column):
+    """
+    Reads sort=<key> or sort=-<key> (descending) from the query string
+    Returns (key columns, descending), ties are broken on id_column
+    Raises ValueError for keys outside the whitelist
+    """
+    sort = args.get("sort", "id")
+    descending = sort.startswith("-")
+    column = sort_keys.get(sort[1:] if descending else sort)
+
+    if column is None:
+        raise ValueError("invalid sort")
+
+    if column is id_column:
+        return (id_column,), descending
+    return (column, id_column), descending
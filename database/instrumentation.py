@@ -0,0 +1,33 @@
+from sqlalchemy import event
+
+
+class QueryCounter:
+    """
+    Context manager recording the SQL statements executed on an engine
+
+        with QueryCounter(db.engine) as counter:
+            ...
+        assert counter.count <= 2
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self._record)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _record(self, conn, cursor, statement, parameters, context,
+                executemany):
+        self.statements.append(statement)
+
+    def __repr__(self):
+        return "<QueryCounter(count={})>".format(self.count)
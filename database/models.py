@@ -1,9 +1,16 @@
+from contextlib import contextmanager
 from datetime import date
 from dotenv import load_dotenv
-from sqlalchemy import Column, String, Integer, ForeignKey, Float, Date
+from sqlalchemy import (
+    Column, String, Integer, ForeignKey, Float, Date, event, select, update)
+from sqlalchemy.orm import selectinload
 from flask_sqlalchemy import SQLAlchemy
 import os
 
+from .pool import engine_options
+from .profiler import init_sql_profiler
+from .routing import REPLICA_EXTENSION, RoutingSession, init_replica_routing
+
 basedir = os.path.abspath(os.path.dirname(__file__))
 load_dotenv(os.path.join(basedir, '.env'))
 
@@ -15,19 +22,68 @@ SQLALCHEMY_TRACK_MODIFICATIONS = os.environ.get(
 # Get the database URL from the environment variable
 database_path = os.environ.get('DATABASE_URL')
 
-db = SQLAlchemy()
+# Optional read replica, GET requests read from it when set
+replica_database_path = os.environ.get('DATABASE_REPLICA_URL')
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+# Tables whose writes bump their change counter in table_versions,
+# once per transaction
+VERSIONED_TABLES = ("actors", "movies", "actor_in_movie")
 
 # ----------------------------------------------------------------------------#
 
 
-def setup_db(app):
+def setup_db(app, database_path=database_path):
     """binds a flask application and a SQLAlchemy service"""
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config.setdefault("SQLALCHEMY_DATABASE_URI", database_path)
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(
+        app.config, app.config["SQLALCHEMY_DATABASE_URI"]))
+
+    replica_path = app.config.get(
+        "DATABASE_REPLICA_URL", replica_database_path)
+    if replica_path:
+        init_replica_routing(app, db, replica_path)
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = SQLALCHEMY_TRACK_MODIFICATIONS
 
     db.app = app
     db.init_app(app)
 
+    with app.app_context():
+        engines = [db.engine]
+    if REPLICA_EXTENSION in app.extensions:
+        engines.append(app.extensions[REPLICA_EXTENSION])
+    init_sql_profiler(app, engines)
+
+
+@contextmanager
+def unit_of_work():
+    """
+    groups model insert/update/delete calls into a single transaction
+    inside the block they only stage their changes, the outermost block
+    commits once on exit or rolls everything back on error
+    """
+    session = db.session
+    depth = session.info.get("unit_of_work", 0)
+    session.info["unit_of_work"] = depth + 1
+
+    try:
+        yield session
+        if depth == 0:
+            session.commit()
+    except Exception:
+        if depth == 0:
+            session.rollback()
+        raise
+    finally:
+        session.info["unit_of_work"] = depth
+
+
+def commit_changes():
+    """commits right away unless a unit of work is open"""
+    if not db.session.info.get("unit_of_work"):
+        db.session.commit()
+
 
 def db_drop_and_create_all():
     """
@@ -38,26 +94,117 @@ def db_drop_and_create_all():
     db.create_all()
 
 
+class TableVersion(db.Model):
+    """
+    change counter of a table, bumped in the same transaction as every
+    write to it, list endpoints derive their ETags from it
+    """
+    __tablename__ = "table_versions"
+
+    table_name = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+    @staticmethod
+    def current(table_name):
+        return db.session.query(TableVersion.version).filter_by(
+            table_name=table_name).scalar() or 0
+
+    @staticmethod
+    async def current_async(session, table_name):
+        """current on an async session"""
+        return await session.scalar(select(TableVersion.version).filter_by(
+            table_name=table_name)) or 0
+
+    def __repr__(self):
+        return "<TableVersion(table_name='{}', version={})>".format(
+            self.table_name, self.version)
+
+
+@event.listens_for(TableVersion.__table__, "after_create")
+def create_table_versions(target, connection, **kwargs):
+    connection.execute(target.insert(), [
+        {"table_name": table_name, "version": 0}
+        for table_name in VERSIONED_TABLES
+    ])
+
+
+def bump_table_versions(session, table_names):
+    bumped = session.info.setdefault("bumped_tables", set())
+    table_names = set(table_names) - bumped
+    if table_names:
+        session.connection().execute(
+            update(TableVersion.__table__)
+            .where(TableVersion.table_name.in_(table_names))
+            .values(version=TableVersion.version + 1))
+        bumped |= table_names
+
+
+@event.listens_for(RoutingSession, "after_commit")
+@event.listens_for(RoutingSession, "after_soft_rollback")
+def reset_bumped_tables(session, *args):
+    session.info.pop("bumped_tables", None)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def bump_flushed_tables(session, flush_context):
+    """counts the unit of work changes: inserts, updates and deletes"""
+    changed = [obj for obj in session.dirty if session.is_modified(obj)]
+    changed.extend(session.new)
+    changed.extend(session.deleted)
+    bump_table_versions(session, {
+        obj.__tablename__ for obj in changed
+        if getattr(obj, "__tablename__", None) in VERSIONED_TABLES
+    })
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def bump_bulk_statement_tables(orm_execute_state):
+    """counts the statement changes: insert(Model), query.update(), ..."""
+    state = orm_execute_state
+    if not (state.is_insert or state.is_update or state.is_delete):
+        return
+
+    mapper = state.bind_mapper
+    if mapper is not None and mapper.local_table.name in VERSIONED_TABLES:
+        bump_table_versions(state.session, [mapper.local_table.name])
+
+
 class ActorInMovie(db.Model):
     __tablename__ = "actor_in_movie"
 
-    movie_id = Column(Integer, ForeignKey("movies.id"), primary_key=True)
+    # Same key order as the migration, (actor_id, movie_id)
     actor_id = Column(Integer, ForeignKey("actors.id"), primary_key=True)
+    movie_id = Column(Integer, ForeignKey("movies.id"), primary_key=True,
+                      index=True)
 
     def __init__(self, movie_id: int, actor_id: int):
         self.movie_id = movie_id
         self.actor_id = actor_id
 
+    @staticmethod
+    def movie_ids_of(actor_ids):
+        """ids of the movies any of the given actors plays in"""
+        return {movie_id for movie_id, in db.session.query(
+            ActorInMovie.movie_id).filter(
+                ActorInMovie.actor_id.in_(actor_ids)).distinct()}
+
+    @staticmethod
+    def actor_ids_of(movie_ids):
+        """ids of the actors cast in any of the given movies"""
+        return {actor_id for actor_id, in db.session.query(
+            ActorInMovie.actor_id).filter(
+                ActorInMovie.movie_id.in_(movie_ids)).distinct()}
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_changes()
 
     def update(self):
-        db.session.commit()
+        commit_changes()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_changes()
 
     @property
     def short_info(self):
@@ -89,11 +236,16 @@ class Movie(db.Model):
     __tablename__ = "movies"
 
     id = Column(Integer, primary_key=True)
-    title = Column(String(256), nullable=False)
-    release_year = Column(Integer, nullable=False)
-    imdb_rating = Column(Float, nullable=False)
-    duration = Column(Integer, nullable=False)
-    actors = db.relationship('ActorInMovie', backref = 'movies', lazy='joined', cascade="all, delete")
+    title = Column(String(256), nullable=False, index=True)
+    release_year = Column(Integer, nullable=False, index=True)
+    imdb_rating = Column(Float, nullable=False, index=True)
+    duration = Column(Integer, nullable=False, index=True)
+    # Bumped on every change to full_info, detail ETags derive from it
+    version = Column(Integer, nullable=False, server_default="1")
+    actors = db.relationship('ActorInMovie', backref='movies', cascade="all, delete")
+
+    # Updates and deletes check the version they read, see If-Match
+    __mapper_args__ = {"version_id_col": version}
 
     def __init__(self, title: str, release_year: int, duration: int, imdb_rating: float):
         self.title = title
@@ -103,14 +255,60 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_changes()
 
     def update(self):
-        db.session.commit()
+        commit_changes()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_changes()
+
+    @classmethod
+    def short_info_query(cls):
+        """
+        Column-only query returning rows shaped like short_info,
+        without loading entities or their relationships
+        """
+        return db.session.query(cls.id, cls.title, cls.release_year)
+
+    @classmethod
+    def short_info_select(cls):
+        """short_info_query as a select(), for async sessions"""
+        return select(cls.id, cls.title, cls.release_year)
+
+    @classmethod
+    def short_info_by_id(cls, ids):
+        """short_info of the given rows keyed by id, in one query"""
+        ids = list(ids)
+        if not ids:
+            return {}
+        return {row.id: row._asdict() for row in
+                cls.short_info_query().filter(cls.id.in_(ids))}
+
+    @classmethod
+    def version_of(cls, movie_id):
+        """version of one row, read without loading it or its relationships"""
+        return db.session.query(cls.version).filter_by(id=movie_id).scalar()
+
+    @classmethod
+    def touch(cls, ids):
+        """
+        bumps the version of rows whose full_info changed through a
+        related row, e.g. a cast member's rename
+        """
+        ids = list(ids)
+        if ids:
+            db.session.query(cls).filter(cls.id.in_(ids)).update(
+                {cls.version: cls.version + 1})
+
+    @staticmethod
+    def with_cast():
+        """
+        Loader option for full_info: the association rows and their actors
+        are fetched in one extra SELECT ... IN query, whatever the cast size
+        """
+        return selectinload(Movie.actors).joinedload(ActorInMovie.actors)
 
     @property
     def short_info(self):
@@ -148,10 +346,16 @@ class Actor(db.Model):
     __tablename__ = "actors"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(256), nullable=False)
+    # Casts reference actors by name, so names are unique
+    name = Column(String(256), nullable=False, unique=True, index=True)
     full_name = Column(String(512), nullable=False, default='')
-    date_of_birth = Column(Date, nullable=False)
-    movies = db.relationship('ActorInMovie', backref = 'actors', lazy='joined', cascade="all, delete")
+    date_of_birth = Column(Date, nullable=False, index=True)
+    # Bumped on every change to full_info, detail ETags derive from it
+    version = Column(Integer, nullable=False, server_default="1")
+    movies = db.relationship('ActorInMovie', backref='actors', cascade="all, delete")
+
+    # Updates and deletes check the version they read, see If-Match
+    __mapper_args__ = {"version_id_col": version}
 
     def __init__(self, name: str, full_name: str, date_of_birth: date):
         self.name = name
@@ -160,16 +364,60 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_changes()
 
     def update(self):
-        db.session.commit()
+        commit_changes()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
-
-    
+        commit_changes()
+
+    @classmethod
+    def short_info_query(cls):
+        """
+        Column-only query returning rows shaped like short_info,
+        without loading entities or their relationships
+        """
+        return db.session.query(cls.id, cls.name)
+
+    @classmethod
+    def short_info_select(cls):
+        """short_info_query as a select(), for async sessions"""
+        return select(cls.id, cls.name)
+
+    @classmethod
+    def short_info_by_id(cls, ids):
+        """short_info of the given rows keyed by id, in one query"""
+        ids = list(ids)
+        if not ids:
+            return {}
+        return {row.id: row._asdict() for row in
+                cls.short_info_query().filter(cls.id.in_(ids))}
+
+    @classmethod
+    def version_of(cls, actor_id):
+        """version of one row, read without loading it or its relationships"""
+        return db.session.query(cls.version).filter_by(id=actor_id).scalar()
+
+    @classmethod
+    def touch(cls, ids):
+        """
+        bumps the version of rows whose full_info changed through a
+        related row, e.g. a cast member's rename
+        """
+        ids = list(ids)
+        if ids:
+            db.session.query(cls).filter(cls.id.in_(ids)).update(
+                {cls.version: cls.version + 1})
+
+    @staticmethod
+    def with_movies():
+        """
+        Loader option for full_info: the association rows and their movies
+        are fetched in one extra SELECT ... IN query, whatever their number
+        """
+        return selectinload(Actor.movies).joinedload(ActorInMovie.movies)
 
     @property
     def short_info(self):
@@ -0,0 +1,164 @@
+import base64
+import json
+import operator
+import os
+from datetime import date
+
+from sqlalchemy import and_, or_
+
+# Page size used when the client does not send a limit
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 100))
+# Largest page size the server accepts, bigger limits are clamped
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+
+
+def encode_cursor(values):
+    """Encodes the keyset values of the last row into an opaque cursor"""
+    raw = json.dumps([
+        value.isoformat() if isinstance(value, date) else value
+        for value in values
+    ], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor built by encode_cursor, raises ValueError if invalid"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except Exception:
+        raise ValueError('invalid cursor')
+
+    if not isinstance(values, list) or not values:
+        raise ValueError('invalid cursor')
+
+    return values
+
+
+def cursor_value(column, value):
+    """Checks a decoded cursor value against its column type"""
+    python_type = column.type.python_type
+
+    if python_type is date and isinstance(value, str):
+        return date.fromisoformat(value)
+    if python_type is float and type(value) in (int, float):
+        return float(value)
+    if type(value) is python_type:
+        return value
+
+    raise ValueError('invalid cursor')
+
+
+def cursor_values(cursor, key_columns):
+    """
+    Typed keyset values of a decoded cursor for the given key columns,
+    raises ValueError if the cursor was built for another sort
+    """
+    if len(cursor) != len(key_columns):
+        raise ValueError('invalid cursor')
+
+    return [cursor_value(column, value)
+            for column, value in zip(key_columns, cursor)]
+
+
+def parse_page_args(args):
+    """
+    Reads limit and cursor from the query string
+    Returns (limit, decoded cursor or None), raises ValueError if invalid
+    The cursor values are checked by cursor_values once the sort is known
+    """
+    limit = args.get('limit', DEFAULT_PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError('invalid limit')
+
+    if limit <= 0:
+        raise ValueError('invalid limit')
+
+    cursor = args.get('cursor')
+    cursor = decode_cursor(cursor) if cursor else None
+
+    return min(limit, MAX_PAGE_SIZE), cursor
+
+
+def after_cursor(key_columns, values, descending=False):
+    """Row value comparison (a, b) > (x, y) as a > x OR (a = x AND b > y)"""
+    compare = operator.lt if descending else operator.gt
+    column, value = key_columns[0], values[0]
+
+    if len(key_columns) == 1:
+        return compare(column, value)
+
+    return or_(compare(column, value), and_(
+        column == value,
+        after_cursor(key_columns[1:], values[1:], descending)))
+
+
+def keyset_query(query, key_columns, cursor=None, descending=False):
+    """
+    Orders query on key_columns, the last of them unique, and starts it
+    after the cursor row; the key columns are appended to the selection
+    Returns (query, fields), fields naming the columns of the original query
+    """
+    fields = [description["name"] for description in query.column_descriptions]
+
+    if cursor is not None:
+        query = query.filter(after_cursor(key_columns, cursor, descending))
+
+    order_by = [column.desc() if descending else column
+                for column in key_columns]
+    return query.add_columns(*key_columns).order_by(*order_by), fields
+
+
+def paginate(query, key_columns, limit, cursor=None, descending=False):
+    """
+    Keyset pagination on indexed columns, the last one unique (no OFFSET scan)
+    Returns (rows as dicts of the query's columns, next_cursor),
+    next_cursor is None on the last page
+    """
+    query, fields = keyset_query(query, key_columns, cursor, descending)
+    return page_of(query.limit(limit + 1).all(), fields, limit)
+
+
+def page_of(rows, fields, limit):
+    """
+    Page of the at most limit + 1 rows of a keyset_query, for callers
+    running the query themselves, e.g. on an async session
+    """
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][len(fields):])
+
+    return [dict(zip(fields, row)) for row in rows], next_cursor
+
+
+class PageStream:
+    """
+    Keyset page like paginate, iterated lazily: rows are fetched in batches
+    of yield_per and next_cursor is known once the iteration is over
+    """
+
+    def __init__(self, query, key_columns, limit, cursor=None,
+                 descending=False, yield_per=1000):
+        query, self.fields = keyset_query(query, key_columns, cursor,
+                                          descending)
+        self.query = query.limit(limit + 1)
+        self.limit = limit
+        self.yield_per = yield_per
+        self.next_cursor = None
+
+    def __iter__(self):
+        last = None
+        # The extra row only tells whether another page follows
+        for index, row in enumerate(self.query.yield_per(self.yield_per)):
+            if index == self.limit:
+                self.next_cursor = encode_cursor(last[len(self.fields):])
+                continue
+            last = row
+            yield dict(zip(self.fields, row))
+
+    def __repr__(self):
+        return "<PageStream(limit={}, next_cursor={})>".format(
+            self.limit, self.next_cursor)
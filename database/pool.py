@@ -0,0 +1,124 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+# Upper bounds, in seconds, of the checkout wait time histogram buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Pool settings read from the app config first, then the environment
+POOL_SETTINGS = {
+    "DB_POOL_SIZE": ("pool_size", int),
+    "DB_MAX_OVERFLOW": ("max_overflow", int),
+    "DB_POOL_TIMEOUT": ("pool_timeout", int),
+    "DB_POOL_RECYCLE": ("pool_recycle", int),
+    "DB_POOL_PRE_PING": ("pool_pre_ping",
+                         lambda value: str(value).lower() in ("1", "true")),
+}
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets, safe to share across threads"""
+
+    def __init__(self, buckets=WAIT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    @property
+    def snapshot(self):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+
+        cumulative = 0
+        buckets = []
+        for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += bucket_count
+            buckets.append({"le": bound, "count": cumulative})
+
+        return {"buckets": buckets, "count": count, "sum": round(total, 6)}
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool recording how long each checkout waited for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_histogram = Histogram()
+        self.timeouts = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            self.timeouts += 1
+            raise
+        finally:
+            self.wait_histogram.observe(time.perf_counter() - start)
+
+
+def is_memory_database(database_uri):
+    url = make_url(database_uri)
+    return url.get_backend_name() == "sqlite" \
+        and url.database in (None, "", ":memory:")
+
+
+def engine_options(config, database_uri):
+    """
+    Builds SQLALCHEMY_ENGINE_OPTIONS from DB_POOL_SIZE, DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING and
+    DB_STATEMENT_TIMEOUT (milliseconds, PostgreSQL only)
+    """
+    if not database_uri or is_memory_database(database_uri):
+        # In-memory SQLite runs on a single static connection
+        return {}
+
+    options = {"poolclass": InstrumentedQueuePool}
+
+    for key, (option, convert) in POOL_SETTINGS.items():
+        value = config.get(key, os.environ.get(key))
+        if value is not None and value != "":
+            options[option] = convert(value)
+
+    statement_timeout = config.get(
+        "DB_STATEMENT_TIMEOUT", os.environ.get("DB_STATEMENT_TIMEOUT"))
+    if statement_timeout and \
+            make_url(database_uri).get_backend_name() == "postgresql":
+        options["connect_args"] = {
+            "options": "-c statement_timeout={}".format(
+                int(statement_timeout))
+        }
+
+    return options
+
+
+def pool_stats(engine):
+    """Live statistics of the engine's connection pool"""
+    pool = engine.pool
+    stats = {"class": type(pool).__name__}
+
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, name, None)
+        if method is not None:
+            stats[name] = method()
+
+    histogram = getattr(pool, "wait_histogram", None)
+    if histogram is not None:
+        stats["timeouts"] = pool.timeouts
+        stats["wait_seconds"] = histogram.snapshot
+
+    return stats
@@ -0,0 +1,348 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from functools import lru_cache
+
+from flask import request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# SQL_PROFILER=false leaves the engines uninstrumented
+SQL_PROFILER = os.environ.get('SQL_PROFILER', 'true').lower() in ('1', 'true')
+# Statements slower than this are logged, with their plan
+SQL_SLOW_QUERY_MS = float(os.environ.get('SQL_SLOW_QUERY_MS', 200))
+# A fingerprint is explained at most once per interval, in seconds
+SQL_EXPLAIN_INTERVAL = float(os.environ.get('SQL_EXPLAIN_INTERVAL', 60))
+# Requests running more statements than this are flagged, 0 disables it
+SQL_QUERY_BUDGET = int(os.environ.get('SQL_QUERY_BUDGET', 25))
+# Fingerprints tracked, later new ones are counted under OTHER_FINGERPRINT
+SQL_MAX_FINGERPRINTS = int(os.environ.get('SQL_MAX_FINGERPRINTS', 1000))
+
+# Fingerprints listed by GET /internal/queries unless ?limit= says otherwise
+SQL_TOP_LIMIT = int(os.environ.get('SQL_TOP_LIMIT', 20))
+# Keys GET /internal/queries can sort on, all descending
+SQL_TOP_SORT_KEYS = ("total_ms", "calls", "mean_ms", "max_ms", "rows")
+
+OTHER_FINGERPRINT = "<other>"
+# Route of requests matching no route, as in metrics.request_metrics
+UNMATCHED_ROUTE = "unmatched"
+# Statements with a plan worth logging
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+# Savepoint the plan of a slow statement is read in, on PostgreSQL
+EXPLAIN_SAVEPOINT = "sql_profiler_explain"
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|:\w+|\$\d+|\?")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_SPACE = re.compile(r"\s+")
+
+_current_request = ContextVar("sql_request_profile", default=None)
+
+
+@lru_cache(maxsize=4096)
+def fingerprint(statement):
+    """
+    Statement text with its literals and placeholders replaced by ?, IN
+    lists of any length collapsed to (...), so every run of a query
+    shares one fingerprint whatever its parameters
+    """
+    statement = _STRING.sub("?", statement)
+    statement = _PLACEHOLDER.sub("?", statement)
+    statement = _NUMBER.sub("?", statement)
+    statement = _PLACEHOLDER_LIST.sub("(...)", statement)
+    return _SPACE.sub(" ", statement).strip()
+
+
+class FingerprintStats:
+    __slots__ = ("calls", "total_time", "max_time", "rows", "last_explained")
+
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.last_explained = None
+
+    def as_dict(self, statement):
+        return {
+            "fingerprint": statement,
+            "calls": self.calls,
+            "total_ms": round(self.total_time * 1000, 3),
+            "mean_ms": round(self.total_time / self.calls * 1000, 3),
+            "max_ms": round(self.max_time * 1000, 3),
+            "rows": self.rows
+        }
+
+
+class RequestProfile:
+    """Statements of the current request"""
+    __slots__ = ("queries", "rows", "fingerprints", "streaming")
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.fingerprints = Counter()
+        # Kept current past teardown until the streamed body is sent
+        self.streaming = False
+
+
+class SQLProfiler:
+    """
+    Cumulative time, calls and rows of every statement fingerprint run on
+    the attached engines; logs the slow ones with their plan and flags
+    requests running more statements than the budget
+    """
+
+    def __init__(self, slow_query_ms=SQL_SLOW_QUERY_MS,
+                 explain_interval=SQL_EXPLAIN_INTERVAL,
+                 query_budget=SQL_QUERY_BUDGET,
+                 max_fingerprints=SQL_MAX_FINGERPRINTS,
+                 clock=time.monotonic):
+        self.slow_query_seconds = slow_query_ms / 1000
+        self.explain_interval = explain_interval
+        self.query_budget = query_budget
+        self.max_fingerprints = max_fingerprints
+        self.clock = clock
+
+        self.slow_queries = 0
+        self.over_budget = Counter()
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def attach(self, engine):
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+
+    def detach(self, engine):
+        event.remove(engine, "before_cursor_execute", self._before_execute)
+        event.remove(engine, "after_cursor_execute", self._after_execute)
+
+    def top(self, limit=SQL_TOP_LIMIT, sort="total_ms"):
+        """The limit costliest fingerprints, as dicts sorted on sort"""
+        with self._lock:
+            rows = [stats.as_dict(statement)
+                    for statement, stats in self._stats.items()]
+        rows.sort(key=lambda row: row[sort], reverse=True)
+        return rows[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.over_budget.clear()
+            self.slow_queries = 0
+
+    # Requests
+
+    def start_request(self):
+        _current_request.set(RequestProfile())
+
+    def finish_request(self, route, method, profile=None):
+        """
+        Returns the profile of the request, the current one unless given,
+        logs it when it ran more statements than the budget
+        """
+        if profile is None:
+            profile = _current_request.get()
+        if _current_request.get() is profile:
+            _current_request.set(None)
+        if profile is None:
+            return None
+
+        if self.query_budget and profile.queries > self.query_budget:
+            with self._lock:
+                self.over_budget[(method, route)] += 1
+            repeated, count = profile.fingerprints.most_common(1)[0]
+            logger.warning(
+                "%s %s ran %d SQL statements (budget %d), most repeated "
+                "%d times: %s", method, route, profile.queries,
+                self.query_budget, count, repeated)
+
+        return profile
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                "fingerprints": len(self._stats),
+                "slow_queries": self.slow_queries,
+                "slow_query_ms": self.slow_query_seconds * 1000,
+                "query_budget": self.query_budget,
+                "over_budget": [
+                    {"method": method, "route": route, "requests": count}
+                    for (method, route), count
+                    in self.over_budget.most_common()
+                ]
+            }
+
+    # Engine events
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        conn.info["profiler_start"] = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        start = conn.info.pop("profiler_start", None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+
+        key = fingerprint(statement)
+        # Drivers report -1 when they do not know, e.g. SQLite selects
+        rows = max(cursor.rowcount, 0)
+
+        profile = _current_request.get()
+        if profile is not None:
+            profile.queries += 1
+            profile.rows += rows
+            profile.fingerprints[key] += 1
+
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                if len(self._stats) >= self.max_fingerprints:
+                    key = OTHER_FINGERPRINT
+                stats = self._stats.setdefault(key, FingerprintStats())
+            stats.calls += 1
+            stats.total_time += elapsed
+            stats.max_time = max(stats.max_time, elapsed)
+            stats.rows += rows
+
+            slow = elapsed >= self.slow_query_seconds
+            explain = slow and not executemany and (
+                stats.last_explained is None
+                or self.clock() - stats.last_explained
+                >= self.explain_interval)
+            if slow:
+                self.slow_queries += 1
+            if explain:
+                stats.last_explained = self.clock()
+
+        if slow:
+            plan = explain_plan(conn, statement, parameters) \
+                if explain else None
+            logger.warning("slow SQL statement (%.1f ms): %s%s",
+                           elapsed * 1000, key,
+                           "\n" + plan if plan else "")
+
+    def __repr__(self):
+        return "<SQLProfiler(fingerprints={}, slow_queries={})>".format(
+            len(self._stats), self.slow_queries)
+
+
+def explain_plan(conn, statement, parameters):
+    """
+    Plan of a statement, run on a separate cursor of the same connection;
+    None when the statement or the dialect has no plan to show
+    On PostgreSQL a failed EXPLAIN would abort the request's transaction,
+    so it runs in a savepoint rolled back on error
+    """
+    if not statement.lstrip().upper().startswith(EXPLAINABLE):
+        return None
+
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    elif dialect == "postgresql":
+        prefix = "EXPLAIN "
+    else:
+        return None
+
+    savepoint = dialect == "postgresql"
+    cursor = conn.connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute("SAVEPOINT " + EXPLAIN_SAVEPOINT)
+        try:
+            cursor.execute(prefix + statement, parameters)
+            plan = "\n".join(" ".join(str(column) for column in row)
+                             for row in cursor.fetchall())
+        except Exception:
+            if savepoint:
+                cursor.execute("ROLLBACK TO SAVEPOINT " + EXPLAIN_SAVEPOINT)
+            plan = None
+        if savepoint:
+            cursor.execute("RELEASE SAVEPOINT " + EXPLAIN_SAVEPOINT)
+        return plan
+    except Exception:
+        logger.exception("could not explain %s", fingerprint(statement))
+        return None
+    finally:
+        cursor.close()
+
+
+# Request hooks, shared by the Flask app and the Quart views of async_app
+
+
+def start_request_profile(profiler):
+    profiler.start_request()
+
+
+def request_labels(current_request):
+    rule = current_request.url_rule
+    return (rule.rule if rule is not None else UNMATCHED_ROUTE,
+            current_request.method)
+
+
+def defer_streamed_profile(profiler, current_request, response):
+    """
+    A streamed body, e.g. /export/* or a large list page, runs its queries
+    after teardown: its profile is finished once the server closes it
+    """
+    profile = _current_request.get()
+    if profile is None or not getattr(response, "is_streamed", False):
+        return response
+
+    profile.streaming = True
+    labels = request_labels(current_request)
+    response.call_on_close(
+        lambda: profiler.finish_request(*labels, profile=profile))
+    return response
+
+
+def finish_request_profile(profiler, current_request):
+    profile = _current_request.get()
+    if profile is not None and profile.streaming:
+        return
+    profiler.finish_request(*request_labels(current_request))
+
+
+def init_sql_profiler(app, engines):
+    """
+    Profiles the statements run on the engines and by each request of a
+    Flask app, the profiler is kept in app.extensions['sql_profiler']
+    """
+    profiler = SQLProfiler(
+        slow_query_ms=float(app.config.get(
+            "SQL_SLOW_QUERY_MS", SQL_SLOW_QUERY_MS)),
+        explain_interval=float(app.config.get(
+            "SQL_EXPLAIN_INTERVAL", SQL_EXPLAIN_INTERVAL)),
+        query_budget=int(app.config.get(
+            "SQL_QUERY_BUDGET", SQL_QUERY_BUDGET)))
+    app.extensions['sql_profiler'] = profiler
+
+    if not app.config.get("SQL_PROFILER", SQL_PROFILER):
+        return profiler
+
+    for engine in engines:
+        profiler.attach(engine)
+
+    @app.before_request
+    def start_profile():
+        start_request_profile(profiler)
+
+    @app.after_request
+    def defer_streamed(response):
+        return defer_streamed_profile(profiler, request, response)
+
+    @app.teardown_request
+    def finish_profile(exc):
+        finish_request_profile(profiler, request)
+
+    return profiler
@@ -0,0 +1,74 @@
+import os
+from contextlib import contextmanager
+
+from flask import current_app, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+
+from .pool import engine_options
+
+# Key of the replica engine in app.extensions
+REPLICA_EXTENSION = "sqlalchemy_replica"
+# Set after a write, keeps that client's reads on the primary for a while
+READ_PRIMARY_COOKIE = "read_primary"
+READ_YOUR_WRITES_WINDOW = int(os.environ.get('READ_YOUR_WRITES_WINDOW', 5))
+
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class RoutingSession(Session):
+    """
+    Session sending reads to the replica when use_replica is set in its info
+    Flushes, and every session without the flag, use the primary
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get("use_replica") \
+                and not self._flushing:
+            engine = current_app.extensions.get(REPLICA_EXTENSION)
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+
+@contextmanager
+def primary_reads(session):
+    """Sends the reads of the block to the primary, e.g. to fill a cache"""
+    use_replica = session.info.pop("use_replica", None)
+    try:
+        yield
+    finally:
+        if use_replica is not None:
+            session.info["use_replica"] = use_replica
+
+
+def get_replica_engine(app):
+    return app.extensions.get(REPLICA_EXTENSION)
+
+
+def init_replica_routing(app, db, replica_path):
+    """
+    Creates the replica engine and routes the reads of GET requests to it
+    A client that just wrote gets a short-lived cookie keeping its reads on
+    the primary, so it always sees its own writes
+    The replica is not a Flask-SQLAlchemy bind: no model lives only there
+    and create_all/drop_all must keep targeting the primary
+    """
+    app.extensions[REPLICA_EXTENSION] = create_engine(
+        replica_path, **engine_options(app.config, replica_path))
+
+    @app.before_request
+    def use_replica_for_reads():
+        if request.method in READ_METHODS \
+                and READ_PRIMARY_COOKIE not in request.cookies:
+            db.session.info["use_replica"] = True
+
+    @app.after_request
+    def read_your_writes(response):
+        if request.method not in READ_METHODS and response.status_code < 400:
+            response.set_cookie(READ_PRIMARY_COOKIE, "1",
+                                max_age=READ_YOUR_WRITES_WINDOW,
+                                httponly=True, samesite="Lax")
+        return response
@@ -0,0 +1,156 @@
+import os
+import re
+
+from sqlalchemy import and_, event, or_, text
+
+from .models import db, Actor, Movie
+
+SEARCH_DEFAULT_LIMIT = int(os.environ.get('SEARCH_DEFAULT_LIMIT', 20))
+SEARCH_MAX_LIMIT = int(os.environ.get('SEARCH_MAX_LIMIT', 100))
+# Words of a query beyond this number are ignored
+SEARCH_MAX_TERMS = 8
+
+# SQLite: external content FTS5 tables kept in sync by triggers
+SQLITE_SEARCH_INDEX = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS actors_fts USING fts5("
+    "name, full_name, content='actors', content_rowid='id', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS actors_fts_insert AFTER INSERT ON actors "
+    "BEGIN INSERT INTO actors_fts(rowid, name, full_name) "
+    "VALUES (new.id, new.name, new.full_name); END",
+    "CREATE TRIGGER IF NOT EXISTS actors_fts_delete AFTER DELETE ON actors "
+    "BEGIN INSERT INTO actors_fts(actors_fts, rowid, name, full_name) "
+    "VALUES ('delete', old.id, old.name, old.full_name); END",
+    "CREATE TRIGGER IF NOT EXISTS actors_fts_update "
+    "AFTER UPDATE OF name, full_name ON actors "
+    "BEGIN INSERT INTO actors_fts(actors_fts, rowid, name, full_name) "
+    "VALUES ('delete', old.id, old.name, old.full_name); "
+    "INSERT INTO actors_fts(rowid, name, full_name) "
+    "VALUES (new.id, new.name, new.full_name); END",
+    "INSERT INTO actors_fts(actors_fts) VALUES ('rebuild')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS movies_fts USING fts5("
+    "title, content='movies', content_rowid='id', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS movies_fts_insert AFTER INSERT ON movies "
+    "BEGIN INSERT INTO movies_fts(rowid, title) "
+    "VALUES (new.id, new.title); END",
+    "CREATE TRIGGER IF NOT EXISTS movies_fts_delete AFTER DELETE ON movies "
+    "BEGIN INSERT INTO movies_fts(movies_fts, rowid, title) "
+    "VALUES ('delete', old.id, old.title); END",
+    "CREATE TRIGGER IF NOT EXISTS movies_fts_update "
+    "AFTER UPDATE OF title ON movies "
+    "BEGIN INSERT INTO movies_fts(movies_fts, rowid, title) "
+    "VALUES ('delete', old.id, old.title); "
+    "INSERT INTO movies_fts(rowid, title) VALUES (new.id, new.title); END",
+    "INSERT INTO movies_fts(movies_fts) VALUES ('rebuild')",
+)
+
+SQLITE_DROP_SEARCH_INDEX = (
+    "DROP TABLE IF EXISTS actors_fts",
+    "DROP TABLE IF EXISTS movies_fts",
+)
+
+# PostgreSQL: GIN indexes on the same expressions as the queries below
+POSTGRES_SEARCH_INDEX = (
+    "CREATE INDEX IF NOT EXISTS ix_actors_search ON actors USING gin "
+    "(to_tsvector('simple', name || ' ' || full_name))",
+    "CREATE INDEX IF NOT EXISTS ix_movies_search ON movies USING gin "
+    "(to_tsvector('simple', title))",
+)
+
+SEARCH_QUERIES = {
+    "sqlite": {
+        "actors": text(
+            "SELECT actors.id, actors.name, actors.full_name FROM ("
+            "SELECT rowid, bm25(actors_fts, 10.0, 1.0) AS rank "
+            "FROM actors_fts WHERE actors_fts MATCH :query "
+            "ORDER BY rank, rowid LIMIT :limit) AS hits "
+            "JOIN actors ON actors.id = hits.rowid "
+            "ORDER BY hits.rank, actors.id"),
+        "movies": text(
+            "SELECT movies.id, movies.title, movies.release_year FROM ("
+            "SELECT rowid, bm25(movies_fts) AS rank "
+            "FROM movies_fts WHERE movies_fts MATCH :query "
+            "ORDER BY rank, rowid LIMIT :limit) AS hits "
+            "JOIN movies ON movies.id = hits.rowid "
+            "ORDER BY hits.rank, movies.id"),
+    },
+    "postgresql": {
+        "actors": text(
+            "SELECT id, name, full_name "
+            "FROM actors, to_tsquery('simple', :query) AS query "
+            "WHERE to_tsvector('simple', name || ' ' || full_name) @@ query "
+            "ORDER BY ts_rank(to_tsvector('simple', "
+            "name || ' ' || full_name), query) DESC, id LIMIT :limit"),
+        "movies": text(
+            "SELECT id, title, release_year "
+            "FROM movies, to_tsquery('simple', :query) AS query "
+            "WHERE to_tsvector('simple', title) @@ query "
+            "ORDER BY ts_rank(to_tsvector('simple', title), query) DESC, id "
+            "LIMIT :limit"),
+    },
+}
+
+
+def search_terms(q):
+    """The words of a search query, punctuation and operators dropped"""
+    return re.findall(r"\w+", q or "")[:SEARCH_MAX_TERMS]
+
+
+def match_query(dialect, terms):
+    """Every term must match the start of a word"""
+    if dialect == "sqlite":
+        return " ".join('"{}"*'.format(term) for term in terms)
+    return " & ".join("{}:*".format(term) for term in terms)
+
+
+@event.listens_for(db.metadata, "after_create")
+def create_search_index(target, connection, **kwargs):
+    statements = {
+        "sqlite": SQLITE_SEARCH_INDEX,
+        "postgresql": POSTGRES_SEARCH_INDEX,
+    }.get(connection.dialect.name, ())
+
+    for statement in statements:
+        connection.exec_driver_sql(statement)
+
+
+@event.listens_for(db.metadata, "before_drop")
+def drop_search_index(target, connection, **kwargs):
+    # PostgreSQL drops the indexes with their tables
+    if connection.dialect.name == "sqlite":
+        for statement in SQLITE_DROP_SEARCH_INDEX:
+            connection.exec_driver_sql(statement)
+
+
+def unindexed_search(kind, terms, limit):
+    """Substring scan for databases without a search index"""
+    if kind == "actors":
+        query = Actor.short_info_query().add_columns(Actor.full_name) \
+            .filter(and_(*(or_(Actor.name.ilike("%{}%".format(term)),
+                               Actor.full_name.ilike("%{}%".format(term)))
+                           for term in terms)))
+    else:
+        query = Movie.short_info_query().filter(
+            and_(*(Movie.title.ilike("%{}%".format(term))
+                   for term in terms)))
+
+    return query.order_by("id").limit(limit)
+
+
+def search(kind, terms, limit):
+    """
+    Ranked matches of kind ("actors" or "movies") for terms, the best first
+    Actors match on name and full name, movies on title
+    Every match is ranked, only the best limit are joined to their rows
+    """
+    dialect = db.session.get_bind().dialect.name
+    queries = SEARCH_QUERIES.get(dialect)
+
+    if queries is None:
+        rows = unindexed_search(kind, terms, limit)
+    else:
+        rows = db.session.execute(queries[kind], {
+            "query": match_query(dialect, terms),
+            "limit": limit
+        })
+
+    return [row._asdict() for row in rows]
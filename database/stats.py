@@ -0,0 +1,211 @@
+from sqlalchemy import (
+    Column, Float, ForeignKey, Integer, delete, event, func, insert, select)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import attributes
+
+from .models import db, Actor, ActorInMovie, Movie
+from .routing import RoutingSession
+
+# Keys refreshed per statement, keeps IN lists under SQLite's variable limit
+STATS_REFRESH_CHUNK_SIZE = 500
+
+# Dialects with INSERT ... ON CONFLICT DO UPDATE
+UPSERT_DIALECTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+# First key of the PostgreSQL advisory locks taken on each summary's keys
+STATS_LOCK_NAMESPACES = {"actors": 7101, "release_years": 7102}
+
+
+class ActorStats(db.Model):
+    """
+    Summary of the movies of each actor cast in at least one, refreshed in
+    the transaction of every write changing it
+    """
+    __tablename__ = "actor_stats"
+
+    actor_id = Column(Integer, ForeignKey("actors.id", ondelete="CASCADE"),
+                      primary_key=True)
+    movie_count = Column(Integer, nullable=False, index=True)
+    total_duration = Column(Integer, nullable=False, index=True)
+    rating_sum = Column(Float, nullable=False)
+
+    def __repr__(self):
+        return "<ActorStats(actor_id={}, movie_count={})>".format(
+            self.actor_id, self.movie_count)
+
+
+class ReleaseYearStats(db.Model):
+    """Summary of the movies of each release year"""
+    __tablename__ = "release_year_stats"
+
+    release_year = Column(Integer, primary_key=True)
+    movie_count = Column(Integer, nullable=False)
+    total_duration = Column(Integer, nullable=False)
+    rating_sum = Column(Float, nullable=False)
+
+    def __repr__(self):
+        return "<ReleaseYearStats(release_year={}, movie_count={})>".format(
+            self.release_year, self.movie_count)
+
+
+def actor_stats_select(actor_ids=None):
+    query = select(
+        ActorInMovie.actor_id, func.count(), func.sum(Movie.duration),
+        func.sum(Movie.imdb_rating)
+    ).join(Movie, Movie.id == ActorInMovie.movie_id)
+
+    if actor_ids is not None:
+        query = query.where(ActorInMovie.actor_id.in_(actor_ids))
+    return query.group_by(ActorInMovie.actor_id)
+
+
+def release_year_stats_select(release_years=None):
+    query = select(
+        Movie.release_year, func.count(), func.sum(Movie.duration),
+        func.sum(Movie.imdb_rating))
+
+    if release_years is not None:
+        query = query.where(Movie.release_year.in_(release_years))
+    return query.group_by(Movie.release_year)
+
+
+# Summary table, its key, the column the key is grouped on and the query
+SUMMARIES = {
+    "actors": (ActorStats, ActorStats.actor_id, ActorInMovie.actor_id,
+               actor_stats_select),
+    "release_years": (ReleaseYearStats, ReleaseYearStats.release_year,
+                      Movie.release_year, release_year_stats_select),
+}
+
+
+def lock_keys(connection, name, keys):
+    """
+    Transaction-level advisory locks on sorted keys, so two writers always
+    take them in the same order and cannot deadlock
+    """
+    if connection.dialect.name != "postgresql" or not keys:
+        return
+    key = func.unnest(postgresql.array(keys)).column_valued("key")
+    connection.execute(
+        select(func.pg_advisory_xact_lock(STATS_LOCK_NAMESPACES[name], key))
+        .order_by(key))
+
+
+def refresh_summary(connection, name, keys):
+    """
+    Recomputes the summary rows of the given keys with one GROUP BY per
+    chunk; keys left without any movie lose their row
+    On PostgreSQL each key is first locked until the end of the
+    transaction: a refresh running alongside another write of the same key
+    waits for its commit, then recomputes from both instead of overwriting
+    it with a total that missed it. SQLite serializes writers anyway
+    """
+    model, key, source_key, summary_select = SUMMARIES[name]
+    table = model.__table__
+    columns = [column.name for column in table.columns]
+    dialect_insert = UPSERT_DIALECTS.get(connection.dialect.name)
+
+    keys = sorted(key_value for key_value in keys if key_value is not None)
+    for start in range(0, len(keys), STATS_REFRESH_CHUNK_SIZE):
+        chunk = keys[start:start + STATS_REFRESH_CHUNK_SIZE]
+        lock_keys(connection, name, chunk)
+
+        if dialect_insert is None:
+            connection.execute(delete(table).where(key.in_(chunk)))
+            connection.execute(insert(table).from_select(
+                columns, summary_select(chunk)))
+            continue
+
+        statement = dialect_insert(table).from_select(
+            columns, summary_select(chunk))
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[key.name],
+            set_={column: statement.excluded[column]
+                  for column in columns if column != key.name}))
+        connection.execute(delete(table).where(
+            key.in_(chunk),
+            key.not_in(select(source_key).where(source_key.in_(chunk)))))
+
+
+def refresh_all_stats(connection):
+    """Rebuilds every summary, e.g. from a scheduled job"""
+    for name, (model, _, _, summary_select) in SUMMARIES.items():
+        table = model.__table__
+        connection.execute(delete(table))
+        connection.execute(insert(table).from_select(
+            [column.name for column in table.columns], summary_select()))
+
+
+# Write tracking
+# Flushes and bulk statements record the keys they touch in the session,
+# the summaries of those keys are refreshed right before the commit
+
+
+def stale_keys(session):
+    return session.info.setdefault("stale_stats", {
+        "actors": set(), "release_years": set(), "movies": set()})
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def track_flushed_changes(session, flush_context):
+    stale = stale_keys(session)
+
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, Movie):
+            stale["release_years"].add(obj.release_year)
+        elif isinstance(obj, ActorInMovie):
+            stale["actors"].add(obj.actor_id)
+        elif isinstance(obj, Actor) and obj in session.deleted:
+            stale["actors"].add(obj.id)
+
+    for obj in session.dirty:
+        if not isinstance(obj, Movie):
+            continue
+
+        changed = False
+        for name in ("release_year", "duration", "imdb_rating"):
+            history = attributes.get_history(obj, name)
+            if history.has_changes():
+                changed = True
+                stale["release_years"].update(history.deleted)
+        if changed:
+            # The totals of its cast change too
+            stale["release_years"].add(obj.release_year)
+            stale["movies"].add(obj.id)
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def track_bulk_links(orm_execute_state):
+    """insert(ActorInMovie) executemany, as in POST /movies/bulk"""
+    state = orm_execute_state
+    if not state.is_insert or state.bind_mapper is not ActorInMovie.__mapper__:
+        return
+
+    parameters = state.parameters
+    if isinstance(parameters, dict):
+        parameters = [parameters]
+    stale_keys(state.session)["actors"].update(
+        row.get("actor_id") for row in parameters or ())
+
+
+@event.listens_for(RoutingSession, "before_commit")
+def refresh_stale_stats(session):
+    # before_commit runs ahead of the last flush
+    session.flush()
+    stale = session.info.pop("stale_stats", None)
+    if not stale or not any(stale.values()):
+        return
+
+    connection = session.connection()
+    if stale["movies"]:
+        stale["actors"].update(actor_id for actor_id, in connection.execute(
+            select(ActorInMovie.actor_id).distinct().where(
+                ActorInMovie.movie_id.in_(stale["movies"]))))
+
+    refresh_summary(connection, "actors", stale["actors"])
+    refresh_summary(connection, "release_years", stale["release_years"])
+
+
+@event.listens_for(RoutingSession, "after_soft_rollback")
+def forget_stale_stats(session, previous_transaction):
+    session.info.pop("stale_stats", None)
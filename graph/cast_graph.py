@@ -0,0 +1,205 @@
+import os
+import threading
+
+from sqlalchemy import select
+
+from database.models import db, ActorInMovie, TableVersion
+
+# Largest number of movies between two actors looked for by separation
+GRAPH_MAX_DEGREES = int(os.environ.get('GRAPH_MAX_DEGREES', 6))
+# Links read per round trip when the graph is (re)loaded
+GRAPH_LOAD_BATCH_SIZE = 10000
+
+CAST_TABLE = "actor_in_movie"
+
+
+def written_version():
+    """
+    The actor_in_movie counter as bumped by the current transaction, read
+    before it commits and handed to CastGraph.apply_write
+    """
+    return TableVersion.current(CAST_TABLE)
+
+
+class CastGraph:
+    """
+    In-memory adjacency of the actor - movie graph, one per worker
+    Loaded from actor_in_movie on first use, then kept current by the write
+    handlers through apply_write; a write made by another worker shows up
+    as an actor_in_movie counter this graph did not account for, and the
+    next refresh reloads it
+    """
+
+    def __init__(self):
+        self.movies_of = {}
+        self.actors_of = {}
+        self.version = None
+        self.loads = 0
+        self._lock = threading.RLock()
+
+    def load(self, links, version):
+        movies_of = {}
+        actors_of = {}
+        for actor_id, movie_id in links:
+            movies_of.setdefault(actor_id, set()).add(movie_id)
+            actors_of.setdefault(movie_id, set()).add(actor_id)
+
+        with self._lock:
+            self.movies_of = movies_of
+            self.actors_of = actors_of
+            self.version = version
+            self.loads += 1
+
+    def refresh(self):
+        """
+        Reloads the graph if actor_in_movie moved past it, reading the
+        primary: a lagging replica would flip it between two versions
+        """
+        primary = {"bind": db.engine}
+        version = db.session.execute(
+            select(TableVersion.version).filter_by(table_name=CAST_TABLE),
+            bind_arguments=primary).scalar() or 0
+        with self._lock:
+            if self.version is not None and version <= self.version:
+                return
+
+            self.load(db.session.execute(
+                select(ActorInMovie.actor_id, ActorInMovie.movie_id)
+                .execution_options(yield_per=GRAPH_LOAD_BATCH_SIZE),
+                bind_arguments=primary), version)
+
+    def apply_write(self, version, added=(), removed=(), actor_ids=(),
+                    movie_ids=()):
+        """
+        Applies one committed transaction that changed actor_in_movie:
+        added and removed (actor_id, movie_id) links, deleted actors and
+        deleted movies; version is the counter it wrote, see
+        written_version. Unless it is the very next one the graph missed
+        or already loaded writes, and is reloaded on next use instead
+        """
+        with self._lock:
+            if self.version is None:
+                return
+            if version != self.version + 1:
+                self.version = None
+                return
+
+            for actor_id, movie_id in removed:
+                self._unlink(actor_id, movie_id)
+            for actor_id in actor_ids:
+                for movie_id in list(self.movies_of.get(actor_id, ())):
+                    self._unlink(actor_id, movie_id)
+            for movie_id in movie_ids:
+                for actor_id in list(self.actors_of.get(movie_id, ())):
+                    self._unlink(actor_id, movie_id)
+            for actor_id, movie_id in added:
+                self.movies_of.setdefault(actor_id, set()).add(movie_id)
+                self.actors_of.setdefault(movie_id, set()).add(actor_id)
+
+            self.version = version
+
+    def _unlink(self, actor_id, movie_id):
+        for adjacency, node, other in ((self.movies_of, actor_id, movie_id),
+                                       (self.actors_of, movie_id, actor_id)):
+            neighbours = adjacency.get(node)
+            if neighbours is not None:
+                neighbours.discard(other)
+                if not neighbours:
+                    del adjacency[node]
+
+    def co_stars(self, actor_id):
+        """{co-star id: number of shared movies}"""
+        counts = {}
+        with self._lock:
+            for movie_id in self.movies_of.get(actor_id, ()):
+                for co_star_id in self.actors_of[movie_id]:
+                    if co_star_id != actor_id:
+                        counts[co_star_id] = counts.get(co_star_id, 0) + 1
+        return counts
+
+    def shared_actors(self, movie_id, other_movie_id):
+        with self._lock:
+            return self.actors_of.get(movie_id, set()) \
+                & self.actors_of.get(other_movie_id, set())
+
+    def separation(self, actor_id, other_actor_id,
+                   max_degrees=GRAPH_MAX_DEGREES):
+        """
+        Shortest chain [actor, movie, actor, ..., movie, actor] between two
+        actors, found by a BFS growing from both ends one degree at a time
+        (the smaller frontier first), None past max_degrees movies
+        """
+        if actor_id == other_actor_id:
+            return [actor_id]
+
+        with self._lock:
+            # actor id -> (previous actor id, movie id) towards each end
+            parents = ({actor_id: None}, {other_actor_id: None})
+            frontiers = ([actor_id], [other_actor_id])
+            seen_movies = (set(), set())
+            degrees = 0
+
+            while frontiers[0] and frontiers[1] and degrees < max_degrees:
+                side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+                found, frontier = self._expand(
+                    frontiers[side], parents[side], parents[1 - side],
+                    seen_movies[side])
+                if found is not None:
+                    return self._chain(found, parents)
+
+                frontiers = (frontier, frontiers[1]) if side == 0 \
+                    else (frontiers[0], frontier)
+                degrees += 1
+
+        return None
+
+    def _expand(self, frontier, parents, other_parents, seen_movies):
+        """Grows one side by one movie, returns (meeting actor, frontier)"""
+        next_frontier = []
+        for actor_id in frontier:
+            for movie_id in self.movies_of.get(actor_id, ()):
+                if movie_id in seen_movies:
+                    continue
+                seen_movies.add(movie_id)
+
+                for co_star_id in self.actors_of[movie_id]:
+                    if co_star_id in parents:
+                        continue
+                    parents[co_star_id] = (actor_id, movie_id)
+                    if co_star_id in other_parents:
+                        return co_star_id, next_frontier
+                    next_frontier.append(co_star_id)
+
+        return None, next_frontier
+
+    @staticmethod
+    def _chain(meeting_id, parents):
+        forward, backward = parents
+        chain = [meeting_id]
+
+        node = meeting_id
+        while forward[node] is not None:
+            node, movie_id = forward[node]
+            chain[:0] = [node, movie_id]
+
+        node = meeting_id
+        while backward[node] is not None:
+            node, movie_id = backward[node]
+            chain.extend([movie_id, node])
+
+        return chain
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                "actors": len(self.movies_of),
+                "movies": len(self.actors_of),
+                "links": sum(len(movies) for movies in self.movies_of.values()),
+                "version": self.version,
+                "loads": self.loads
+            }
+
+    def __repr__(self):
+        return "<CastGraph(version={}, loads={})>".format(
+            self.version, self.loads)
@@ -2,12 +2,49 @@ from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
+from database.catalogue import (
+    CAST_MAX, CAST_MIN, CAST_MODE, POPULARITY_EXPONENT, CatalogueGenerator,
+    load_catalogue, write_catalogue)
 from database.models import db
+from database.stats import refresh_all_stats
 
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def refresh_stats():
+    """Rebuilds the summary tables behind GET /stats, e.g. from cron"""
+    with db.engine.begin() as connection:
+        refresh_all_stats(connection)
+
+
+@manager.option('--output', default=None,
+                help='directory of CSV files to write instead of seeding')
+@manager.option('--seed', type=int, default=0)
+@manager.option('--popularity', type=float, default=POPULARITY_EXPONENT,
+                help='power-law exponent of actor popularity')
+@manager.option('--cast-mode', dest='cast_mode', type=int, default=CAST_MODE)
+@manager.option('--cast-max', dest='cast_max', type=int, default=CAST_MAX)
+@manager.option('--cast-min', dest='cast_min', type=int, default=CAST_MIN)
+@manager.option('--movies', type=int, default=50000)
+@manager.option('--actors', type=int, default=100000)
+def generate_catalogue(actors, movies, cast_min, cast_max, cast_mode,
+                       popularity, seed, output):
+    """Seeds empty tables with a synthetic catalogue, the same for a seed"""
+    generator = CatalogueGenerator(actors, movies, cast_min, cast_max,
+                                   cast_mode, popularity, seed)
+    if output:
+        counts = write_catalogue(generator, output)
+    else:
+        with db.engine.begin() as connection:
+            counts = load_catalogue(connection, generator)
+
+    for table_name, count in counts.items():
+        print("{}: {} rows".format(table_name, count))
+
+
 if __name__ == '__main__':
     manager.run()
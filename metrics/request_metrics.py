@@ -0,0 +1,268 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from database.pool import Histogram
+
+# REQUEST_METRICS=false turns the per-request timing off
+REQUEST_METRICS = os.environ.get(
+    'REQUEST_METRICS', 'true').lower() in ('1', 'true')
+# SERVER_TIMING=false keeps the timings out of the responses
+SERVER_TIMING = os.environ.get(
+    'SERVER_TIMING', 'true').lower() in ('1', 'true')
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+# Timed phases, the rest of the request is reported as app
+PHASES = ("auth", "db", "serialise")
+
+# Route label of requests matching no route, keeps the label set bounded
+UNMATCHED_ROUTE = "unmatched"
+
+_current_timer = ContextVar("request_timer", default=None)
+
+
+class RequestTimer:
+    """Time spent in each phase of the current request"""
+    __slots__ = ("start", "phases", "queries", "streaming")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+        # Kept current past teardown until the streamed body is sent
+        self.streaming = False
+
+    def server_timing(self, total):
+        """Server-Timing header value, durations in milliseconds"""
+        app_time = max(total - sum(self.phases.values()), 0.0)
+        return ", ".join([
+            "auth;dur={:.2f}".format(self.phases["auth"] * 1000),
+            'db;dur={:.2f};desc="{} queries"'.format(
+                self.phases["db"] * 1000, self.queries),
+            "serialise;dur={:.2f}".format(self.phases["serialise"] * 1000),
+            "app;dur={:.2f}".format(app_time * 1000),
+            "total;dur={:.2f}".format(total * 1000),
+        ])
+
+    def __repr__(self):
+        return "<RequestTimer(queries={})>".format(self.queries)
+
+
+@contextmanager
+def record_phase(name):
+    """Adds the time spent in the block to a phase of the current request"""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.phases[name] += time.perf_counter() - start
+
+
+# Every engine, replicas included, reports its statements to the request
+# running them; outside a timed request the hooks return right away
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement_timer(conn, cursor, statement, parameters, context,
+                          executemany):
+    if _current_timer.get() is not None:
+        conn.info["statement_start"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def stop_statement_timer(conn, cursor, statement, parameters, context,
+                         executemany):
+    timer = _current_timer.get()
+    start = conn.info.pop("statement_start", None)
+    if timer is not None and start is not None:
+        timer.phases["db"] += time.perf_counter() - start
+        timer.queries += 1
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def format_labels(labels):
+    return ",".join('{}="{}"'.format(name, escape_label(value))
+                    for name, value in labels)
+
+
+class RequestMetrics:
+    """
+    Latency histograms per route, method and status, and the cumulative
+    time per phase of each route, rendered in the Prometheus text format
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._phases = {}
+        self._lock = threading.Lock()
+
+    def observe(self, route, method, status, seconds, timer=None):
+        with self._lock:
+            histogram = self._histograms.get((route, method, status))
+            if histogram is None:
+                histogram = Histogram(self.buckets)
+                self._histograms[(route, method, status)] = histogram
+
+            if timer is not None:
+                totals = self._phases.setdefault(
+                    (route, method), dict.fromkeys(PHASES + ("queries",), 0))
+                for name, phase_seconds in timer.phases.items():
+                    totals[name] += phase_seconds
+                totals["queries"] += timer.queries
+
+        histogram.observe(seconds)
+
+    def prometheus(self):
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            phases = sorted((key, dict(totals))
+                            for key, totals in self._phases.items())
+
+        lines = [
+            "# HELP http_request_duration_seconds Request latency.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for (route, method, status), histogram in histograms:
+            labels = [("method", method), ("route", route),
+                      ("status", status)]
+            snapshot = histogram.snapshot
+            for bucket in snapshot["buckets"]:
+                lines.append("http_request_duration_seconds_bucket{{{}}} {}"
+                             .format(format_labels(labels + [
+                                 ("le", bucket["le"])]), bucket["count"]))
+            lines.append("http_request_duration_seconds_sum{{{}}} {}".format(
+                format_labels(labels), snapshot["sum"]))
+            lines.append("http_request_duration_seconds_count{{{}}} {}"
+                         .format(format_labels(labels), snapshot["count"]))
+
+        lines.extend([
+            "# HELP http_request_phase_seconds_total Time spent per phase.",
+            "# TYPE http_request_phase_seconds_total counter",
+        ])
+        for (route, method), totals in phases:
+            for name in PHASES:
+                lines.append("http_request_phase_seconds_total{{{}}} {}"
+                             .format(format_labels([
+                                 ("method", method), ("phase", name),
+                                 ("route", route)]), round(totals[name], 6)))
+
+        lines.extend([
+            "# HELP http_request_queries_total SQL statements executed.",
+            "# TYPE http_request_queries_total counter",
+        ])
+        for (route, method), totals in phases:
+            lines.append("http_request_queries_total{{{}}} {}".format(
+                format_labels([("method", method), ("route", route)]),
+                totals["queries"]))
+
+        return "\n".join(lines) + "\n"
+
+    def __repr__(self):
+        return "<RequestMetrics(series={})>".format(len(self._histograms))
+
+
+# Request hooks, shared by the Flask app and the Quart views of async_app
+
+
+def start_request_timer():
+    _current_timer.set(RequestTimer())
+
+
+def finish_request_timer(metrics, current_request, response,
+                         server_timing=SERVER_TIMING):
+    """
+    Records the request and adds its Server-Timing header
+    A streamed body, e.g. /export/* or a list page, is generated after
+    this hook, along with its queries: it is recorded once the server
+    closes it, without Server-Timing since headers go out first
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        return response
+
+    rule = current_request.url_rule
+    labels = (rule.rule if rule is not None else UNMATCHED_ROUTE,
+              current_request.method, response.status_code)
+
+    if getattr(response, "is_streamed", False):
+        timer.streaming = True
+
+        def record_streamed():
+            metrics.observe(*labels, time.perf_counter() - timer.start, timer)
+            if _current_timer.get() is timer:
+                _current_timer.set(None)
+
+        response.call_on_close(record_streamed)
+        return response
+
+    total = time.perf_counter() - timer.start
+    metrics.observe(*labels, total, timer)
+
+    if server_timing:
+        response.headers["Server-Timing"] = timer.server_timing(total)
+    return response
+
+
+def clear_request_timer(*args):
+    timer = _current_timer.get()
+    if timer is None or not timer.streaming:
+        _current_timer.set(None)
+
+
+def timed_json_response(provider):
+    """Counts the encoding of jsonify responses as the serialise phase"""
+    encode_response = provider.response
+
+    def response(*args, **kwargs):
+        with record_phase("serialise"):
+            return encode_response(*args, **kwargs)
+
+    provider.response = response
+    return provider
+
+
+def init_request_metrics(app):
+    """
+    Times every request of a Flask app, the registry is kept in
+    app.extensions['request_metrics'] for the /metrics endpoint
+    """
+    metrics = RequestMetrics()
+    app.extensions['request_metrics'] = metrics
+
+    if not app.config.get("REQUEST_METRICS", REQUEST_METRICS):
+        return metrics
+
+    server_timing = app.config.get("SERVER_TIMING", SERVER_TIMING)
+    timed_json_response(app.json)
+
+    @app.before_request
+    def start_timer():
+        start_request_timer()
+
+    @app.after_request
+    def record_request(response):
+        return finish_request_timer(metrics, request, response,
+                                    server_timing)
+
+    app.teardown_request(clear_request_timer)
+
+    return metrics
@@ -0,0 +1,63 @@
+"""add the actor and release year summary tables
+
+Revision ID: 4b8d2f6a9c13
+Revises: e71b0c4d9a26
+Create Date: 2026-10-17 18:02:47.331905
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '4b8d2f6a9c13'
+down_revision = 'e71b0c4d9a26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'actor_stats',
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.Column('movie_count', sa.Integer(), nullable=False),
+        sa.Column('total_duration', sa.Integer(), nullable=False),
+        sa.Column('rating_sum', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['actor_id'], ['actors.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('actor_id')
+    )
+    op.create_index(op.f('ix_actor_stats_movie_count'), 'actor_stats',
+                    ['movie_count'], unique=False)
+    op.create_index(op.f('ix_actor_stats_total_duration'), 'actor_stats',
+                    ['total_duration'], unique=False)
+
+    op.create_table(
+        'release_year_stats',
+        sa.Column('release_year', sa.Integer(), nullable=False),
+        sa.Column('movie_count', sa.Integer(), nullable=False),
+        sa.Column('total_duration', sa.Integer(), nullable=False),
+        sa.Column('rating_sum', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('release_year')
+    )
+
+    # Existing rows are summarised once, writes keep the tables current
+    op.execute(
+        "INSERT INTO actor_stats "
+        "(actor_id, movie_count, total_duration, rating_sum) "
+        "SELECT actor_in_movie.actor_id, count(*), sum(movies.duration), "
+        "sum(movies.imdb_rating) FROM actor_in_movie "
+        "JOIN movies ON movies.id = actor_in_movie.movie_id "
+        "GROUP BY actor_in_movie.actor_id")
+    op.execute(
+        "INSERT INTO release_year_stats "
+        "(release_year, movie_count, total_duration, rating_sum) "
+        "SELECT release_year, count(*), sum(duration), sum(imdb_rating) "
+        "FROM movies GROUP BY release_year")
+
+
+def downgrade():
+    op.drop_table('release_year_stats')
+    op.drop_index(op.f('ix_actor_stats_total_duration'),
+                  table_name='actor_stats')
+    op.drop_index(op.f('ix_actor_stats_movie_count'), table_name='actor_stats')
+    op.drop_table('actor_stats')
@@ -0,0 +1,82 @@
+"""add indexes for name lookups, cast loading and list filters
+
+Revision ID: 5a2c7e91d4b3
+Revises: 0f87e8f45ce0
+Create Date: 2026-10-17 10:12:41.318204
+
+"""
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5a2c7e91d4b3'
+down_revision = '0f87e8f45ce0'
+branch_labels = None
+depends_on = None
+
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+
+def rename_duplicate_actors():
+    """
+    Suffixes every namesake but the oldest with its id, e.g. 'Jane Doe'
+    becomes 'Jane Doe (42)', so the unique name index can be built
+    """
+    actors = sa.table('actors',
+                      sa.column('id', sa.Integer),
+                      sa.column('name', sa.String))
+    duplicated = sa.select(actors.c.name).group_by(actors.c.name) \
+        .having(sa.func.count() > 1)
+
+    connection = op.get_bind()
+    seen = set()
+    for actor_id, name in connection.execute(
+            sa.select(actors.c.id, actors.c.name)
+            .where(actors.c.name.in_(duplicated))
+            .order_by(actors.c.name, actors.c.id)):
+        if name not in seen:
+            seen.add(name)
+            continue
+
+        new_name = '{} ({})'.format(name, actor_id)
+        logger.warning("Renaming duplicate actor %d from %r to %r",
+                       actor_id, name, new_name)
+        connection.execute(actors.update()
+                           .where(actors.c.id == actor_id)
+                           .values(name=new_name))
+
+
+def upgrade():
+    # Cast resolution looks actors up by name and rejects ambiguous names,
+    # so the index also enforces that names are unique
+    rename_duplicate_actors()
+    op.create_index(op.f('ix_actors_name'), 'actors', ['name'],
+                    unique=True)
+    op.create_index(op.f('ix_actors_date_of_birth'), 'actors',
+                    ['date_of_birth'], unique=False)
+    # The primary key leads with actor_id, loading a movie's cast needs
+    # an index leading with movie_id
+    op.create_index(op.f('ix_actor_in_movie_movie_id'), 'actor_in_movie',
+                    ['movie_id'], unique=False)
+    op.create_index(op.f('ix_movies_title'), 'movies', ['title'],
+                    unique=False)
+    op.create_index(op.f('ix_movies_release_year'), 'movies',
+                    ['release_year'], unique=False)
+    op.create_index(op.f('ix_movies_imdb_rating'), 'movies',
+                    ['imdb_rating'], unique=False)
+    op.create_index(op.f('ix_movies_duration'), 'movies', ['duration'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_movies_duration'), table_name='movies')
+    op.drop_index(op.f('ix_movies_imdb_rating'), table_name='movies')
+    op.drop_index(op.f('ix_movies_release_year'), table_name='movies')
+    op.drop_index(op.f('ix_movies_title'), table_name='movies')
+    op.drop_index(op.f('ix_actor_in_movie_movie_id'),
+                  table_name='actor_in_movie')
+    op.drop_index(op.f('ix_actors_date_of_birth'), table_name='actors')
+    op.drop_index(op.f('ix_actors_name'), table_name='actors')
@@ -0,0 +1,40 @@
+"""add row versions and table change counters for ETags
+
+Revision ID: 8d4f1b6c2e07
+Revises: 5a2c7e91d4b3
+Create Date: 2026-10-17 14:36:05.920117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '8d4f1b6c2e07'
+down_revision = '5a2c7e91d4b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing rows start at version 1, the ORM bumps it on every update
+    op.add_column('actors', sa.Column('version', sa.Integer(),
+                                      server_default='1', nullable=False))
+    op.add_column('movies', sa.Column('version', sa.Integer(),
+                                      server_default='1', nullable=False))
+
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('table_name', sa.String(length=64), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('table_name')
+    )
+    op.bulk_insert(table_versions, [
+        {'table_name': 'actors', 'version': 0},
+        {'table_name': 'movies', 'version': 0},
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
+    op.drop_column('movies', 'version')
+    op.drop_column('actors', 'version')
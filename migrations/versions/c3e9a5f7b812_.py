@@ -0,0 +1,82 @@
+"""add full-text search indexes on actor names and movie titles
+
+Revision ID: c3e9a5f7b812
+Revises: 8d4f1b6c2e07
+Create Date: 2026-10-17 16:02:47.553861
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c3e9a5f7b812'
+down_revision = '8d4f1b6c2e07'
+branch_labels = None
+depends_on = None
+
+
+SQLITE_UPGRADE = (
+    "CREATE VIRTUAL TABLE actors_fts USING fts5("
+    "name, full_name, content='actors', content_rowid='id', prefix='2 3')",
+    "CREATE TRIGGER actors_fts_insert AFTER INSERT ON actors "
+    "BEGIN INSERT INTO actors_fts(rowid, name, full_name) "
+    "VALUES (new.id, new.name, new.full_name); END",
+    "CREATE TRIGGER actors_fts_delete AFTER DELETE ON actors "
+    "BEGIN INSERT INTO actors_fts(actors_fts, rowid, name, full_name) "
+    "VALUES ('delete', old.id, old.name, old.full_name); END",
+    "CREATE TRIGGER actors_fts_update AFTER UPDATE OF name, full_name ON actors "
+    "BEGIN INSERT INTO actors_fts(actors_fts, rowid, name, full_name) "
+    "VALUES ('delete', old.id, old.name, old.full_name); "
+    "INSERT INTO actors_fts(rowid, name, full_name) "
+    "VALUES (new.id, new.name, new.full_name); END",
+    "INSERT INTO actors_fts(actors_fts) VALUES ('rebuild')",
+    "CREATE VIRTUAL TABLE movies_fts USING fts5("
+    "title, content='movies', content_rowid='id', prefix='2 3')",
+    "CREATE TRIGGER movies_fts_insert AFTER INSERT ON movies "
+    "BEGIN INSERT INTO movies_fts(rowid, title) "
+    "VALUES (new.id, new.title); END",
+    "CREATE TRIGGER movies_fts_delete AFTER DELETE ON movies "
+    "BEGIN INSERT INTO movies_fts(movies_fts, rowid, title) "
+    "VALUES ('delete', old.id, old.title); END",
+    "CREATE TRIGGER movies_fts_update AFTER UPDATE OF title ON movies "
+    "BEGIN INSERT INTO movies_fts(movies_fts, rowid, title) "
+    "VALUES ('delete', old.id, old.title); "
+    "INSERT INTO movies_fts(rowid, title) VALUES (new.id, new.title); END",
+    "INSERT INTO movies_fts(movies_fts) VALUES ('rebuild')",
+)
+
+SQLITE_DOWNGRADE = (
+    "DROP TRIGGER movies_fts_update",
+    "DROP TRIGGER movies_fts_delete",
+    "DROP TRIGGER movies_fts_insert",
+    "DROP TABLE movies_fts",
+    "DROP TRIGGER actors_fts_update",
+    "DROP TRIGGER actors_fts_delete",
+    "DROP TRIGGER actors_fts_insert",
+    "DROP TABLE actors_fts",
+)
+
+POSTGRES_UPGRADE = (
+    "CREATE INDEX ix_actors_search ON actors USING gin "
+    "(to_tsvector('simple', name || ' ' || full_name))",
+    "CREATE INDEX ix_movies_search ON movies USING gin "
+    "(to_tsvector('simple', title))",
+)
+
+POSTGRES_DOWNGRADE = (
+    "DROP INDEX ix_movies_search",
+    "DROP INDEX ix_actors_search",
+)
+
+
+def run(statements_by_dialect):
+    dialect = op.get_bind().dialect.name
+    for statement in statements_by_dialect.get(dialect, ()):
+        op.execute(statement)
+
+
+def upgrade():
+    run({"sqlite": SQLITE_UPGRADE, "postgresql": POSTGRES_UPGRADE})
+
+
+def downgrade():
+    run({"sqlite": SQLITE_DOWNGRADE, "postgresql": POSTGRES_DOWNGRADE})
@@ -0,0 +1,30 @@
+"""add the actor_in_movie change counter
+
+Revision ID: e71b0c4d9a26
+Revises: c3e9a5f7b812
+Create Date: 2026-10-17 17:21:09.104538
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e71b0c4d9a26'
+down_revision = 'c3e9a5f7b812'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Tells each worker's cast graph that another worker changed a cast
+    table_versions = sa.table('table_versions',
+                              sa.column('table_name', sa.String),
+                              sa.column('version', sa.Integer))
+    op.bulk_insert(table_versions, [
+        {'table_name': 'actor_in_movie', 'version': 0},
+    ])
+
+
+def downgrade():
+    op.execute("DELETE FROM table_versions "
+               "WHERE table_name = 'actor_in_movie'")
@@ -0,0 +1,56 @@
+import csv
+import io
+import os
+import zlib
+from datetime import date
+
+from .json_provider import encode
+
+EXPORT_GZIP_LEVEL = int(os.environ.get('EXPORT_GZIP_LEVEL', 6))
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def export_value(value):
+    """Dates are exported in ISO format, as CSV writes them"""
+    return value.isoformat() if isinstance(value, date) else value
+
+
+def ndjson_chunks(provider, keys, batches):
+    """One JSON object per line, one chunk per batch of rows"""
+    for rows in batches:
+        yield b"".join(
+            encode(provider, dict(zip(keys, map(export_value, row)))) + b"\n"
+            for row in rows)
+
+
+def csv_chunks(keys, batches):
+    """A header line, then one chunk per batch of rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(keys)
+
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        # Header of an empty export
+        yield buffer.getvalue().encode()
+
+
+def gzip_chunks(chunks, level=EXPORT_GZIP_LEVEL):
+    """Compresses a stream of chunks on the fly into a single gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
@@ -0,0 +1,103 @@
+import json
+import os
+from itertools import islice
+
+from flask import current_app, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# auto uses orjson when it is installed, stdlib forces Flask's encoder
+JSON_PROVIDER = os.environ.get('JSON_PROVIDER', 'auto')
+# Pages of at least this many rows are streamed instead of built in memory
+JSON_STREAM_MIN_ROWS = int(os.environ.get('JSON_STREAM_MIN_ROWS', 1000))
+# Rows encoded together per streamed chunk
+JSON_STREAM_CHUNK_SIZE = int(os.environ.get('JSON_STREAM_CHUNK_SIZE', 500))
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    DefaultJSONProvider encoding with orjson: keys stay sorted and dates,
+    decimals and UUIDs still go through Flask's default hook
+    """
+
+    def dumps_bytes(self, obj, indent=False):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option)
+
+    def dumps(self, obj, **kwargs):
+        # Only the arguments Flask itself passes are mapped to orjson
+        if set(kwargs) - {"indent", "separators"}:
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj, bool(kwargs.get("indent"))).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) \
+            or self.compact is False
+        return self._app.response_class(
+            self.dumps_bytes(obj, indent) + b"\n", mimetype=self.mimetype)
+
+
+def init_json_provider(app):
+    """Installs the provider selected by JSON_PROVIDER on the app"""
+    name = app.config.get("JSON_PROVIDER", JSON_PROVIDER)
+
+    if name == "orjson" or (name == "auto" and orjson is not None):
+        if orjson is None:
+            raise RuntimeError("JSON_PROVIDER=orjson needs the orjson package")
+        app.json = OrjsonProvider(app)
+    elif name not in ("auto", "stdlib"):
+        raise ValueError("unknown JSON_PROVIDER {}".format(name))
+
+    return app.json
+
+
+def encode(provider, obj):
+    """Compact UTF-8 JSON of obj with the given provider"""
+    if isinstance(provider, OrjsonProvider):
+        return provider.dumps_bytes(obj)
+    return provider.dumps(obj, separators=(",", ":")).encode()
+
+
+def stream_json_object(provider, head, key, rows, tail,
+                       chunk_size=JSON_STREAM_CHUNK_SIZE):
+    """
+    Yields the JSON of {**head, key: [*rows], **tail()} chunk by chunk
+    Only chunk_size rows are encoded at a time, tail is called once the
+    rows are exhausted, for values known at the end such as next_cursor
+    """
+    yield encode(provider, head)[:-1] + b"," + json.dumps(key).encode() + b":["
+
+    rows = iter(rows)
+    separator = b""
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield separator + encode(provider, chunk)[1:-1]
+        separator = b","
+
+    tail = encode(provider, tail())
+    yield (b"]}" if tail == b"{}" else b"]," + tail[1:]) + b"\n"
+
+
+def streamed_json_response(head, key, rows, tail):
+    """Chunked response of stream_json_object, rows may hit the database"""
+    app = current_app._get_current_object()
+    return app.response_class(
+        stream_with_context(stream_json_object(app.json, head, key, rows,
+                                               tail)),
+        mimetype=app.json.mimetype)
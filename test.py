@@ -1,15 +1,137 @@
+import asyncio
+import gzip
 import os
+import tempfile
+import time
 import unittest
 import json
+import rsa
+from unittest import mock
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
+from jose import jwk, jwt
 
 from app import create_app
-from database.models import setup_db, Actor, Movie
+from auth import auth
+from auth.jwks import (
+    JWKSKeyStore, KeySetUnavailable, StaticKeySource, parse_max_age)
+from auth.token_cache import TokenCache
+from cache.response_cache import (
+    ACTOR, LocalCacheBackend, LocalSharedClient, ResponseCache,
+    SharedCacheBackend)
+from database.catalogue import (
+    CatalogueGenerator, load_catalogue, write_catalogue)
+from database.export import export_batches
+from database.filters import ACTOR_FILTERS, parse_filters
+from database.instrumentation import QueryCounter
+from database.models import db, setup_db, unit_of_work, Actor, ActorInMovie, Movie
+from database.pagination import keyset_query
+from database.profiler import explain_plan, fingerprint
+from database.routing import get_replica_engine
+from database.stats import (
+    ActorStats, ReleaseYearStats, actor_stats_select, refresh_all_stats,
+    release_year_stats_select)
+from serialization.json_provider import (
+    OrjsonProvider, init_json_provider, stream_json_object)
+from sqlalchemy import event, text
+from sqlalchemy.orm.exc import StaleDataError
+from datetime import date
 from dotenv import load_dotenv
 
+# The async entry point needs quart and an asyncio database driver
+try:
+    from async_app import create_async_app
+except ImportError:
+    create_async_app = None
+
 basedir = os.path.abspath(os.path.dirname(__file__))
 load_dotenv(os.path.join(basedir, '.env'))
 
+# Locally signed tokens, verified against a stub key set instead of Auth0
+TEST_KID = 'test-key'
+_public_key, _private_key = rsa.newkeys(1024)
+TEST_PRIVATE_KEY = _private_key.save_pkcs1().decode()
+TEST_JWKS = {'keys': [dict(
+    jwk.construct(_public_key.save_pkcs1().decode(), 'RS256').to_dict(),
+    kid=TEST_KID, use='sig')]}
+
+
+def make_token(permissions, expires_in=3600, kid=TEST_KID):
+    now = int(time.time())
+    return jwt.encode({
+        'iss': 'https://{}/'.format(auth.AUTH0_DOMAIN),
+        'aud': auth.API_AUDIENCE,
+        'sub': 'test|user',
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': permissions
+    }, TEST_PRIVATE_KEY, algorithm='RS256', headers={'kid': kid})
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FailingKeySource:
+    def __init__(self, jwks):
+        self.jwks = jwks
+        self.fail = False
+        self.fetch_count = 0
+
+    def fetch(self):
+        self.fetch_count += 1
+        if self.fail:
+            raise OSError('JWKS endpoint unreachable')
+        return self.jwks, None
+
+class SlowKeySource(StaticKeySource):
+    def __init__(self, jwks, delay):
+        super().__init__(jwks)
+        self.delay = delay
+
+    def fetch(self):
+        time.sleep(self.delay)
+        return super().fetch()
+
+
+async def asgi_request(app, method, url, headers=None, body=b''):
+    """Sends one request to an ASGI app, returns (status, headers, body)"""
+    path, _, query_string = url.partition('?')
+    headers = dict(headers or {}, **{'Content-Length': str(len(body))})
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': method, 'scheme': 'http', 'path': path,
+        'raw_path': path.encode(), 'query_string': query_string.encode(),
+        'root_path': '', 'client': ('127.0.0.1', 1),
+        'server': ('localhost', 80),
+        'headers': [(name.lower().encode(), value.encode())
+                    for name, value in headers.items()]
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        # The client stays connected until the response is sent
+        await asyncio.Future()
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    start = sent[0]
+    return (start['status'],
+            {name.decode(): value.decode()
+             for name, value in start['headers']},
+            b''.join(message.get('body', b'') for message in sent[1:]))
+
+
 class CastingAgencyTestCase(unittest.TestCase):
     """This class represents the casting agency test case"""
 
@@ -334,6 +456,1948 @@ class CastingAgencyTestCase(unittest.TestCase):
 
     # End producer
 
+
+class LocalDatabaseTestCase(unittest.TestCase):
+    """Runs the app against an in-memory SQLite database and local tokens"""
+
+    PERMISSIONS = [
+        'get:actors', 'get:actor-by-id', 'get:movies', 'get:movie-by-id',
+        'post:actors', 'patch:actors', 'delete:actors',
+        'post:movies', 'patch:movies', 'delete:movies'
+    ]
+
+    def setUp(self):
+        auth.set_key_source(StaticKeySource(TEST_JWKS))
+        self.app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+        self.client = self.app.test_client
+        self.headers = {
+            'Authorization': 'Bearer {}'.format(make_token(self.PERMISSIONS))
+        }
+
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def seed(self, actors=0, movies=0, cast_size=0):
+        """Adds numbered actors and movies, each movie casting cast_size actors"""
+        with self.app.app_context():
+            db.session.add_all([
+                Actor('Actor {}'.format(i), 'Full Name {}'.format(i),
+                      date(1980, 1, 1 + i % 28))
+                for i in range(actors)
+            ])
+            db.session.add_all([
+                Movie('Movie {}'.format(i), 2000 + i % 20, 90 + i % 60,
+                      5 + i % 5)
+                for i in range(movies)
+            ])
+            db.session.flush()
+            db.session.add_all([
+                ActorInMovie(movie_id, actor_id)
+                for movie_id in range(1, movies + 1)
+                for actor_id in range(1, min(cast_size, actors) + 1)
+            ])
+            db.session.commit()
+
+    def assertMaxQueries(self, max_queries, fn, *args, **kwargs):
+        """Fails if fn issues more than max_queries SQL statements"""
+        with self.app.app_context():
+            engine = db.engine
+        with QueryCounter(engine) as counter:
+            result = fn(*args, **kwargs)
+        self.assertLessEqual(
+            counter.count, max_queries,
+            'expected at most {} queries, got {}:\n{}'.format(
+                max_queries, counter.count, '\n'.join(counter.statements)))
+        return result
+
+
+class QueryCountTestCase(LocalDatabaseTestCase):
+    """This class represents the N+1 regression test case"""
+
+    def test_get_movie_by_id_query_count_is_constant(self):
+        """GET /movies/<id> runs the same queries for any cast size"""
+        self.seed(actors=30, movies=1, cast_size=30)
+        # The row, its cast, and its version before the cache fill
+        res = self.assertMaxQueries(
+            3, self.client().get, '/movies/1', headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movie']['cast']), 30)
+
+    def test_get_actor_by_id_query_count_is_constant(self):
+        """GET /actors/<id> runs the same queries for any filmography"""
+        self.seed(actors=1, movies=30, cast_size=1)
+        res = self.assertMaxQueries(
+            3, self.client().get, '/actors/1', headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actor']['movies']), 30)
+
+    def test_list_endpoints_never_touch_actor_in_movie(self):
+        """List endpoints read their table version and one page of rows"""
+        self.seed(actors=10, movies=10, cast_size=5)
+        for url in ('/actors', '/movies'):
+            with self.app.app_context():
+                engine = db.engine
+            with QueryCounter(engine) as counter:
+                self.client().get(url, headers=self.headers)
+            self.assertLessEqual(counter.count, 2)
+            self.assertFalse(any('actor_in_movie' in statement
+                                 for statement in counter.statements))
+
+
+class BulkMovieTestCase(LocalDatabaseTestCase):
+    """This class represents the POST /movies/bulk test case"""
+
+    def bulk_body(self, count, cast):
+        return {'movies': [{
+            'title': 'Bulk {}'.format(i),
+            'release_year': 2001,
+            'duration': 100,
+            'imdb_rating': 7.5,
+            'cast': cast
+        } for i in range(count)]}
+
+    def test_create_movies_bulk(self):
+        """Movies and cast links are created in a few statements"""
+        self.seed(actors=3)
+        body = self.bulk_body(50, ['Actor 0', 'Actor 2'])
+
+        with self.app.app_context():
+            engine = db.engine
+        with QueryCounter(engine) as counter:
+            res = self.client().post('/movies/bulk', headers=self.headers,
+                                     json=body)
+
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 201)
+        # Movie inserts are batched where the dialect can return ids in
+        # order, the actor lookup and the cast links never scale with size
+        def count(prefix):
+            return len([statement for statement in counter.statements
+                        if statement.startswith(prefix)])
+
+        self.assertEqual(count('SELECT actors.id'), 1)
+        self.assertEqual(count('INSERT INTO actor_in_movie'), 1)
+        self.assertEqual(count('SELECT movies'), 0)
+        self.assertEqual(len(data['created_movie_ids']), 50)
+        with self.app.app_context():
+            self.assertEqual(ActorInMovie.query.count(), 100)
+            movie = Movie.query.options(Movie.with_cast()) \
+                .filter_by(id=data['created_movie_ids'][-1]).first()
+            self.assertEqual(sorted(movie.full_info['cast']),
+                             ['Actor 0', 'Actor 2'])
+
+    def test_422_create_movies_bulk_unknown_actor(self):
+        """A single invalid movie rejects the whole batch"""
+        self.seed(actors=1)
+        body = self.bulk_body(3, ['Actor 0'])
+        body['movies'][1]['cast'] = ['Nobody']
+
+        res = self.client().post('/movies/bulk', headers=self.headers,
+                                 json=body)
+
+        self.assertEqual(res.status_code, 422)
+        with self.app.app_context():
+            self.assertEqual(Movie.query.count(), 0)
+
+
+    def test_422_create_movies_malformed_body(self):
+        """Non-object movies and non-list casts are rejected, not a 500"""
+        self.seed(actors=1)
+        body = self.bulk_body(1, 'Actor 0')
+
+        for url, json_body in (('/movies/bulk', {'movies': ['x']}),
+                               ('/movies/bulk', {'movies': [None]}),
+                               ('/movies/bulk', body),
+                               ('/movies', body['movies'][0]),
+                               ('/movies', ['x'])):
+            res = self.client().post(url, headers=self.headers,
+                                     json=json_body)
+            self.assertEqual(res.status_code, 422, (url, json_body))
+
+
+class BulkActorTestCase(LocalDatabaseTestCase):
+    """This class represents the POST /actors/bulk test case"""
+
+    def test_create_actors_bulk_ndjson(self):
+        """Valid lines are inserted in batches, invalid ones reported"""
+        lines = [json.dumps({'name': 'Bulk {}'.format(i),
+                             'date_of_birth': '1990-01-01'})
+                 for i in range(25)]
+        lines.insert(3, json.dumps({'name': 'No Birthday'}))
+        lines.insert(7, '{not json')
+        lines.insert(9, '')
+
+        with self.app.app_context():
+            engine = db.engine
+        with QueryCounter(engine) as counter:
+            res = self.client().post(
+                '/actors/bulk?batch_size=10', headers=self.headers,
+                data='\n'.join(lines),
+                content_type='application/x-ndjson')
+
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 25)
+        self.assertEqual(data['failed'], 2)
+        self.assertEqual([error['line'] for error in data['errors']], [4, 8])
+        inserts = [statement for statement in counter.statements
+                   if statement.startswith('INSERT INTO actors')]
+        self.assertEqual(len(inserts), 3)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 25)
+
+    def test_create_actors_bulk_rejects_non_string_fields(self):
+        """A badly typed line is reported, its batch is still inserted"""
+        lines = [
+            json.dumps({'name': 'Good 0', 'date_of_birth': '1990-01-01'}),
+            json.dumps({'name': ['x'], 'date_of_birth': '1990-01-01'}),
+            json.dumps({'name': 'Good 1', 'date_of_birth': 19900101}),
+            json.dumps({'name': 'Good 2', 'full_name': {'a': 1},
+                        'date_of_birth': '1990-01-01'}),
+            json.dumps({'name': 'Good 3', 'date_of_birth': '1990-01-01'}),
+        ]
+        res = self.client().post(
+            '/actors/bulk?batch_size=10', headers=self.headers,
+            data='\n'.join(lines), content_type='application/x-ndjson')
+
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual([error['line'] for error in data['errors']],
+                         [2, 3, 4])
+        with self.app.app_context():
+            self.assertEqual(sorted(name for name, in
+                                    db.session.query(Actor.name)),
+                             ['Good 0', 'Good 3'])
+
+    def test_422_create_actor_non_string_date_of_birth(self):
+        """A numeric date of birth is unprocessable, not a 500"""
+        res = self.client().post('/actors', headers=self.headers, json={
+            'name': 'Numeric', 'date_of_birth': 19900101})
+        self.assertEqual(res.status_code, 422)
+
+    def test_400_create_actors_bulk_invalid_batch_size(self):
+        """batch_size must be a positive integer"""
+        res = self.client().post('/actors/bulk?batch_size=0',
+                                 headers=self.headers, data='')
+        self.assertEqual(res.status_code, 400)
+
+    def test_create_actor_parses_date_of_birth(self):
+        """POST /actors accepts the documented date format"""
+        res = self.client().post('/actors', headers=self.headers, json={
+            'name': 'Ana de Armas',
+            'full_name': 'Ana Celia de Armas Caso',
+            'date_of_birth': 'April 30, 1988'
+        })
+        self.assertEqual(res.status_code, 201)
+        res = self.client().post('/actors', headers=self.headers,
+                                 json={'name': 'Ana de Armas'})
+        self.assertEqual(res.status_code, 422)
+
+
+class UnitOfWorkTestCase(LocalDatabaseTestCase):
+    """This class represents the unit-of-work test case"""
+
+    def count_commits(self, fn, *args, **kwargs):
+        commits = []
+
+        def record(session):
+            commits.append(session)
+
+        event.listen(db.session.__class__, 'after_commit', record)
+        try:
+            result = fn(*args, **kwargs)
+        finally:
+            event.remove(db.session.__class__, 'after_commit', record)
+        return result, len(commits)
+
+    def test_model_methods_only_stage_inside_unit_of_work(self):
+        """insert/update/delete commit once at the end of the block"""
+        with self.app.app_context():
+            def create():
+                with unit_of_work():
+                    for i in range(5):
+                        Actor('UoW {}'.format(i), '', date(1990, 1, 1)).insert()
+
+            _, commits = self.count_commits(create)
+            self.assertEqual(commits, 1)
+            self.assertEqual(Actor.query.count(), 5)
+
+    def test_unit_of_work_rolls_back_on_error(self):
+        """Nothing staged in a failed block is committed"""
+        with self.app.app_context():
+            with self.assertRaises(ValueError):
+                with unit_of_work():
+                    Actor('Rolled Back', '', date(1990, 1, 1)).insert()
+                    raise ValueError
+            self.assertEqual(Actor.query.count(), 0)
+
+    def test_create_movie_commits_once(self):
+        """POST /movies inserts the movie and its cast in one transaction"""
+        self.seed(actors=3)
+        res, commits = self.count_commits(
+            self.client().post, '/movies', headers=self.headers, json={
+                'title': 'Knives Out', 'release_year': 2019,
+                'duration': 130, 'imdb_rating': 7.9,
+                'cast': ['Actor 0', 'Actor 1', 'Actor 2']
+            })
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(commits, 1)
+        data = json.loads(self.client().get(
+            '/movies/{}'.format(json.loads(res.data)['created_movie_id']),
+            headers=self.headers).data)
+        self.assertEqual(sorted(data['movie']['cast']),
+                         ['Actor 0', 'Actor 1', 'Actor 2'])
+
+    def test_update_movie_replaces_cast(self):
+        """PATCH /movies/<id> updates fields and cast in one transaction"""
+        self.seed(actors=3, movies=1, cast_size=2)
+        res, commits = self.count_commits(
+            self.client().patch, '/movies/1', headers=self.headers,
+            json={'imdb_rating': 9, 'cast': ['Actor 1', 'Actor 2']})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(commits, 1)
+        data = json.loads(self.client().get('/movies/1',
+                                            headers=self.headers).data)
+        self.assertEqual(data['movie']['imdb_rating'], 9)
+        self.assertEqual(sorted(data['movie']['cast']),
+                         ['Actor 1', 'Actor 2'])
+
+
+class IndexUsageTestCase(LocalDatabaseTestCase):
+    """This class asserts through EXPLAIN that lookups use the indexes"""
+
+    def explain(self, query):
+        dialect = db.engine.dialect.name
+        statement = str(query.statement.compile(
+            db.engine, compile_kwargs={'literal_binds': True}))
+
+        if dialect == 'sqlite':
+            rows = db.session.execute(text('EXPLAIN QUERY PLAN ' + statement))
+        else:
+            db.session.execute(text('SET LOCAL enable_seqscan = off'))
+            rows = db.session.execute(text('EXPLAIN ' + statement))
+
+        return '\n'.join(str(row[-1]) for row in rows)
+
+    def test_cast_lookup_by_name_uses_index(self):
+        """Actor.name IN (...) is an index search, not a table scan"""
+        self.seed(actors=50)
+        with self.app.app_context():
+            plan = self.explain(
+                Actor.query.filter(Actor.name.in_(['Actor 1', 'Actor 2'])))
+        self.assertIn('ix_actors_name', plan)
+
+    def test_cast_loading_uses_movie_id_index(self):
+        """Loading a movie's cast searches actor_in_movie by movie_id"""
+        self.seed(actors=10, movies=10, cast_size=5)
+        with self.app.app_context():
+            plan = self.explain(
+                ActorInMovie.query.filter(ActorInMovie.movie_id.in_([1])))
+        self.assertIn('ix_actor_in_movie_movie_id', plan)
+
+    def test_movie_filter_uses_index(self):
+        """Range filters on movie columns are index searches"""
+        self.seed(movies=50)
+        with self.app.app_context():
+            plan = self.explain(
+                Movie.query.filter(Movie.release_year >= 2015))
+        self.assertIn('ix_movies_release_year', plan)
+
+    def test_name_prefix_matches_literally(self):
+        """Wildcards in a prefix are escaped, the range is kept"""
+        self.seed(actors=12)
+        with self.app.app_context():
+            predicates = list(parse_filters({'name_prefix': 'Actor 1%'},
+                                            ACTOR_FILTERS))
+            self.assertEqual(len(predicates), 3)
+            self.assertEqual(Actor.query.filter(*predicates).count(), 0)
+            predicates = parse_filters({'name_prefix': 'Actor 1'},
+                                       ACTOR_FILTERS)
+            self.assertEqual(Actor.query.filter(*predicates).count(), 3)
+
+    def test_name_prefix_and_sorted_pages_use_indexes(self):
+        """Prefix filters and keyset sorts are served by the indexes"""
+        self.seed(actors=50, movies=50)
+        with self.app.app_context():
+            predicates = parse_filters({'name_prefix': 'Actor 1'},
+                                       ACTOR_FILTERS)
+            plan = self.explain(Actor.query.filter(*predicates))
+            self.assertIn('ix_actors_name', plan)
+
+            query, _ = keyset_query(
+                Movie.short_info_query(), (Movie.imdb_rating, Movie.id),
+                [7.0, 10], descending=True)
+            plan = self.explain(query.limit(10))
+        self.assertIn('ix_movies_imdb_rating', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_422_duplicate_actor_name(self):
+        """Actor names are unique"""
+        self.seed(actors=1)
+        res = self.client().post('/actors', headers=self.headers, json={
+            'name': 'Actor 0', 'date_of_birth': '1990-01-01'
+        })
+        self.assertEqual(res.status_code, 422)
+
+    def test_422_create_actor_non_object_body(self):
+        """A body that is not a JSON object is unprocessable, not a 500"""
+        for body in (['x'], 'Actor 0', 42):
+            res = self.client().post('/actors', headers=self.headers,
+                                     json=body)
+            self.assertEqual(res.status_code, 422, body)
+
+    def test_bulk_import_reports_duplicate_names(self):
+        """Duplicate names are reported per line in bulk imports"""
+        self.seed(actors=1)
+        lines = [json.dumps({'name': name, 'date_of_birth': '1990-01-01'})
+                 for name in ('Actor 0', 'New Actor', 'New Actor')]
+        res = self.client().post('/actors/bulk', headers=self.headers,
+                                 data='\n'.join(lines))
+        data = json.loads(res.data)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual([error['line'] for error in data['errors']], [1, 3])
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    """This class represents the connection pool configuration test case"""
+
+    def setUp(self):
+        auth.set_key_source(StaticKeySource(TEST_JWKS))
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(
+                os.path.join(self.tmp.name, 'pool.db')),
+            'DB_POOL_SIZE': 3,
+            'DB_MAX_OVERFLOW': '2',
+            'DB_POOL_TIMEOUT': '2',
+            'DB_POOL_PRE_PING': 'true'
+        })
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        self.tmp.cleanup()
+
+    def test_pool_settings_from_config(self):
+        """setup_db applies the pool settings to the engine"""
+        with self.app.app_context():
+            pool = db.engine.pool
+            self.assertEqual(pool.size(), 3)
+            self.assertEqual(pool._max_overflow, 2)
+            self.assertEqual(pool._timeout, 2)
+            self.assertTrue(pool._pre_ping)
+
+    def test_get_pool_stats(self):
+        """GET /internal/pool reports live pool statistics"""
+        headers = {
+            'Authorization': 'Bearer {}'.format(make_token(['read:metrics']))
+        }
+        res = self.app.test_client().get('/internal/pool', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['pool']['size'], 3)
+        self.assertIn('checkedout', data['pool'])
+        self.assertGreaterEqual(data['pool']['wait_seconds']['count'], 1)
+
+    def test_get_pool_stats_requires_permission(self):
+        """Pool statistics are not public"""
+        res = self.app.test_client().get('/internal/pool')
+        self.assertEqual(res.status_code, 401)
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """This class represents the read-replica routing test case"""
+
+    def setUp(self):
+        auth.set_key_source(StaticKeySource(TEST_JWKS))
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(
+                os.path.join(self.tmp.name, 'primary.db')),
+            'DATABASE_REPLICA_URL': 'sqlite:///{}'.format(
+                os.path.join(self.tmp.name, 'replica.db'))
+        })
+        self.client = self.app.test_client()
+        self.headers = {'Authorization': 'Bearer {}'.format(
+            make_token(LocalDatabaseTestCase.PERMISSIONS))}
+
+        # Replication is simulated: the replica lags behind by one actor
+        with self.app.app_context():
+            db.create_all()
+            replica = get_replica_engine(self.app)
+            db.metadata.create_all(replica)
+            with replica.begin() as connection:
+                connection.execute(Actor.__table__.insert(), [{
+                    'id': 1, 'name': 'Replica Actor', 'full_name': '',
+                    'date_of_birth': date(1990, 1, 1)}])
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+            get_replica_engine(self.app).dispose()
+        self.tmp.cleanup()
+
+    def names(self, client):
+        data = json.loads(client.get('/actors', headers=self.headers).data)
+        return [actor['name'] for actor in data['actors']]
+
+    def test_reads_use_replica(self):
+        """GET requests read from the replica"""
+        self.assertEqual(self.names(self.client), ['Replica Actor'])
+
+    def test_writes_use_primary_and_are_read_back(self):
+        """After a write the same client reads from the primary"""
+        res = self.client.post('/actors', headers=self.headers, json={
+            'name': 'Primary Actor', 'date_of_birth': '1990-01-01'})
+        self.assertEqual(res.status_code, 201)
+
+        self.assertEqual(self.names(self.client), ['Primary Actor'])
+        # Other clients keep reading from the replica
+        self.assertEqual(self.names(self.app.test_client()),
+                         ['Replica Actor'])
+
+    def test_detail_cache_fills_from_the_primary(self):
+        """Replicated setups cache details, never a lagging replica row"""
+        writer = self.client
+        writer.post('/actors', headers=self.headers, json={
+            'name': 'Primary Actor', 'date_of_birth': '1990-01-01'})
+        response_cache = self.app.extensions['response_cache']
+
+        reader = self.app.test_client()
+        for _ in range(10):
+            res = reader.get('/actors/1', headers=self.headers)
+            self.assertEqual(json.loads(res.data)['actor']['name'],
+                             'Primary Actor')
+        # One miss, read from the primary, then every read is a hit
+        self.assertEqual(response_cache.stats['misses'], 1)
+        self.assertEqual(response_cache.stats['hits'], 9)
+        self.assertEqual(response_cache.get(ACTOR, 1)['info']['name'],
+                         'Primary Actor')
+
+        res = writer.get('/actors/1', headers=self.headers)
+        self.assertEqual(json.loads(res.data)['actor']['name'],
+                         'Primary Actor')
+
+
+class ResponseCacheTestCase(LocalDatabaseTestCase):
+    """This class represents the detail response cache test case"""
+
+    def get(self, url):
+        return json.loads(self.client().get(url, headers=self.headers).data)
+
+    def test_repeat_read_is_served_from_cache(self):
+        """A cached detail read runs no query"""
+        self.seed(actors=2, movies=1, cast_size=2)
+        self.get('/movies/1')
+        self.assertMaxQueries(0, self.client().get, '/movies/1',
+                              headers=self.headers)
+        stats = self.app.extensions['response_cache'].stats
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_read_racing_a_write_is_not_cached(self):
+        """A row whose version moved since it was read is not cached"""
+        self.seed(actors=1)
+        with mock.patch.object(Actor, 'version_of', return_value=99):
+            self.get('/actors/1')
+        self.assertIsNone(
+            self.app.extensions['response_cache'].get(ACTOR, 1))
+
+        self.get('/actors/1')
+        self.assertIsNotNone(
+            self.app.extensions['response_cache'].get(ACTOR, 1))
+
+    def test_actor_rename_invalidates_movies(self):
+        """Renaming an actor refreshes the cast of their movies"""
+        self.seed(actors=2, movies=1, cast_size=2)
+        self.get('/movies/1')
+        self.client().patch('/actors/1', headers=self.headers,
+                            json={'name': 'Renamed'})
+        self.assertIn('Renamed', self.get('/movies/1')['movie']['cast'])
+
+    def test_movie_retitle_invalidates_actors(self):
+        """Retitling a movie refreshes the filmography of its cast"""
+        self.seed(actors=1, movies=1, cast_size=1)
+        self.get('/actors/1')
+        self.client().patch('/movies/1', headers=self.headers,
+                            json={'title': 'Retitled'})
+        self.assertEqual(self.get('/actors/1')['actor']['movies'],
+                         ['Retitled'])
+
+    def test_cast_change_invalidates_removed_and_added_actors(self):
+        """Both sides of a cast change are refreshed"""
+        self.seed(actors=2, movies=1, cast_size=1)
+        self.get('/actors/1')
+        self.get('/actors/2')
+        self.client().patch('/movies/1', headers=self.headers,
+                            json={'cast': ['Actor 1']})
+        self.assertEqual(self.get('/actors/1')['actor']['movies'], [])
+        self.assertEqual(self.get('/actors/2')['actor']['movies'],
+                         ['Movie 0'])
+
+    def test_deletes_invalidate(self):
+        """Deleted resources disappear from the cache and from casts"""
+        self.seed(actors=2, movies=1, cast_size=2)
+        self.get('/movies/1')
+        self.get('/actors/2')
+        self.client().delete('/actors/1', headers=self.headers)
+        self.assertEqual(self.get('/movies/1')['movie']['cast'], ['Actor 1'])
+        self.client().delete('/movies/1', headers=self.headers)
+        self.assertEqual(self.get('/actors/2')['actor']['movies'], [])
+        res = self.client().get('/movies/1', headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_local_backend_evicts_and_expires(self):
+        """The in-process backend is bounded in size and time"""
+        clock = FakeClock()
+        cache = ResponseCache(LocalCacheBackend(max_size=1, ttl=10,
+                                                clock=clock))
+        cache.set('movie', 1, {'title': 'One'})
+        cache.set('movie', 2, {'title': 'Two'})
+        self.assertIsNone(cache.get('movie', 1))
+        clock.now = 10
+        self.assertIsNone(cache.get('movie', 2))
+        self.assertEqual(cache.stats['evictions'], 1)
+        self.assertEqual(cache.stats['expirations'], 1)
+
+    def test_shared_backend_invalidation_is_seen_by_all_workers(self):
+        """Workers sharing a backend see each other's invalidations"""
+        client = LocalSharedClient()
+        worker_a = ResponseCache(SharedCacheBackend(client))
+        worker_b = ResponseCache(SharedCacheBackend(client))
+        worker_a.set('actor', 1, {'name': 'Cached'})
+        self.assertEqual(worker_b.get('actor', 1), {'name': 'Cached'})
+        worker_b.invalidate('actor', [1])
+        self.assertIsNone(worker_a.get('actor', 1))
+
+    def test_get_cache_stats(self):
+        """GET /internal/cache reports hit rate and evictions"""
+        headers = {
+            'Authorization': 'Bearer {}'.format(make_token(['read:metrics']))
+        }
+        data = json.loads(self.client().get('/internal/cache',
+                                            headers=headers).data)
+        self.assertIn('hit_rate', data['cache'])
+        self.assertIn('evictions', data['cache'])
+
+
+class ConditionalRequestTestCase(LocalDatabaseTestCase):
+    """This class represents the ETag and conditional request test case"""
+
+    def etag(self, url):
+        res = self.client().get(url, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNotNone(res.headers.get('ETag'))
+        return res.headers['ETag']
+
+    def conditional_headers(self, header, etag):
+        headers = dict(self.headers)
+        headers[header] = etag
+        return headers
+
+    def test_detail_revalidation_skips_related_rows(self):
+        """A matching If-None-Match gets a 304 from the version alone"""
+        self.seed(actors=5, movies=1, cast_size=5)
+        etag = self.etag('/movies/1')
+        self.app.extensions['response_cache'].backend.clear()
+
+        res = self.assertMaxQueries(
+            1, self.client().get, '/movies/1',
+            headers=self.conditional_headers('If-None-Match', etag))
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_cached_detail_revalidation_runs_no_query(self):
+        """A cached resource is revalidated without touching the database"""
+        self.seed(actors=1, movies=1, cast_size=1)
+        etag = self.etag('/actors/1')
+        res = self.assertMaxQueries(
+            0, self.client().get, '/actors/1',
+            headers=self.conditional_headers('If-None-Match', etag))
+        self.assertEqual(res.status_code, 304)
+
+    def test_related_changes_change_etags(self):
+        """Renames and recasts change the ETags of the other side too"""
+        self.seed(actors=2, movies=1, cast_size=1)
+        movie_etag = self.etag('/movies/1')
+        actor_etag = self.etag('/actors/1')
+
+        self.client().patch('/actors/1', headers=self.headers,
+                            json={'name': 'Renamed'})
+        self.assertNotEqual(self.etag('/movies/1'), movie_etag)
+        movie_etag = self.etag('/movies/1')
+
+        self.client().patch('/movies/1', headers=self.headers,
+                            json={'title': 'Retitled'})
+        self.assertNotEqual(self.etag('/actors/1'), actor_etag)
+        actor_etag = self.etag('/actors/2')
+
+        self.client().patch('/movies/1', headers=self.headers,
+                            json={'cast': ['Actor 1']})
+        self.assertNotEqual(self.etag('/movies/1'), movie_etag)
+        self.assertNotEqual(self.etag('/actors/2'), actor_etag)
+
+    def test_list_revalidation_skips_rows(self):
+        """List pages revalidate on the table counter, writes change it"""
+        self.seed(actors=3)
+        etag = self.etag('/actors?limit=2')
+        self.assertNotEqual(self.etag('/actors?limit=3'), etag)
+
+        res = self.assertMaxQueries(
+            1, self.client().get, '/actors?limit=2',
+            headers=self.conditional_headers('If-None-Match', etag))
+        self.assertEqual(res.status_code, 304)
+
+        self.client().post('/actors/bulk', headers=self.headers,
+                           data='{"name": "New", "date_of_birth": '
+                                '"1990-01-01"}\n')
+        res = self.client().get(
+            '/actors?limit=2',
+            headers=self.conditional_headers('If-None-Match', etag))
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_if_match_guards_updates_and_deletes(self):
+        """Stale If-Match headers get a 412 and change nothing"""
+        self.seed(actors=1, movies=1, cast_size=1)
+        etag = self.etag('/movies/1')
+
+        res = self.client().patch(
+            '/movies/1', json={'title': 'First'},
+            headers=self.conditional_headers('If-Match', etag))
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+        res = self.client().patch(
+            '/movies/1', json={'title': 'Second'},
+            headers=self.conditional_headers('If-Match', etag))
+        self.assertEqual(res.status_code, 412)
+        res = self.client().delete(
+            '/movies/1', headers=self.conditional_headers('If-Match', etag))
+        self.assertEqual(res.status_code, 412)
+
+        data = json.loads(self.client().get('/movies/1',
+                                            headers=self.headers).data)
+        self.assertEqual(data['movie']['title'], 'First')
+
+    def test_concurrent_update_is_detected(self):
+        """An update based on a version changed meanwhile is rejected"""
+        self.seed(actors=1)
+        with self.app.app_context():
+            actor = Actor.query.filter_by(id=1).first()
+            db.session.execute(
+                text('UPDATE actors SET version = version + 1'))
+            actor.full_name = 'Lost update'
+            with self.assertRaises(StaleDataError):
+                db.session.commit()
+
+
+class JsonProviderTestCase(LocalDatabaseTestCase):
+    """This class represents the JSON provider and streaming test case"""
+
+    def test_orjson_provider_matches_stdlib(self):
+        """Both providers produce the same document"""
+        value = {'b': [1, 2.5, None, True], 'a': {'2': 'x', '1': 'y'},
+                 'when': date(2000, 1, 2)}
+        stdlib = DefaultJSONProvider(self.app)
+        fast = OrjsonProvider(self.app)
+        self.assertEqual(fast.dumps(value),
+                         stdlib.dumps(value, separators=(',', ':')))
+        self.assertEqual(fast.loads(fast.dumps(value)),
+                         stdlib.loads(stdlib.dumps(value)))
+
+    def test_provider_selection(self):
+        """JSON_PROVIDER picks the encoder, unknown names are rejected"""
+        self.assertIsInstance(self.app.json, OrjsonProvider)
+        app = Flask(__name__)
+        app.config['JSON_PROVIDER'] = 'stdlib'
+        self.assertIs(type(init_json_provider(app)), DefaultJSONProvider)
+        app.config['JSON_PROVIDER'] = 'bogus'
+        with self.assertRaises(ValueError):
+            init_json_provider(app)
+
+    def test_stream_json_object_chunks(self):
+        """Chunks join into one document whatever the chunk size"""
+        rows = [{'id': i} for i in range(5)]
+        for provider in (DefaultJSONProvider(self.app),
+                         OrjsonProvider(self.app)):
+            chunks = list(stream_json_object(
+                provider, {'success': True}, 'rows', iter(rows),
+                lambda: {'next_cursor': None}, chunk_size=2))
+            self.assertEqual(len(chunks), 5)
+            self.assertEqual(json.loads(b''.join(chunks)), {
+                'success': True, 'rows': rows, 'next_cursor': None})
+            empty = b''.join(stream_json_object(
+                provider, {'success': True}, 'rows', [], lambda: {}))
+            self.assertEqual(json.loads(empty), {'success': True, 'rows': []})
+
+    def test_streamed_pages_match_buffered_pages(self):
+        """Large pages are streamed with the same content and cursor"""
+        self.seed(movies=25)
+        buffered = json.loads(self.client().get(
+            '/movies?limit=10', headers=self.headers).data)
+
+        with mock.patch('app.JSON_STREAM_MIN_ROWS', 10):
+            res = self.client().get('/movies?limit=10', headers=self.headers)
+            self.assertIsNone(res.headers.get('Content-Length'))
+            self.assertIsNotNone(res.headers.get('ETag'))
+            streamed = json.loads(res.data)
+            self.assertEqual(streamed, buffered)
+
+            last = json.loads(self.client().get(
+                '/movies?limit=10&cursor={}'.format(streamed['next_cursor']),
+                headers=self.headers).data)
+        self.assertEqual([movie['id'] for movie in last['movies']],
+                         list(range(11, 21)))
+
+
+class ExportTestCase(LocalDatabaseTestCase):
+    """This class represents the streaming export test case"""
+
+    def export(self, url, **headers):
+        headers.update(self.headers)
+        res = self.client().get(url, headers=headers)
+        self.assertEqual(res.status_code, 200)
+        return res
+
+    def test_export_actors_ndjson(self):
+        """One JSON object per actor, dates in ISO format"""
+        self.seed(actors=3)
+        res = self.export('/export/actors')
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in res.data.splitlines()]
+        self.assertEqual([row['id'] for row in rows], [1, 2, 3])
+        self.assertEqual(rows[0], {'id': 1, 'name': 'Actor 0',
+                                   'full_name': 'Full Name 0',
+                                   'date_of_birth': '1980-01-01'})
+
+    def test_export_movies_csv(self):
+        """CSV exports start with a header line"""
+        self.seed(movies=2)
+        res = self.export('/export/movies?format=csv')
+        self.assertEqual(res.mimetype, 'text/csv')
+        lines = res.data.decode().splitlines()
+        self.assertEqual(lines[0],
+                         'id,title,release_year,duration,imdb_rating')
+        self.assertEqual(lines[1], '1,Movie 0,2000,90,5.0')
+        self.assertEqual(len(lines), 3)
+
+        empty = self.export('/export/casting?format=csv')
+        self.assertEqual(empty.data, b'movie_id,actor_id\n')
+
+    def test_export_casting_gzip_streams_in_batches(self):
+        """Gzip is applied on the fly, rows are read in batches"""
+        self.seed(actors=3, movies=4, cast_size=3)
+        res = self.export('/export/casting', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        rows = [json.loads(line) for line in
+                gzip.decompress(res.data).splitlines()]
+        self.assertEqual(len(rows), 12)
+        self.assertEqual(rows[0], {'movie_id': 1, 'actor_id': 1})
+
+        with self.app.app_context():
+            chunks = list(export_batches('casting', batch_size=5))
+        self.assertEqual([len(chunk) for chunk in chunks], [5, 5, 2])
+
+    def test_export_unknown_format(self):
+        """Unknown export formats are rejected"""
+        res = self.client().get('/export/actors?format=xml',
+                                headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+
+class ListFilterTestCase(LocalDatabaseTestCase):
+    """This class represents the list filtering and sorting test case"""
+
+    def walk(self, url):
+        """Follows next_cursor to the last page, returns every row"""
+        rows = []
+        cursor = None
+        while True:
+            page_url = url if cursor is None else '{}&cursor={}'.format(
+                url, cursor)
+            res = self.client().get(page_url, headers=self.headers)
+            self.assertEqual(res.status_code, 200)
+            data = json.loads(res.data)
+            key = 'movies' if 'movies' in data else 'actors'
+            rows.extend(data[key])
+            cursor = data['next_cursor']
+            if cursor is None:
+                return rows
+
+    def test_movie_range_filters_combine(self):
+        """Range filters are inclusive and combine with AND"""
+        self.seed(movies=40)
+        rows = self.walk('/movies?limit=4&release_year_min=2010'
+                         '&imdb_rating_min=7&duration_max=120')
+        with self.app.app_context():
+            expected = [movie.id for movie in Movie.query.order_by(Movie.id)
+                        if movie.release_year >= 2010
+                        and movie.imdb_rating >= 7
+                        and movie.duration <= 120]
+        self.assertTrue(expected)
+        self.assertEqual([row['id'] for row in rows], expected)
+
+    def test_sorted_pages_walk_every_row_once(self):
+        """Keyset pages on (sort key, id) neither skip nor repeat rows"""
+        self.seed(movies=25)
+        with self.app.app_context():
+            movies = Movie.query.all()
+            expected = [movie.id for movie in sorted(
+                movies, key=lambda movie: (movie.imdb_rating, movie.id),
+                reverse=True)]
+
+        rows = self.walk('/movies?limit=4&sort=-imdb_rating')
+        self.assertEqual([row['id'] for row in rows], expected)
+        self.assertEqual(set(rows[0]), {'id', 'title', 'release_year'})
+
+        with mock.patch('app.JSON_STREAM_MIN_ROWS', 4):
+            streamed = self.walk('/movies?limit=4&sort=-imdb_rating')
+        self.assertEqual(streamed, rows)
+
+    def test_actor_filters_and_date_sort(self):
+        """Name prefix and date of birth range, sorted by date of birth"""
+        self.seed(actors=30)
+        rows = self.walk('/actors?name_prefix=Actor%201')
+        self.assertEqual(sorted(row['name'] for row in rows),
+                         ['Actor 1'] + ['Actor 1{}'.format(i)
+                                        for i in range(10)])
+
+        rows = self.walk('/actors?limit=3&sort=date_of_birth'
+                         '&date_of_birth_min=1980-01-05'
+                         '&date_of_birth_max=1980-01-10')
+        with self.app.app_context():
+            expected = [actor.id for actor in Actor.query.order_by(
+                Actor.date_of_birth, Actor.id)
+                if date(1980, 1, 5) <= actor.date_of_birth
+                <= date(1980, 1, 10)]
+        self.assertEqual([row['id'] for row in rows], expected)
+
+    def test_400_invalid_filters_and_sorts(self):
+        """Unknown sort keys, bad values and foreign cursors are rejected"""
+        self.seed(movies=3)
+        cursor = json.loads(self.client().get(
+            '/movies?limit=1&sort=title', headers=self.headers).data)[
+                'next_cursor']
+        for url in ('/movies?sort=budget', '/movies?imdb_rating_min=high',
+                    '/actors?date_of_birth_max=yesterday',
+                    '/movies?cursor={}'.format(cursor),
+                    '/movies?sort=duration&cursor={}'.format(cursor)):
+            res = self.client().get(url, headers=self.headers)
+            self.assertEqual(res.status_code, 400, url)
+
+
+class SearchTestCase(LocalDatabaseTestCase):
+    """This class represents the full-text search test case"""
+
+    def search(self, q, headers=None):
+        res = self.client().get('/search', query_string={'q': q},
+                                headers=headers or self.headers)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def add_actor(self, name, full_name):
+        self.client().post('/actors', headers=self.headers, json={
+            'name': name, 'full_name': full_name,
+            'date_of_birth': '1974-11-11'})
+
+    def test_prefix_search_ranks_names_first(self):
+        """Word prefixes match, name matches rank above full names"""
+        self.seed(actors=5)
+        self.add_actor('Kate', 'Kate Winslet')
+        self.add_actor('Leo', 'Leonardo DiCaprio')
+        self.add_actor('Leonie', 'Leonie Benesch')
+
+        data = self.search('leo')
+        self.assertEqual([actor['name'] for actor in data['actors']],
+                         ['Leo', 'Leonie'])
+        self.assertEqual(data['actors'][0]['full_name'], 'Leonardo DiCaprio')
+
+        data = self.search('dicap')
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Leo'])
+
+    def test_search_follows_writes(self):
+        """Created, retitled and deleted movies are reflected at once"""
+        self.seed(actors=1, movies=3, cast_size=1)
+        self.assertEqual(len(self.search('movie')['movies']), 3)
+
+        self.client().patch('/movies/2', headers=self.headers,
+                            json={'title': 'Titanic'})
+        self.client().delete('/movies/3', headers=self.headers)
+        data = self.search('tita')
+        self.assertEqual(data['movies'],
+                         [{'id': 2, 'title': 'Titanic', 'release_year': 2001}])
+        self.assertEqual([movie['id'] for movie in
+                          self.search('movie')['movies']], [1])
+
+    def test_every_word_must_match_and_limit_applies(self):
+        """Words combine with AND, results are capped by limit"""
+        self.seed(actors=12)
+        self.assertEqual(len(self.search('actor 1')['actors']), 3)
+        res = self.client().get('/search?q=actor&limit=5',
+                                headers=self.headers)
+        self.assertEqual(len(json.loads(res.data)['actors']), 5)
+
+    def test_best_match_wins_whatever_its_position(self):
+        """Matches are ranked before the limit is applied"""
+        self.seed(actors=30)
+        self.add_actor('Hanks', 'Tom Hanks')
+        for i in range(5):
+            self.add_actor('Tom {}'.format(i), 'Tom Actor {}'.format(i))
+
+        res = self.client().get('/search?q=tom&limit=1',
+                                headers=self.headers)
+        self.assertEqual([actor['name'] for actor in
+                          json.loads(res.data)['actors']], ['Tom 0'])
+        res = self.client().get('/search?q=hanks&limit=1',
+                                headers=self.headers)
+        self.assertEqual([actor['name'] for actor in
+                          json.loads(res.data)['actors']], ['Hanks'])
+
+    def test_results_follow_permissions(self):
+        """Only the kinds the caller may list are searched"""
+        self.seed(actors=1, movies=1)
+        headers = {
+            'Authorization': 'Bearer {}'.format(make_token(['get:movies']))
+        }
+        data = self.search('movie', headers=headers)
+        self.assertNotIn('actors', data)
+        self.assertEqual(len(data['movies']), 1)
+
+        headers = {
+            'Authorization': 'Bearer {}'.format(make_token(['post:actors']))
+        }
+        res = self.client().get('/search?q=movie', headers=headers)
+        self.assertEqual(res.status_code, 401)
+
+    def test_400_empty_query(self):
+        """Queries without any word are rejected"""
+        for url in ('/search', '/search?q=', '/search?q="*"',
+                    '/search?q=leo&limit=0'):
+            res = self.client().get(url, headers=self.headers)
+            self.assertEqual(res.status_code, 400, url)
+
+
+class CastGraphTestCase(LocalDatabaseTestCase):
+    """This class represents the co-star and separation graph test case"""
+
+    def chain(self, actors, movies):
+        """Movie i casts actors i and i + 1: a chain of co-stars"""
+        self.seed(actors=actors, movies=movies)
+        with self.app.app_context():
+            db.session.add_all([ActorInMovie(movie_id, actor_id)
+                                for movie_id in range(1, movies + 1)
+                                for actor_id in (movie_id, movie_id + 1)])
+            db.session.commit()
+
+    def get(self, url):
+        res = self.client().get(url, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def test_co_stars_ranked_by_shared_movies(self):
+        """Co-stars come with the number of movies they share"""
+        self.seed(actors=4, movies=3, cast_size=2)
+        self.client().post('/movies', headers=self.headers, json={
+            'title': 'Reunion', 'release_year': 2020, 'duration': 100,
+            'imdb_rating': 7, 'cast': ['Actor 0', 'Actor 3']})
+
+        data = self.get('/actors/1/co-stars')
+        self.assertEqual(data['co_stars'], [
+            {'id': 2, 'name': 'Actor 1', 'shared_movies': 3},
+            {'id': 4, 'name': 'Actor 3', 'shared_movies': 1}])
+        self.assertEqual(self.get('/actors/3/co-stars')['co_stars'], [])
+        res = self.client().get('/actors/99/co-stars', headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_separation_path_runs_constant_queries(self):
+        """Long chains are walked in memory, not one query per hop"""
+        self.chain(actors=8, movies=7)
+        self.get('/actors/1/co-stars')
+
+        res = self.assertMaxQueries(
+            4, self.client().get, '/actors/1/separation/6',
+            headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(data['degrees'], 5)
+        self.assertEqual(data['path'][0], {'actor': {'id': 1,
+                                                     'name': 'Actor 0'}})
+        self.assertEqual(data['path'][1]['movie']['id'], 1)
+        self.assertEqual([step['actor']['id'] for step in data['path'][::2]],
+                         [1, 2, 3, 4, 5, 6])
+
+        data = self.get('/actors/1/separation/8?max_degrees=6')
+        self.assertIsNone(data['degrees'])
+        self.assertEqual(self.get('/actors/3/separation/3')['degrees'], 0)
+
+    def test_separation_finds_shortest_path(self):
+        """A shortcut movie shortens the chain"""
+        self.chain(actors=6, movies=5)
+        self.assertEqual(self.get('/actors/1/separation/6')['degrees'], 5)
+        self.client().post('/movies', headers=self.headers, json={
+            'title': 'Shortcut', 'release_year': 2020, 'duration': 100,
+            'imdb_rating': 7, 'cast': ['Actor 1', 'Actor 4']})
+        data = self.get('/actors/1/separation/6')
+        self.assertEqual(data['degrees'], 3)
+
+    def test_shared_actors(self):
+        """Actors cast in both movies"""
+        self.seed(actors=3, movies=2, cast_size=2)
+        self.client().patch('/movies/2', headers=self.headers,
+                            json={'cast': ['Actor 1', 'Actor 2']})
+        data = self.get('/movies/1/shared-actors/2')
+        self.assertEqual(data['actors'], [{'id': 2, 'name': 'Actor 1'}])
+
+    def test_writes_update_the_graph_in_place(self):
+        """Cast changes made here are applied without a reload"""
+        self.chain(actors=4, movies=3)
+        self.get('/actors/1/separation/4')
+        graph = self.app.extensions['cast_graph']
+
+        self.client().delete('/movies/2', headers=self.headers)
+        self.assertIsNone(self.get('/actors/1/separation/4')['degrees'])
+        self.client().patch('/movies/1', headers=self.headers,
+                            json={'cast': ['Actor 0', 'Actor 2']})
+        self.assertEqual(self.get('/actors/1/separation/4')['degrees'], 2)
+        self.client().delete('/actors/3', headers=self.headers)
+        self.assertIsNone(self.get('/actors/1/separation/4')['degrees'])
+        self.assertEqual(graph.loads, 1)
+
+    def test_other_workers_writes_trigger_a_reload(self):
+        """A cast change the graph did not apply is picked up on refresh"""
+        self.chain(actors=3, movies=1)
+        self.assertIsNone(self.get('/actors/1/separation/3')['degrees'])
+
+        with self.app.app_context():
+            db.session.add(ActorInMovie(1, 3))
+            db.session.commit()
+
+        self.assertEqual(self.get('/actors/1/separation/3')['degrees'], 1)
+        self.assertEqual(self.app.extensions['cast_graph'].loads, 2)
+
+    def test_older_counter_does_not_reload(self):
+        """A lagging counter, as a replica would read it, is ignored"""
+        self.chain(actors=3, movies=2)
+        self.get('/actors/1/separation/3')
+        graph = self.app.extensions['cast_graph']
+
+        with self.app.app_context():
+            graph.version += 1
+            graph.refresh()
+        self.assertEqual(graph.loads, 1)
+
+    def test_out_of_order_write_marks_for_reload(self):
+        """A write skipping a version leaves the graph to be reloaded"""
+        self.chain(actors=3, movies=2)
+        self.get('/actors/1/separation/3')
+        graph = self.app.extensions['cast_graph']
+
+        graph.apply_write(graph.version + 2, removed=[(1, 1)])
+        self.assertIsNone(graph.version)
+        self.assertEqual(self.get('/actors/1/separation/3')['degrees'], 2)
+        self.assertEqual(graph.loads, 2)
+
+
+class StatsTestCase(LocalDatabaseTestCase):
+    """This class represents the aggregate statistics test case"""
+
+    def summaries(self):
+        """Summary table rows, and the same summaries recomputed from scratch"""
+        def rows(statement):
+            return sorted(tuple(row) for row in db.session.execute(statement))
+
+        with self.app.app_context():
+            stored = (rows(ActorStats.__table__.select()),
+                      rows(ReleaseYearStats.__table__.select()))
+            recomputed = (rows(actor_stats_select()),
+                          rows(release_year_stats_select()))
+        return stored, recomputed
+
+    def assertSummariesCurrent(self):
+        stored, recomputed = self.summaries()
+        self.assertEqual(stored, recomputed)
+
+    def get(self, url):
+        res = self.client().get(url, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def test_writes_refresh_the_summaries(self):
+        """Every write keeps the summaries equal to a full GROUP BY"""
+        self.seed(actors=4, movies=3, cast_size=2)
+        self.assertSummariesCurrent()
+
+        self.client().post('/movies', headers=self.headers, json={
+            'title': 'New', 'release_year': 2001, 'duration': 120,
+            'imdb_rating': 8, 'cast': ['Actor 2', 'Actor 3']})
+        self.assertSummariesCurrent()
+
+        self.client().patch('/movies/1', headers=self.headers, json={
+            'release_year': 1999, 'duration': 200})
+        self.assertSummariesCurrent()
+
+        self.client().patch('/movies/2', headers=self.headers,
+                            json={'cast': ['Actor 3']})
+        self.assertSummariesCurrent()
+
+        self.client().post('/movies/bulk', headers=self.headers, json={
+            'movies': [{'title': 'Bulk', 'release_year': 2002,
+                        'duration': 90, 'imdb_rating': 6,
+                        'cast': ['Actor 0', 'Actor 3']}]})
+        self.assertSummariesCurrent()
+
+        self.client().delete('/movies/3', headers=self.headers)
+        self.client().delete('/actors/4', headers=self.headers)
+        self.assertSummariesCurrent()
+
+        stored, _ = self.summaries()
+        self.assertNotIn(4, [row[0] for row in stored[0]])
+
+    def test_rolled_back_writes_leave_the_summaries(self):
+        """Keys staged by a failed transaction are not refreshed later"""
+        self.seed(actors=1, movies=1, cast_size=1)
+        with self.app.app_context():
+            with self.assertRaises(RuntimeError):
+                with unit_of_work():
+                    Movie('Lost', 1990, 100, 5).insert()
+                    raise RuntimeError
+            self.assertNotIn('stale_stats', db.session.info)
+        self.assertSummariesCurrent()
+
+    def test_refresh_all_stats_rebuilds_the_summaries(self):
+        """The scheduled refresh repairs summaries changed behind the app"""
+        self.seed(actors=3, movies=4, cast_size=2)
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                connection.execute(text('DELETE FROM actor_stats'))
+                connection.execute(text(
+                    'UPDATE release_year_stats SET movie_count = 99'))
+                refresh_all_stats(connection)
+        self.assertSummariesCurrent()
+
+    def test_overview_and_release_years(self):
+        """Totals and per year averages read from the summary tables"""
+        self.seed(actors=3, movies=2, cast_size=2)
+        self.client().post('/movies', headers=self.headers, json={
+            'title': 'Same Year', 'release_year': 2000, 'duration': 100,
+            'imdb_rating': 8, 'cast': ['Actor 2']})
+
+        data = self.assertMaxQueries(
+            3, self.get, '/stats')['stats']
+        self.assertEqual(data, {
+            'actors': 3, 'cast_actors': 3, 'movies': 3,
+            'total_duration': 90 + 91 + 100,
+            'average_imdb_rating': (5 + 6 + 8) / 3})
+
+        years = self.get('/stats/release-years')['release_years']
+        self.assertEqual(years, [
+            {'release_year': 2000, 'movie_count': 2, 'total_duration': 190,
+             'average_imdb_rating': 6.5},
+            {'release_year': 2001, 'movie_count': 1, 'total_duration': 91,
+             'average_imdb_rating': 6.0}])
+
+    def test_actor_stats_sorted_and_paginated(self):
+        """Busiest actors first, keyset pagination over the summary"""
+        self.seed(actors=4, movies=3, cast_size=3)
+        self.client().patch('/movies/3', headers=self.headers,
+                            json={'cast': ['Actor 0', 'Actor 3']})
+
+        data = self.get('/stats/actors?limit=2')
+        self.assertEqual([actor['id'] for actor in data['actors']], [1, 3])
+        self.assertEqual(data['actors'][0], {
+            'id': 1, 'name': 'Actor 0', 'movie_count': 3,
+            'total_duration': 90 + 91 + 92, 'average_imdb_rating': 6.0})
+
+        data = self.get('/stats/actors?limit=2&cursor=' + data['next_cursor'])
+        self.assertEqual([actor['id'] for actor in data['actors']], [2, 4])
+        self.assertIsNone(data['next_cursor'])
+
+        data = self.get('/stats/actors?sort=total_duration')
+        self.assertEqual(data['actors'][0]['id'], 4)
+        res = self.client().get('/stats/actors?sort=name',
+                                headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+
+class RequestMetricsTestCase(LocalDatabaseTestCase):
+    """This class represents the request timing and metrics test case"""
+
+    def server_timing(self, res):
+        return {entry.split(';')[0]: entry.strip()
+                for entry in res.headers['Server-Timing'].split(',')}
+
+    def test_server_timing_header(self):
+        """Each phase is reported, with the number of queries"""
+        self.seed(actors=3, movies=1, cast_size=3)
+        res = self.client().get('/movies/1', headers=self.headers)
+        timing = self.server_timing(res)
+        self.assertEqual(sorted(timing), [
+            ' app', ' db', ' serialise', ' total', 'auth'])
+        self.assertIn('desc="3 queries"', timing[' db'])
+
+        res = self.client().get('/movies/1', headers=self.headers)
+        self.assertIn('desc="0 queries"', self.server_timing(res)[' db'])
+
+    def test_metrics_endpoint(self):
+        """Histograms are labelled with the route template and status"""
+        self.seed(actors=2)
+        for url in ['/actors/1', '/actors/2', '/actors/99', '/unknown']:
+            self.client().get(url, headers=self.headers)
+
+        res = self.client().get('/metrics', headers=self.headers)
+        self.assertEqual(res.status_code, 401)
+
+        res = self.client().get('/metrics', headers={
+            'Authorization': 'Bearer {}'.format(make_token(['read:metrics']))
+        })
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        text_body = res.get_data(as_text=True)
+        self.assertIn(
+            'http_request_duration_seconds_count{method="GET",'
+            'route="/actors/<int:actor_id>",status="200"} 2', text_body)
+        self.assertIn(
+            'http_request_duration_seconds_bucket{method="GET",'
+            'route="/actors/<int:actor_id>",status="404",le="+Inf"} 1',
+            text_body)
+        self.assertIn('route="unmatched",status="404"', text_body)
+        self.assertIn(
+            'http_request_queries_total{method="GET",'
+            'route="/actors/<int:actor_id>"} 7', text_body)
+
+    def test_streamed_responses_are_recorded_once_sent(self):
+        """Exports are timed with the queries run while streaming"""
+        self.seed(actors=3)
+        metrics = self.app.extensions['request_metrics']
+
+        res = self.client().get('/export/actors', headers=self.headers)
+        self.assertNotIn('Server-Timing', res.headers)
+        self.assertNotIn('route="/export/actors"', metrics.prometheus())
+
+        res.get_data()
+        res.close()
+        text_body = metrics.prometheus()
+        self.assertIn(
+            'http_request_duration_seconds_count{method="GET",'
+            'route="/export/actors",status="200"} 1', text_body)
+        self.assertNotIn(
+            'http_request_queries_total{method="GET",'
+            'route="/export/actors"} 0', text_body)
+
+    def test_metrics_can_be_turned_off(self):
+        """REQUEST_METRICS=false leaves the responses untouched"""
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                          'REQUEST_METRICS': False})
+        res = app.test_client().get('/')
+        self.assertNotIn('Server-Timing', res.headers)
+
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                          'SERVER_TIMING': False})
+        res = app.test_client().get('/')
+        self.assertNotIn('Server-Timing', res.headers)
+        self.assertIn('route="/"', app.extensions[
+            'request_metrics'].prometheus())
+
+
+class SQLProfilerTestCase(LocalDatabaseTestCase):
+    """This class represents the SQL statement profiler test case"""
+
+    def profiled_app(self, **config):
+        app = create_app(dict(config, SQLALCHEMY_DATABASE_URI='sqlite://'))
+        with app.app_context():
+            db.create_all()
+            db.session.add(Actor('Actor', 'Full Name', date(1980, 1, 1)))
+            db.session.commit()
+        app.extensions['sql_profiler'].reset()
+        return app
+
+    def test_fingerprint(self):
+        """Literals, placeholders and IN lists do not split a fingerprint"""
+        self.assertEqual(
+            fingerprint("SELECT * FROM actors WHERE id IN (?, ?, ?)\n"
+                        "  AND name = 'O''Neil' LIMIT 20"),
+            "SELECT * FROM actors WHERE id IN (...) AND name = ? LIMIT ?")
+        self.assertEqual(
+            fingerprint("SELECT * FROM actors_1 WHERE id = %(id_1)s"),
+            fingerprint("SELECT * FROM actors_1 WHERE id = 42"))
+
+    def test_queries_endpoint(self):
+        """Repeated statements share a fingerprint, costliest first"""
+        self.seed(actors=3)
+        self.app.extensions['sql_profiler'].reset()
+        for actor_id in (1, 2, 3):
+            self.client().get('/actors/{}'.format(actor_id),
+                              headers=self.headers)
+
+        res = self.client().get('/internal/queries', headers=self.headers)
+        self.assertEqual(res.status_code, 401)
+
+        headers = {
+            'Authorization': 'Bearer {}'.format(make_token(['read:metrics']))
+        }
+        res = self.client().get('/internal/queries?sort=calls&limit=1',
+                                headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['queries']), 1)
+        self.assertEqual(data['queries'][0]['calls'], 3)
+        self.assertIn('FROM actors', data['queries'][0]['fingerprint'])
+        self.assertEqual(data['profiler']['over_budget'], [])
+
+        res = self.client().get('/internal/queries?sort=name',
+                                headers=headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_query_budget(self):
+        """Requests over the budget are logged and counted per route"""
+        app = self.profiled_app(SQL_QUERY_BUDGET=1)
+        with self.assertLogs('database.profiler', 'WARNING') as logs:
+            app.test_client().get('/actors/1', headers=self.headers)
+
+        self.assertIn('GET /actors/<int:actor_id> ran', logs.output[0])
+        self.assertEqual(app.extensions['sql_profiler'].stats['over_budget'],
+                         [{'method': 'GET', 'route': '/actors/<int:actor_id>',
+                           'requests': 1}])
+
+    def test_slow_query_plan(self):
+        """Slow statements are logged once per interval with their plan"""
+        app = self.profiled_app(SQL_SLOW_QUERY_MS=0, SQL_QUERY_BUDGET=0)
+        with self.assertLogs('database.profiler', 'WARNING') as logs:
+            app.test_client().get('/actors/1', headers=self.headers)
+            app.test_client().get('/actors?limit=5', headers=self.headers)
+        self.assertTrue(any('SEARCH actors USING INTEGER PRIMARY KEY' in line
+                            for line in logs.output))
+
+        with self.assertLogs('database.profiler', 'WARNING') as logs:
+            app.test_client().get('/actors?limit=5', headers=self.headers)
+        self.assertNotIn('SCAN', ''.join(logs.output))
+
+    def test_failed_explain_rolls_back_to_a_savepoint(self):
+        """A failed EXPLAIN leaves the PostgreSQL transaction usable"""
+        conn = mock.Mock()
+        conn.dialect.name = 'postgresql'
+        cursor = conn.connection.cursor.return_value
+
+        def failing(sql, *args):
+            if sql.startswith('EXPLAIN'):
+                raise Exception('syntax error')
+        cursor.execute.side_effect = failing
+
+        self.assertIsNone(explain_plan(conn, 'SELECT 1', {}))
+        self.assertEqual(
+            [call.args[0] for call in cursor.execute.call_args_list],
+            ['SAVEPOINT sql_profiler_explain', 'EXPLAIN SELECT 1',
+             'ROLLBACK TO SAVEPOINT sql_profiler_explain',
+             'RELEASE SAVEPOINT sql_profiler_explain'])
+        cursor.close.assert_called_once_with()
+
+    def test_streamed_responses_are_profiled_once_sent(self):
+        """Statements run while a body streams count for its request"""
+        self.seed(actors=25)
+        profiler = self.app.extensions['sql_profiler']
+        finish_request = profiler.finish_request
+        profiles = []
+
+        def record(*args, **kwargs):
+            profile = finish_request(*args, **kwargs)
+            profiles.append(profile)
+            return profile
+
+        with mock.patch.object(profiler, 'finish_request',
+                               side_effect=record), \
+                mock.patch('app.JSON_STREAM_MIN_ROWS', 10):
+            self.client().get('/actors?limit=5', headers=self.headers)
+            buffered = profiles.pop().queries
+
+            res = self.client().get('/actors?limit=10', headers=self.headers)
+            self.assertEqual(profiles, [])
+            res.get_data()
+            res.close()
+            self.assertEqual(profiles.pop().queries, buffered)
+
+            res = self.client().get('/export/actors', headers=self.headers)
+            res.get_data()
+            res.close()
+            self.assertEqual(profiles.pop().queries, 1)
+
+    def test_profiler_can_be_turned_off(self):
+        """SQL_PROFILER=false leaves the engines uninstrumented"""
+        app = self.profiled_app(SQL_PROFILER=False)
+        app.test_client().get('/actors/1', headers=self.headers)
+        self.assertEqual(app.extensions['sql_profiler'].top(), [])
+
+
+class CatalogueTestCase(LocalDatabaseTestCase):
+    """This class represents the synthetic catalogue generator test case"""
+
+    def generator(self, seed=7):
+        return CatalogueGenerator(actors=300, movies=200, cast_min=2,
+                                  cast_max=12, cast_mode=4, seed=seed)
+
+    def test_deterministic_by_seed(self):
+        """A seed always gives the same rows, another seed other rows"""
+        for rows in ('actor_rows', 'movie_rows', 'cast_rows'):
+            self.assertEqual(list(getattr(self.generator(), rows)()),
+                             list(getattr(self.generator(), rows)()))
+        self.assertNotEqual(list(self.generator().cast_rows()),
+                            list(self.generator(seed=8).cast_rows()))
+
+    def test_generated_rows(self):
+        """Unique names, casts within bounds and a few very busy actors"""
+        actors = list(self.generator().actor_rows())
+        self.assertEqual(len({name for _, name, _, _ in actors}), 300)
+
+        casts = {}
+        for actor_id, movie_id in self.generator().cast_rows():
+            casts.setdefault(movie_id, []).append(actor_id)
+        self.assertEqual(len(casts), 200)
+        for cast in casts.values():
+            self.assertTrue(2 <= len(cast) <= 12)
+            self.assertEqual(len(set(cast)), len(cast))
+
+        movies_per_actor = sorted(
+            (sum(actor_id in cast for cast in casts.values())
+             for actor_id in range(1, 301)), reverse=True)
+        self.assertGreater(movies_per_actor[0], 5 * movies_per_actor[150])
+
+    def test_load_catalogue(self):
+        """The loaded catalogue is served with its summaries"""
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                counts = load_catalogue(connection, self.generator(),
+                                        batch_size=64)
+            links = ActorInMovie.query.count()
+            cast_actors = db.session.query(
+                ActorInMovie.actor_id).distinct().count()
+
+        self.assertEqual(counts['actors'], 300)
+        self.assertEqual(counts['actor_in_movie'], links)
+
+        res = self.client().get('/stats', headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(data['stats']['movies'], 200)
+        self.assertEqual(data['stats']['cast_actors'], cast_actors)
+
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                with self.assertRaises(ValueError):
+                    load_catalogue(connection, self.generator())
+
+    def test_write_catalogue(self):
+        """One CSV file per table, with a header line"""
+        with tempfile.TemporaryDirectory() as directory:
+            counts = write_catalogue(self.generator(), directory)
+            with open(os.path.join(directory, 'actors.csv')) as csv_file:
+                lines = csv_file.read().splitlines()
+
+        self.assertEqual(lines[0], 'id,name,full_name,date_of_birth')
+        self.assertEqual(len(lines), 301)
+        self.assertEqual(counts['movies'], 200)
+
+
+@unittest.skipIf(create_async_app is None, 'quart or aiosqlite missing')
+class AsyncAppTestCase(LocalDatabaseTestCase):
+    """This class represents the async entry point test case"""
+
+    def setUp(self):
+        # The sync and async engines share a database file, not a memory one
+        auth.set_key_source(StaticKeySource(TEST_JWKS))
+        self.database_file = tempfile.NamedTemporaryFile(suffix='.db')
+        self.asgi = create_async_app({
+            'SQLALCHEMY_DATABASE_URI':
+                'sqlite:///' + self.database_file.name})
+        self.app = self.asgi.sync_app
+        self.client = self.app.test_client
+        self.headers = {
+            'Authorization': 'Bearer {}'.format(make_token(self.PERMISSIONS))
+        }
+
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        super().tearDown()
+        self.database_file.close()
+
+    def request(self, method, url, headers=None, json_body=None):
+        body = b'' if json_body is None else json.dumps(json_body).encode()
+        headers = dict(self.headers if headers is None else headers)
+        if json_body is not None:
+            headers['Content-Type'] = 'application/json'
+        return asyncio.run(asgi_request(self.asgi, method, url, headers, body))
+
+    def test_reads_match_the_flask_app(self):
+        """Same status, body and ETag from both apps"""
+        self.seed(actors=3, movies=2, cast_size=2)
+        for url in ['/actors?limit=2', '/movies?sort=-release_year',
+                    '/actors/1', '/movies/2', '/actors/99',
+                    '/movies?sort=unknown']:
+            self.assertTrue(self.asgi.handles('GET', url.partition('?')[0]))
+            status, headers, body = self.request('GET', url)
+            res = self.client().get(url, headers=self.headers)
+            self.assertEqual(status, res.status_code, url)
+            self.assertEqual(json.loads(body), json.loads(res.data), url)
+            self.assertEqual(headers.get('etag'), res.headers.get('ETag'))
+
+        status, _, body = self.request('GET', '/actors', headers={})
+        self.assertEqual(status, 401)
+        self.assertEqual(json.loads(body)['message'], 'Auth error')
+
+    def test_conditional_get(self):
+        """If-None-Match is answered with a 304 by the async views"""
+        self.seed(actors=1, movies=1, cast_size=1)
+        _, headers, _ = self.request('GET', '/movies/1')
+        status, _, _ = self.request('GET', '/movies/1', headers=dict(
+            self.headers, **{'If-None-Match': headers['etag']}))
+        self.assertEqual(status, 304)
+
+    def test_other_routes_fall_back_to_flask(self):
+        """Writes run in Flask and invalidate the cache read by async views"""
+        self.seed(actors=2, movies=1, cast_size=2)
+        self.assertFalse(self.asgi.handles('PATCH', '/actors/1'))
+        self.assertFalse(self.asgi.handles('GET', '/stats'))
+
+        status, _, body = self.request('GET', '/actors/1')
+        self.assertEqual(json.loads(body)['actor']['name'], 'Actor 0')
+
+        status, _, _ = self.request('PATCH', '/actors/1',
+                                    json_body={'name': 'Renamed'})
+        self.assertEqual(status, 200)
+        status, _, body = self.request('GET', '/actors/1')
+        self.assertEqual(json.loads(body)['actor']['name'], 'Renamed')
+
+        status, _, body = self.request('GET', '/stats')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['stats']['movies'], 1)
+        status, _, body = self.request('DELETE', '/unknown')
+        self.assertEqual(status, 404)
+        self.assertFalse(json.loads(body)['success'])
+
+    def test_key_fetch_does_not_block_the_event_loop(self):
+        """Concurrent lookups share one fetch while the loop keeps running"""
+        source = SlowKeySource(TEST_JWKS, delay=0.2)
+        store = JWKSKeyStore(source)
+
+        async def lookups():
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while not done.is_set():
+                    ticks += 1
+                    await asyncio.sleep(0.01)
+
+            done = asyncio.Event()
+            tick_task = asyncio.create_task(ticker())
+            keys = await asyncio.gather(*[
+                store.get_key_async(TEST_KID) for _ in range(20)])
+            done.set()
+            await tick_task
+            return keys, ticks
+
+        keys, ticks = asyncio.run(lookups())
+        self.assertTrue(all(keys))
+        self.assertEqual(source.fetch_count, 1)
+        self.assertGreater(ticks, 5)
+
+
+class PaginationTestCase(LocalDatabaseTestCase):
+    """This class represents the keyset pagination test case"""
+
+    def test_get_actors_pages_with_cursor(self):
+        """GET /actors walks the whole table page by page"""
+        self.seed(actors=25)
+        ids = []
+        cursor = None
+
+        while True:
+            url = '/actors?limit=10'
+            if cursor:
+                url += '&cursor={}'.format(cursor)
+            data = json.loads(self.client().get(url, headers=self.headers).data)
+            self.assertTrue(data['success'])
+            self.assertLessEqual(len(data['actors']), 10)
+            ids.extend(actor['id'] for actor in data['actors'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(ids, list(range(1, 26)))
+
+    def test_get_movies_page_size_is_clamped(self):
+        """Limits above the server maximum are clamped"""
+        self.seed(movies=5)
+        with mock.patch('database.pagination.MAX_PAGE_SIZE', 2):
+            res = self.client().get('/movies?limit=500', headers=self.headers)
+
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 2)
+        self.assertIsNotNone(data['next_cursor'])
+
+    def test_list_rows_match_short_info(self):
+        """Projected rows serialise exactly like short_info"""
+        self.seed(actors=2, movies=2, cast_size=2)
+        data = json.loads(self.client().get('/movies',
+                                            headers=self.headers).data)
+        with self.app.app_context():
+            expected = [movie.short_info
+                        for movie in Movie.query.order_by(Movie.id)]
+        self.assertEqual(data['movies'], expected)
+
+    def test_400_invalid_cursor(self):
+        """Malformed cursors and limits are rejected"""
+        res = self.client().get('/movies?cursor=not-a-cursor',
+                                headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+        res = self.client().get('/actors?limit=0', headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """This class represents the JWKS key store test case"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.source = StaticKeySource(TEST_JWKS)
+        self.store = JWKSKeyStore(self.source, ttl=600,
+                                  min_refresh_interval=30, clock=self.clock)
+
+    def test_fetches_once(self):
+        """Repeated lookups are served from memory"""
+        for _ in range(10):
+            self.assertIsNotNone(self.store.get_key(TEST_KID))
+        self.assertEqual(self.source.fetch_count, 1)
+
+    def test_refreshes_after_ttl(self):
+        """The key set is fetched again once its TTL has passed"""
+        self.store.get_key(TEST_KID)
+        self.clock.now = 601
+        self.store.get_key(TEST_KID)
+        self.assertEqual(self.source.fetch_count, 2)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        """An unknown kid refetches at most once per refresh interval"""
+        self.store.get_key(TEST_KID)
+        self.clock.now = 31
+        for _ in range(5):
+            self.assertIsNone(self.store.get_key('rotated-key'))
+        self.assertEqual(self.source.fetch_count, 2)
+
+    def test_serves_stale_keys_when_refresh_fails(self):
+        """A failed refresh keeps the previously fetched keys"""
+        source = FailingKeySource(TEST_JWKS)
+        store = JWKSKeyStore(source, ttl=600, clock=self.clock)
+        store.get_key(TEST_KID)
+        source.fail = True
+        self.clock.now = 601
+        self.assertIsNotNone(store.get_key(TEST_KID))
+
+    def test_initial_fetch_failure_raises(self):
+        """Without any cached keys a fetch failure is not hidden"""
+        source = FailingKeySource(TEST_JWKS)
+        source.fail = True
+        store = JWKSKeyStore(source, min_refresh_interval=30,
+                             clock=self.clock)
+        with self.assertRaises(OSError):
+            store.get_key(TEST_KID)
+
+        # Within the refresh interval the outage is not fetched again
+        for _ in range(5):
+            self.clock.now += 5
+            with self.assertRaises(KeySetUnavailable):
+                store.get_key(TEST_KID)
+        self.assertEqual(source.fetch_count, 1)
+
+        self.clock.now += 10
+        source.fail = False
+        self.assertIsNotNone(store.get_key(TEST_KID))
+        self.assertEqual(source.fetch_count, 2)
+
+    def test_parse_max_age(self):
+        """Cache-Control max-age drives the TTL"""
+        self.assertEqual(parse_max_age('public, max-age=15'), 15)
+        self.assertEqual(parse_max_age('no-store'), 0)
+        self.assertIsNone(parse_max_age(None))
+
+    def test_verify_decode_jwt_with_local_key_source(self):
+        """verify_decode_jwt uses the pluggable key source"""
+        auth.set_key_source(self.source)
+        payload = auth.verify_decode_jwt(make_token(['get:actors']))
+        self.assertEqual(payload['permissions'], ['get:actors'])
+
+    def test_malformed_token_is_an_auth_error(self):
+        """A token that is not a JWT is a 401, not a 500"""
+        auth.set_key_source(self.source)
+        with self.assertRaises(auth.AuthError) as raised:
+            auth.verify_decode_jwt('abc')
+        self.assertEqual(raised.exception.status_code, 401)
+        self.assertEqual(raised.exception.error['code'], 'invalid_header')
+
+    def test_unreachable_key_set_is_a_503(self):
+        """A failed first fetch answers 503 rather than a bare 500"""
+        source = FailingKeySource(TEST_JWKS)
+        source.fail = True
+        auth.set_key_source(source)
+        auth.token_cache.clear()
+
+        app = Flask(__name__)
+
+        @app.route('/protected')
+        @auth.requires_auth('get:actors')
+        def protected(payload):
+            return 'ok'
+
+        for _ in range(3):
+            res = app.test_client().get('/protected', headers={
+                'Authorization': 'Bearer {}'.format(
+                    make_token(['get:actors']))})
+            self.assertEqual(res.status_code, 503)
+        self.assertEqual(source.fetch_count, 1)
+        res = app.test_client().get(
+            '/protected', headers={'Authorization': 'Bearer abc'})
+        self.assertEqual(res.status_code, 401)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified-token cache test case"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.clock.now = 1000.0
+        self.cache = TokenCache(max_size=2, max_ttl=3600, clock=self.clock)
+
+    def test_hit_and_miss_counters(self):
+        """Lookups are counted as hits or misses"""
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', {'exp': 2000})
+        self.assertEqual(self.cache.get('a'), {'exp': 2000})
+        self.assertEqual(self.cache.stats['hits'], 1)
+        self.assertEqual(self.cache.stats['misses'], 1)
+
+    def test_entry_expires_at_token_exp(self):
+        """A cached payload is dropped once the token expires"""
+        self.cache.put('a', {'exp': 1010})
+        self.clock.now = 1010
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_expired_token_is_not_cached(self):
+        """Tokens already past their exp are never stored"""
+        self.cache.put('a', {'exp': 900})
+        self.assertEqual(len(self.cache), 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        """The cache stays bounded by evicting the oldest entry"""
+        self.cache.put('a', {'exp': 2000})
+        self.cache.put('b', {'exp': 2000})
+        self.cache.get('a')
+        self.cache.put('c', {'exp': 2000})
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats['evictions'], 1)
+
+    def test_requires_auth_skips_verification_on_repeat(self):
+        """Repeat requests with the same token skip verify_decode_jwt"""
+        auth.set_key_source(StaticKeySource(TEST_JWKS))
+        auth.token_cache.clear()
+
+        app = Flask(__name__)
+
+        @app.route('/protected')
+        @auth.requires_auth('get:actors')
+        def protected(payload):
+            return payload['sub']
+
+        token = make_token(['get:actors'])
+        headers = {'Authorization': 'Bearer {}'.format(token)}
+
+        with mock.patch.object(auth, 'verify_decode_jwt',
+                               wraps=auth.verify_decode_jwt) as verify:
+            for _ in range(3):
+                res = app.test_client().get('/protected', headers=headers)
+                self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(verify.call_count, 1)
+        self.assertEqual(auth.token_cache.stats['hits'], 2)
+
+
+class PermissionsTestCase(unittest.TestCase):
+    """This class represents the permission check test case"""
+
+    def setUp(self):
+        self.payload = auth.Payload({
+            'permissions': ['get:actors', 'get:movies', 'post:actors']
+        })
+
+    def test_payload_precompiles_permission_set(self):
+        """Decoded payloads carry their permissions as a frozenset"""
+        self.assertEqual(self.payload.permission_set, frozenset(
+            ['get:actors', 'get:movies', 'post:actors']))
+
+    def test_all_of(self):
+        """Every listed permission is required"""
+        self.assertTrue(auth.check_permissions(
+            ['get:actors', 'get:movies'], self.payload))
+        with self.assertRaises(auth.AuthError):
+            auth.check_permissions(['get:actors', 'delete:actors'],
+                                   self.payload)
+
+    def test_any_of(self):
+        """At least one of the any_of permissions is required"""
+        self.assertTrue(auth.check_permissions(
+            None, self.payload, any_of=['delete:actors', 'post:actors']))
+        with self.assertRaises(auth.AuthError):
+            auth.check_permissions(None, self.payload,
+                                   any_of=['delete:actors', 'patch:actors'])
+
+    def test_plain_dict_payload(self):
+        """Plain claim dicts are still accepted"""
+        self.assertTrue(auth.check_permissions(
+            'get:actors', {'permissions': ['get:actors']}))
+        with self.assertRaises(auth.AuthError) as error:
+            auth.check_permissions('get:actors', {})
+        self.assertEqual(error.exception.status_code, 400)
+
+    def test_requires_auth_with_multiple_permissions(self):
+        """requires_auth checks all-of and any-of requirements"""
+        auth.set_key_source(StaticKeySource(TEST_JWKS))
+
+        app = Flask(__name__)
+
+        @app.route('/protected')
+        @auth.requires_auth(['get:actors', 'get:movies'],
+                            any_of=['patch:actors', 'patch:movies'])
+        def protected(payload):
+            return 'ok'
+
+        def get(permissions):
+            token = make_token(permissions)
+            return app.test_client().get('/protected', headers={
+                'Authorization': 'Bearer {}'.format(token)
+            })
+
+        self.assertEqual(
+            get(['get:actors', 'get:movies', 'patch:movies']).status_code,
+            200)
+        self.assertEqual(
+            get(['get:actors', 'get:movies']).status_code, 401)
+        self.assertEqual(
+            get(['get:actors', 'patch:movies']).status_code, 401)
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()